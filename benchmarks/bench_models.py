@@ -0,0 +1,127 @@
+import torch
+
+from .common import (
+    LATENT_FRAMES,
+    LATENT_HEIGHT,
+    LATENT_WIDTH,
+    TEXT_SEQ_LENGTH,
+    import_wrapper_module,
+    measure,
+    tiny_controlnet_config,
+    tiny_transformer_config,
+    video_tokens,
+)
+
+# classifier free guidance doubles the batch in the samplers, benchmark the shapes they actually run
+BATCH_SIZE = 2
+
+def _rotary_emb(config: dict, latent_frames: int, height: int, width: int, device):
+    if not config.get("use_rotary_positional_embeddings", False):
+        return None
+    p = config["patch_size"]
+    grid_height, grid_width = height // p, width // p
+    return import_wrapper_module("rotary_cache").get_rotary_emb_cache().get(
+        embed_dim=config["attention_head_dim"],
+        crops_coords=((0, 0), (grid_height, grid_width)),
+        grid_size=(grid_height, grid_width),
+        temporal_size=latent_frames,
+        device=device,
+    )
+
+def _inputs(config: dict, device, dtype, latent_frames=LATENT_FRAMES, height=LATENT_HEIGHT, width=LATENT_WIDTH):
+    latent_channels = config["out_channels"] or config["in_channels"]
+    return {
+        "hidden_states": torch.randn(BATCH_SIZE, latent_frames, latent_channels, height, width, device=device, dtype=dtype),
+        "encoder_hidden_states": torch.randn(BATCH_SIZE, TEXT_SEQ_LENGTH, config["text_embed_dim"], device=device, dtype=dtype),
+        "timestep": torch.full((BATCH_SIZE,), 500, device=device, dtype=torch.long),
+        "image_rotary_emb": _rotary_emb(config, latent_frames, height, width, device),
+    }
+
+def _result(name: str, config: dict, stats: dict, latent_frames=LATENT_FRAMES, height=LATENT_HEIGHT, width=LATENT_WIDTH) -> dict:
+    tokens = video_tokens(config, BATCH_SIZE, latent_frames, height, width)
+    return {
+        "name": name,
+        "batch_size": BATCH_SIZE,
+        "latent_shape": [latent_frames, height, width],
+        "tokens": tokens,
+        "tokens_per_s": tokens / stats["mean_s"],
+        **stats,
+    }
+
+def bench_transformer(device, dtype, warmup, repeats):
+    module = import_wrapper_module("custom_cogvideox_transformer_3d")
+    results = []
+    for config_name in ["transformer_config_2b.json", "transformer_config_5b.json"]:
+        config = tiny_transformer_config(config_name)
+        model = module.CogVideoXTransformer3DModel.from_config(config).to(device, dtype).eval()
+        inputs = _inputs(config, device, dtype)
+        stats = measure(lambda: model(**inputs, return_dict=False), warmup, repeats)
+        results.append(_result(f"transformer_{config_name.split('_')[-1].split('.')[0]}", config, stats))
+    return results
+
+def bench_fun_transformer(device, dtype, warmup, repeats):
+    module = import_wrapper_module("cogvideox_fun.transformer_3d")
+    config = tiny_transformer_config(in_channels=33)
+    model = module.CogVideoXTransformer3DModel.from_config(config).to(device, dtype).eval()
+    inputs = _inputs(config, device, dtype)
+    # mask + masked video latents, concatenated to the noise on the channel dim inside the model
+    inpaint_latents = torch.randn(BATCH_SIZE, LATENT_FRAMES, 33 - config["out_channels"], LATENT_HEIGHT, LATENT_WIDTH, device=device, dtype=dtype)
+    stats = measure(lambda: model(**inputs, inpaint_latents=inpaint_latents, return_dict=False), warmup, repeats)
+    return [_result("fun_transformer_inpaint", config, stats)]
+
+def bench_pab_transformer(device, dtype, warmup, repeats):
+    pab = import_wrapper_module("videosys.pab")
+    pab_mgr = import_wrapper_module("videosys.core.pab_mgr")
+    results = []
+    for name, module_name, in_channels in [
+        ("pab_transformer", "videosys.cogvideox_transformer_3d", None),
+        ("fun_pab_transformer_inpaint", "cogvideox_fun.fun_pab_transformer_3d", 33),
+    ]:
+        module = import_wrapper_module(module_name)
+        config = tiny_transformer_config(**({"in_channels": in_channels} if in_channels else {}))
+        model = module.CogVideoXTransformer3DModel.from_config(config).to(device, dtype).eval()
+        inputs = _inputs(config, device, dtype)
+        if in_channels:
+            inputs["inpaint_latents"] = torch.randn(
+                BATCH_SIZE, LATENT_FRAMES, in_channels - config["out_channels"], LATENT_HEIGHT, LATENT_WIDTH, device=device, dtype=dtype
+            )
+        # every call is a new step inside the default broadcast range, so every other call reuses the cached attention outputs
+        timesteps = [500 + step % 2 for step in range(warmup + repeats)]
+        model.pab_state = pab_mgr.pab_state_for(pab.CogVideoXPABConfig(steps=len(timesteps)), timesteps, model)
+        calls = iter(timesteps)
+        stats = measure(
+            lambda: model(**{**inputs, "timestep": torch.full_like(inputs["timestep"], next(calls))}, return_dict=False), warmup, repeats
+        )
+        results.append(_result(name, config, stats))
+    return results
+
+def bench_controlnet(device, dtype, warmup, repeats):
+    module = import_wrapper_module("cogvideo_controlnet")
+    transformer_config = tiny_transformer_config()
+    config = tiny_controlnet_config()
+    model = module.CogVideoXControlnet.from_config(config).to(device, dtype).eval()
+    inputs = _inputs(transformer_config, device, dtype)
+    # the ControlNet patch embedding keeps the full T5 width
+    inputs["encoder_hidden_states"] = torch.randn(BATCH_SIZE, TEXT_SEQ_LENGTH, 4096, device=device, dtype=dtype)
+    pixel_frames = (LATENT_FRAMES - 1) * transformer_config["temporal_compression_ratio"] + 1
+    controlnet_states = torch.randn(
+        BATCH_SIZE, pixel_frames, 3, LATENT_HEIGHT * 8, LATENT_WIDTH * 8, device=device, dtype=dtype
+    )
+    stats = measure(lambda: model(**inputs, controlnet_states=controlnet_states, return_dict=False), warmup, repeats)
+    return [_result("controlnet", transformer_config, stats)]
+
+BENCHMARKS = {
+    "transformer": bench_transformer,
+    "fun_transformer": bench_fun_transformer,
+    "pab_transformer": bench_pab_transformer,
+    "controlnet": bench_controlnet,
+}
+
+def run(device, dtype, warmup: int = 1, repeats: int = 3) -> list:
+    results = []
+    for name, bench in BENCHMARKS.items():
+        try:
+            results.extend(bench(device, dtype, warmup, repeats))
+        except Exception as e:
+            results.append({"name": name, "error": f"{type(e).__name__}: {e}"})
+    return results
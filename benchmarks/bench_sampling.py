@@ -0,0 +1,144 @@
+import torch
+
+from .common import (
+    LATENT_FRAMES,
+    LATENT_HEIGHT,
+    LATENT_WIDTH,
+    TEXT_SEQ_LENGTH,
+    add_comfyui_to_path,
+    import_wrapper_module,
+    load_config,
+    measure,
+    tiny_transformer_config,
+    tiny_vae_config,
+    video_tokens,
+)
+
+NUM_STEPS = 8
+GUIDANCE_SCALE = 6.0
+
+# keyword arguments on top of the common ones, in the units the pipeline expects (latent frames for the context options)
+# the modes without a context schedule turn FreeNoise off, its noise shuffling needs the context options
+SAMPLING_MODES = {
+    "plain": {"freenoise": False},
+    "cfg_sequential": {"cfg_mode": "sequential", "freenoise": False},
+    "context": {
+        "context_schedule": "uniform_standard",
+        "context_frames": 4,
+        "context_stride": 1,
+        "context_overlap": 1,
+        "freenoise": True,
+    },
+    "context_batched": {
+        "context_schedule": "uniform_standard",
+        "context_frames": 4,
+        "context_stride": 1,
+        "context_overlap": 1,
+        "freenoise": True,
+        "context_batch_size": 4,
+    },
+    "temporal_tiling": {
+        "context_schedule": "temporal_tiling",
+        "context_frames": 4,
+        "context_stride": 1,
+        "context_overlap": 1,
+        "freenoise": True,
+    },
+    "temporal_tiling_dpm": {
+        "scheduler": "CogVideoXDPMScheduler",
+        "context_schedule": "temporal_tiling",
+        "context_frames": 4,
+        "context_stride": 1,
+        "context_overlap": 1,
+        "freenoise": True,
+    },
+    "fastercache": {
+        "fastercache": {"start_step": 2, "hf_step": 4, "lf_step": 6},
+        "freenoise": False,
+    },
+    "pab": {
+        "pab": True,
+        "freenoise": False,
+    },
+}
+
+def _scheduler(name: str):
+    from diffusers.schedulers import CogVideoXDDIMScheduler, CogVideoXDPMScheduler
+    scheduler_class = {"CogVideoXDDIM": CogVideoXDDIMScheduler, "CogVideoXDPMScheduler": CogVideoXDPMScheduler}[name]
+    return scheduler_class.from_config(load_config("scheduler_config_5b.json"))
+
+def _pipeline(mode: dict, device, dtype):
+    from diffusers.models import AutoencoderKLCogVideoX
+    pipeline_module = import_wrapper_module("pipeline_cogvideox")
+    config = tiny_transformer_config()
+    pab_config = None
+    if mode.get("pab"):
+        transformer_class = import_wrapper_module("videosys.cogvideox_transformer_3d").CogVideoXTransformer3DModel
+        pab_config = import_wrapper_module("videosys.pab").CogVideoXPABConfig(steps=NUM_STEPS)
+    else:
+        transformer_class = import_wrapper_module("custom_cogvideox_transformer_3d").CogVideoXTransformer3DModel
+    transformer = transformer_class.from_config(config).to(device, dtype).eval()
+    vae = AutoencoderKLCogVideoX.from_config(tiny_vae_config()).to(device, dtype).eval()
+    scheduler = _scheduler(mode.get("scheduler", "CogVideoXDDIM"))
+    pipe = pipeline_module.CogVideoXPipeline(vae, transformer, scheduler, pab_config=pab_config)
+
+    # same attributes CogVideoSampler sets from the CogVideoXFasterCache node
+    fastercache = mode.get("fastercache")
+    transformer.use_fastercache = fastercache is not None
+    transformer.fastercache_counter = 0
+    if fastercache is not None:
+        transformer.fastercache_policy = import_wrapper_module("fastercache").FasterCachePolicy(
+            start_step=fastercache["start_step"],
+            lf_step=fastercache["lf_step"],
+            hf_step=fastercache["hf_step"],
+            cache_device=torch.device(device),
+        )
+    return pipe, config
+
+def bench_mode(name: str, mode: dict, device, dtype, warmup: int, repeats: int) -> dict:
+    pipe, config = _pipeline(mode, device, dtype)
+    num_frames = (LATENT_FRAMES - 1) * pipe.vae_scale_factor_temporal + 1
+    prompt_embeds = torch.randn(1, TEXT_SEQ_LENGTH, config["text_embed_dim"], device=device, dtype=dtype)
+    negative_prompt_embeds = torch.randn_like(prompt_embeds)
+    call_kwargs = {k: v for k, v in mode.items() if k not in ("scheduler", "fastercache", "pab")}
+
+    def sample():
+        output = pipe(
+            height=LATENT_HEIGHT * pipe.vae_scale_factor_spatial,
+            width=LATENT_WIDTH * pipe.vae_scale_factor_spatial,
+            num_frames=num_frames,
+            num_inference_steps=NUM_STEPS,
+            guidance_scale=GUIDANCE_SCALE,
+            prompt_embeds=prompt_embeds,
+            negative_prompt_embeds=negative_prompt_embeds,
+            generator=torch.Generator(device=device).manual_seed(0),
+            device=torch.device(device),
+            **call_kwargs,
+        )
+        # like CogVideoSampler, every run starts from an empty cache
+        if getattr(pipe.transformer, "fastercache_state", None) is not None:
+            pipe.transformer.fastercache_state.clear()
+        return output
+
+    stats = measure(sample, warmup, repeats)
+    # tokens of the full latent video denoised per step, with the CFG doubled batch
+    tokens = video_tokens(config, 2, LATENT_FRAMES, LATENT_HEIGHT, LATENT_WIDTH) * NUM_STEPS
+    return {
+        "name": f"sampling_{name}",
+        "steps": NUM_STEPS,
+        "latent_shape": [LATENT_FRAMES, LATENT_HEIGHT, LATENT_WIDTH],
+        "tokens_per_s": tokens / stats["mean_s"],
+        "steps_per_s": NUM_STEPS / stats["mean_s"],
+        **stats,
+    }
+
+def run(device, dtype, warmup: int = 1, repeats: int = 3) -> list:
+    if not add_comfyui_to_path():
+        return [{"name": "sampling", "skipped": "the pipelines import comfy, set COMFYUI_PATH to a ComfyUI checkout"}]
+    results = []
+    for name, mode in SAMPLING_MODES.items():
+        try:
+            results.append(bench_mode(name, mode, device, dtype, warmup, repeats))
+        except Exception as e:
+            results.append({"name": f"sampling_{name}", "error": f"{type(e).__name__}: {e}"})
+    return results
@@ -0,0 +1,68 @@
+import torch
+
+from .common import LATENT_FRAMES, LATENT_HEIGHT, LATENT_WIDTH, import_wrapper_module, measure, tiny_vae_config
+
+# spatial tiles smaller than the synthetic frames so the tiled paths actually split and blend
+TILE_SAMPLE_SIZE = 64
+
+def _vae_classes():
+    from diffusers.models import AutoencoderKLCogVideoX
+    fun_module = import_wrapper_module("cogvideox_fun.autoencoder_magvit")
+    return {
+        "vae": AutoencoderKLCogVideoX,
+        "fun_vae": fun_module.AutoencoderKLCogVideoX,
+    }
+
+def _result(name: str, num_frames: int, stats: dict) -> dict:
+    return {
+        "name": name,
+        "frames": num_frames,
+        "frames_per_s": num_frames / stats["mean_s"],
+        **stats,
+    }
+
+def bench_vae(name, vae_class, device, dtype, warmup, repeats):
+    vae = vae_class.from_config(tiny_vae_config()).to(device, dtype).eval()
+    vae.enable_slicing()
+    num_frames = (LATENT_FRAMES - 1) * vae.config.temporal_compression_ratio + 1
+    pixels = torch.randn(1, 3, num_frames, LATENT_HEIGHT * 8, LATENT_WIDTH * 8, device=device, dtype=dtype)
+    latents = torch.randn(1, vae.config.latent_channels, LATENT_FRAMES, LATENT_HEIGHT, LATENT_WIDTH, device=device, dtype=dtype)
+
+    def clear_cache():
+        # only present on diffusers versions with the fake context parallel cache, the nodes guard it the same way
+        try:
+            vae._clear_fake_context_parallel_cache()
+        except AttributeError:
+            pass
+
+    def encode():
+        clear_cache()
+        return vae.encode(pixels).latent_dist.sample()
+
+    def decode():
+        clear_cache()
+        return vae.decode(latents).sample
+
+    results = []
+    for tiled in [False, True]:
+        suffix = "_tiled" if tiled else ""
+        if tiled:
+            if name == "vae":
+                # same as CogVideoImageEncode, older diffusers only tile the decoder
+                import_wrapper_module("mz_enable_vae_encode_tiling").enable_vae_encode_tiling(vae)
+            vae.enable_tiling(tile_sample_min_height=TILE_SAMPLE_SIZE, tile_sample_min_width=TILE_SAMPLE_SIZE)
+        else:
+            vae.disable_tiling()
+        results.append(_result(f"{name}_encode{suffix}", num_frames, measure(encode, warmup, repeats)))
+        results.append(_result(f"{name}_decode{suffix}", num_frames, measure(decode, warmup, repeats)))
+    vae.disable_tiling()
+    return results
+
+def run(device, dtype, warmup: int = 1, repeats: int = 3) -> list:
+    results = []
+    for name, vae_class in _vae_classes().items():
+        try:
+            results.extend(bench_vae(name, vae_class, device, dtype, warmup, repeats))
+        except Exception as e:
+            results.append({"name": name, "error": f"{type(e).__name__}: {e}"})
+    return results
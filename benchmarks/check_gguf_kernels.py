@@ -0,0 +1,81 @@
+"""
+CPU check of the GGUF kernels in mz_gguf_loader against the reference implementation of the gguf package
+(`pip install gguf`): every registered dequantize kernel on random blocks, and the quantizers on random weights, which
+have to produce the same bytes as ggml.
+
+Usage, from the root of the node pack:
+
+    python -m benchmarks.check_gguf_kernels
+
+Exits with a non-zero status when a kernel doesn't match.
+"""
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+from .common import import_wrapper_module
+
+def _random_blocks(qtype, num_rows: int, blocks_per_row: int, generator) -> torch.Tensor:
+    """Random packed blocks with finite fp16 scales, every field of the layout is otherwise arbitrary bytes"""
+    import gguf
+    block_size, type_size = gguf.GGML_QUANT_SIZES[gguf.GGMLQuantizationType[qtype]]
+    data = torch.randint(0, 256, (num_rows * blocks_per_row, type_size), dtype=torch.uint8, generator=generator)
+    # the scales (d, m) of every layout are fp16 values at the start of the block, or at the end for the k-quants
+    scales = (torch.rand(num_rows * blocks_per_row, 2, generator=generator) * 0.02 - 0.01).to(torch.float16)
+    scale_bytes = scales.view(torch.uint8)
+    if qtype.endswith("_K"):
+        data[:, -2:] = scale_bytes[:, :2]
+    else:
+        num_scales = 2 if qtype in ("Q4_1", "Q5_1") else 1
+        data[:, :2 * num_scales] = scale_bytes[:, :2 * num_scales]
+    return data.reshape(num_rows, blocks_per_row * type_size)
+
+def check_dequantize(qtype: str, generator) -> float:
+    """Compared in fp16, the default output dtype, the Q4_0 kernels multiply the scales in fp16 rather than fp32"""
+    import gguf
+    mz = import_wrapper_module("mz_gguf_loader")
+    data = _random_blocks(qtype, 8, 4, generator)
+    expected = torch.from_numpy(gguf.quants.dequantize(data.numpy(), gguf.GGMLQuantizationType[qtype])).half()
+    kernels = [mz.QUANT_TYPES[qtype].dequantize]
+    if qtype == "Q4_0":
+        kernels.append(mz.dequantize_blocks_Q4_0_reference)
+    return max((kernel(data, dtype=torch.float16) - expected).float().abs().max().item() for kernel in kernels)
+
+def check_quantize(qtype: str, generator) -> int:
+    """Number of bytes that differ from the gguf package quantizer"""
+    import gguf
+    mz = import_wrapper_module("mz_gguf_loader")
+    weight = torch.randn(16, 256, generator=generator)
+    # exact halves and zero blocks exercise the rounding and the all zero scale
+    weight[0] = torch.arange(256) / 2 - 64
+    weight[1] = 0
+    expected = gguf.quants.quantize(weight.numpy(), gguf.GGMLQuantizationType[qtype])
+    packed = mz.QUANT_TYPES[qtype].quantize(weight).numpy()
+    return int(np.count_nonzero(packed != expected))
+
+def run(seed: int = 0) -> bool:
+    mz = import_wrapper_module("mz_gguf_loader")
+    generator = torch.Generator().manual_seed(seed)
+    ok = True
+    for name, qtype in mz.QUANT_TYPES.items():
+        error = check_dequantize(name, generator)
+        print(f"{name} dequantize: max abs error {error:.3g}")
+        ok &= error == 0
+        if qtype.quantize is not None:
+            mismatches = check_quantize(name, generator)
+            print(f"{name} quantize: {mismatches} mismatched bytes")
+            ok &= mismatches == 0
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    ok = run(args.seed)
+    print("all kernels match the gguf package" if ok else "MISMATCH against the gguf package")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import gc
+import importlib
+import importlib.machinery
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+
+import torch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_DIR = os.path.join(REPO_ROOT, "configs")
+# the node pack is imported under a fixed name so its relative imports resolve without running the ComfyUI node registration in __init__.py
+PACKAGE_NAME = "cogvideox_wrapper"
+
+# latent sizes of the synthetic runs, small enough to keep a full suite on CPU in the minutes range
+LATENT_FRAMES = 9
+LATENT_HEIGHT = 16
+LATENT_WIDTH = 16
+TEXT_SEQ_LENGTH = 16
+
+def import_wrapper_module(name: str):
+    if PACKAGE_NAME not in sys.modules:
+        spec = importlib.machinery.ModuleSpec(PACKAGE_NAME, None, is_package=True)
+        package = importlib.util.module_from_spec(spec)
+        package.__path__ = [REPO_ROOT]
+        sys.modules[PACKAGE_NAME] = package
+    return importlib.import_module(f"{PACKAGE_NAME}.{name}")
+
+def add_comfyui_to_path() -> bool:
+    """The sampling pipelines import comfy.utils, look for the ComfyUI checkout the node pack is installed in"""
+    try:
+        import comfy.utils  # noqa: F401
+        return True
+    except ImportError:
+        pass
+    candidates = [os.environ.get("COMFYUI_PATH"), os.path.dirname(os.path.dirname(REPO_ROOT))]
+    for path in candidates:
+        if path and os.path.isdir(os.path.join(path, "comfy")):
+            sys.path.insert(0, path)
+            try:
+                import comfy.utils  # noqa: F401
+                return True
+            except ImportError:
+                sys.path.remove(path)
+    return False
+
+def load_config(name: str) -> dict:
+    with open(os.path.join(CONFIG_DIR, name)) as f:
+        config = json.load(f)
+    return {k: v for k, v in config.items() if not k.startswith("_")}
+
+def tiny_transformer_config(name: str = "transformer_config_5b.json", **overrides) -> dict:
+    """Scaled down copy of a transformer config, keeps the architecture flags (rotary, patch size, activations)"""
+    config = load_config(name)
+    config.update(
+        num_layers=2,
+        num_attention_heads=2,
+        attention_head_dim=64,
+        text_embed_dim=64,
+        time_embed_dim=64,
+        max_text_seq_length=TEXT_SEQ_LENGTH,
+        sample_frames=(LATENT_FRAMES - 1) * config.get("temporal_compression_ratio", 4) + 1,
+        sample_height=LATENT_HEIGHT,
+        sample_width=LATENT_WIDTH,
+    )
+    config.update(overrides)
+    return config
+
+def tiny_controlnet_config(**overrides) -> dict:
+    transformer_config = tiny_transformer_config()
+    config = {
+        "num_attention_heads": transformer_config["num_attention_heads"],
+        "attention_head_dim": transformer_config["attention_head_dim"],
+        "vae_channels": transformer_config["in_channels"],
+        "in_channels": 3,
+        "downscale_coef": 8,
+        "time_embed_dim": transformer_config["time_embed_dim"],
+        "num_layers": 2,
+        "sample_width": transformer_config["sample_width"],
+        "sample_height": transformer_config["sample_height"],
+        "sample_frames": transformer_config["sample_frames"],
+        "max_text_seq_length": TEXT_SEQ_LENGTH,
+        "use_rotary_positional_embeddings": transformer_config["use_rotary_positional_embeddings"],
+        "out_proj_dim": transformer_config["num_attention_heads"] * transformer_config["attention_head_dim"],
+    }
+    config.update(overrides)
+    return config
+
+def tiny_vae_config(**overrides) -> dict:
+    config = load_config("vae_config.json")
+    config.update(
+        block_out_channels=[16, 32, 32, 32],
+        layers_per_block=1,
+        norm_num_groups=8,
+        sample_height=LATENT_HEIGHT * 8,
+        sample_width=LATENT_WIDTH * 8,
+    )
+    config.update(overrides)
+    return config
+
+def video_tokens(config: dict, batch_size: int, latent_frames: int, height: int, width: int) -> int:
+    p = config["patch_size"]
+    return batch_size * latent_frames * (height // p) * (width // p)
+
+def _current_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # ru_maxrss is the lifetime peak, in kilobytes on linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+class PeakRSS:
+    """Samples the resident set size on a background thread to get the peak of a single benchmark"""
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        gc.collect()
+        self.peak = _current_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _current_rss())
+
+def measure(fn, warmup: int = 1, repeats: int = 3) -> dict:
+    """Runs fn warmup + repeats times, returns the timing statistics in seconds and the peak RSS in bytes"""
+    with torch.inference_mode():
+        for _ in range(warmup):
+            fn()
+        times = []
+        with PeakRSS() as rss:
+            for _ in range(repeats):
+                start = time.perf_counter()
+                fn()
+                times.append(time.perf_counter() - start)
+    times.sort()
+    return {
+        "repeats": repeats,
+        "mean_s": sum(times) / len(times),
+        "median_s": times[len(times) // 2],
+        "min_s": times[0],
+        "peak_rss_bytes": rss.peak,
+    }
@@ -0,0 +1,104 @@
+"""
+Micro benchmarks of the CogVideoX wrapper on tiny synthetic configs, so they run on CPU and in CI without any weights.
+
+Usage, from the root of the node pack:
+
+    python -m benchmarks.run_benchmarks --suites models vae --output benchmark_results.json
+    COMFYUI_PATH=/path/to/ComfyUI python -m benchmarks.run_benchmarks --suites sampling --device cuda --dtype bf16
+
+Suites:
+    models:   forward pass of the transformer (2b and 5b layouts), Fun inpaint transformer, PAB transformers and ControlNet
+    vae:      encode and decode, tiled and untiled, of the diffusers and Fun VAEs
+    sampling: full denoising loops of CogVideoXPipeline (plain, sequential CFG, context windows, temporal tiling,
+              FasterCache and PAB), needs ComfyUI importable since the pipelines depend on comfy.utils
+
+Results are throughput (tokens/s for the transformers, frames/s for the VAE), wall time and the peak resident set size.
+Absolute numbers on the tiny configs are only meaningful relative to other runs on the same machine.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+
+import torch
+
+from . import bench_models, bench_sampling, bench_vae
+from .common import REPO_ROOT
+
+SUITES = {
+    "models": bench_models.run,
+    "vae": bench_vae.run,
+    "sampling": bench_sampling.run,
+}
+
+DTYPES = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _metadata(args) -> dict:
+    import diffusers
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": _git_revision(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "diffusers": diffusers.__version__,
+        "device": args.device,
+        "dtype": args.dtype,
+        "threads": torch.get_num_threads(),
+        "warmup": args.warmup,
+        "repeats": args.repeats,
+    }
+
+def _summary(result: dict) -> str:
+    if "error" in result:
+        return f"error: {result['error']}"
+    if "skipped" in result:
+        return f"skipped: {result['skipped']}"
+    throughput = f"{result['tokens_per_s']:.0f} tokens/s" if "tokens_per_s" in result else f"{result['frames_per_s']:.2f} frames/s"
+    return f"{result['mean_s'] * 1000:.1f}ms, {throughput}, peak RSS {result['peak_rss_bytes'] / 1024**2:.0f}MB"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CogVideoX wrapper micro benchmarks")
+    parser.add_argument("--suites", nargs="+", choices=list(SUITES), default=list(SUITES))
+    parser.add_argument("--output", default="benchmark_results.json", help="path of the JSON report")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", choices=list(DTYPES), default="fp32")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads, defaults to torch's own choice")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    report = {"metadata": _metadata(args), "results": {}}
+    for suite in args.suites:
+        print(f"[{suite}]")
+        results = SUITES[suite](args.device, DTYPES[args.dtype], args.warmup, args.repeats)
+        for result in results:
+            print(f"  {result['name']}: {_summary(result)}")
+        report["results"][suite] = results
+
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    return report
+
+if __name__ == "__main__":
+    main()
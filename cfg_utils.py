@@ -0,0 +1,49 @@
+from typing import Callable, Optional
+
+import torch
+
+# "batched" runs the unconditional and conditional passes as one doubled batch,
+# "sequential" runs them one after the other to halve the peak activation memory
+CFG_MODES = ["batched", "sequential"]
+
+def cfg_chunk(x, index: int, dim: int = 0, groups: int = 1):
+    """
+    Selects the unconditional (index 0) or conditional (index 1) half of an input doubled for classifier free guidance.
+    Doubled inputs are laid out as [uncond, cond] along `dim`, repeated `groups` times when several context windows are stacked.
+    Lists and tuples are split element wise, None is passed through.
+    """
+    if x is None:
+        return None
+    if isinstance(x, (list, tuple)):
+        return type(x)(cfg_chunk(v, index, dim, groups) for v in x)
+    return x.unflatten(dim, (groups, 2, -1)).select(dim + 1, index).flatten(dim, dim + 1)
+
+def cfg_forward(
+    predict: Callable[..., torch.Tensor],
+    cfg_inputs: dict,
+    cfg_mode: str = "batched",
+    groups: int = 1,
+    cfg_dims: Optional[dict] = None,
+    out: Optional[torch.Tensor] = None,
+    **shared_inputs,
+) -> torch.Tensor:
+    """
+    Calls `predict` on the CFG doubled `cfg_inputs`, either once on the full batch or once per half in "sequential" mode.
+    `predict` must return a tensor with the batch on dim 0. Sequential results are written into `out` when it has the
+    right shape, so the caller can hand back the previous result to reuse its memory.
+    """
+    if cfg_mode == "batched":
+        return predict(**cfg_inputs, **shared_inputs)
+    if cfg_mode != "sequential":
+        raise ValueError(f"Unknown cfg_mode {cfg_mode}")
+
+    cfg_dims = cfg_dims or {}
+    for index in range(2):
+        half_inputs = {name: cfg_chunk(value, index, cfg_dims.get(name, 0), groups) for name, value in cfg_inputs.items()}
+        pred = predict(**half_inputs, **shared_inputs)
+        pred = pred.unflatten(0, (groups, -1))
+        if out is None or out.shape != (groups * 2 * pred.shape[1], *pred.shape[2:]) or out.dtype != pred.dtype:
+            out = pred.new_empty((groups * 2 * pred.shape[1], *pred.shape[2:]))
+        out.unflatten(0, (groups, 2, -1))[:, index] = pred
+        del pred
+    return out
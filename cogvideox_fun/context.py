@@ -1,11 +1,17 @@
+import functools
 import numpy as np
+import torch
+from collections import deque
 from typing import Callable, Optional, List
 
+_BIT_REVERSE_TABLE = [int(f"{i:08b}"[::-1], 2) for i in range(256)]
 
 def ordered_halving(val):
-    bin_str = f"{val:064b}"
-    bin_flip = bin_str[::-1]
-    as_int = int(bin_flip, 2)
+    # reverse the 64 bits of val one byte at a time
+    as_int = 0
+    for _ in range(8):
+        as_int = (as_int << 8) | _BIT_REVERSE_TABLE[val & 0xFF]
+        val >>= 8
 
     return as_int / (1 << 64)
 
@@ -95,30 +101,27 @@ def uniform_standard(
             windows.append([e % num_frames for e in range(j, j + context_size * context_step, context_step)])
 
     # now that windows are created, shift any windows that loop, and delete duplicate windows
-    delete_idxs = []
-    win_i = 0
-    while win_i < len(windows):
+    unique_windows = []
+    seen = set()
+    queue = deque(windows)
+    while queue:
+        window = queue.popleft()
         # if window is rolls over itself, need to shift it
-        is_roll, roll_idx = does_window_roll_over(windows[win_i], num_frames)
+        is_roll, roll_idx = does_window_roll_over(window, num_frames)
         if is_roll:
-            roll_val = windows[win_i][roll_idx]  # roll_val might not be 0 for windows of higher strides
-            shift_window_to_end(windows[win_i], num_frames=num_frames)
+            roll_val = window[roll_idx]  # roll_val might not be 0 for windows of higher strides
+            shift_window_to_end(window, num_frames=num_frames)
             # check if next window (cyclical) is missing roll_val
-            if roll_val not in windows[(win_i+1) % len(windows)]:
+            next_window = queue[0] if queue else (unique_windows[0] if unique_windows else window)
+            if roll_val not in next_window:
                 # need to insert new window here - just insert window starting at roll_val
-                windows.insert(win_i+1, list(range(roll_val, roll_val + context_size)))
-        # delete window if it's not unique
-        for pre_i in range(0, win_i):
-            if windows[win_i] == windows[pre_i]:
-                delete_idxs.append(win_i)
-                break
-        win_i += 1
-
-    # reverse delete_idxs so that they will be deleted in an order that doesn't break idx correlation
-    delete_idxs.reverse()
-    for i in delete_idxs:
-        windows.pop(i)
-    return windows
+                queue.appendleft(list(range(roll_val, roll_val + context_size)))
+        # keep window only if it's unique
+        key = tuple(window)
+        if key not in seen:
+            seen.add(key)
+            unique_windows.append(window)
+    return unique_windows
 
 def static_standard(
     step: int = ...,
@@ -146,6 +149,34 @@ def static_standard(
         windows.append(list(range(start_idx, start_idx + context_size)))
     return windows
 
+#temporal tiling code based on https://github.com/mayuelala/FollowYourEmoji/blob/main/models/video_pipeline.py
+def temporal_tiling(
+    step: int = ...,
+    num_steps: Optional[int] = None,
+    num_frames: int = ...,
+    context_size: Optional[int] = None,
+    context_stride: int = 3,
+    context_overlap: int = 4,
+    closed_loop: bool = True,
+):
+    if num_frames <= context_size:
+        return [list(range(num_frames))]
+    grid_ts = 0
+    cur_t = 0
+    while cur_t < num_frames:
+        cur_t = max(grid_ts * context_size - context_overlap * grid_ts, 0) + context_size
+        grid_ts += 1
+
+    windows = []
+    for t_i in range(grid_ts):
+        # last tile is aligned to the end of the video
+        if t_i < grid_ts - 1:
+            ofs_t = max(t_i * context_size - context_overlap * t_i, 0)
+        else:
+            ofs_t = num_frames - context_size
+        windows.append(list(range(ofs_t, ofs_t + context_size)))
+    return windows
+
 def get_context_scheduler(name: str) -> Callable:
     if name == "uniform_looped":
         return uniform_looped
@@ -153,6 +184,8 @@ def get_context_scheduler(name: str) -> Callable:
         return uniform_standard
     elif name == "static_standard":
         return static_standard
+    elif name == "temporal_tiling":
+        return temporal_tiling
     else:
         raise ValueError(f"Unknown context_overlap policy {name}")
 
@@ -182,3 +215,114 @@ def get_total_steps(
         )
         for i in range(len(timesteps))
     )
+
+
+CONTEXT_WEIGHT_PROFILES = ["flat", "gaussian", "pyramid"]
+
+@functools.lru_cache(maxsize=64)
+def _context_weights(profile: str, window_length: int, overlap: int) -> torch.Tensor:
+    if profile == "flat":
+        weights = np.ones(window_length)
+    elif profile == "gaussian":
+        var = 0.01
+        midpoint = (window_length - 1) / 2  # -1 because index goes from 0 to window_length - 1
+        t = np.arange(window_length)
+        weights = np.exp(-(t - midpoint) * (t - midpoint) / (window_length * window_length) / (2 * var)) / np.sqrt(2 * np.pi * var)
+    elif profile == "pyramid":
+        # ramp up over the overlapping frames on both ends, flat in between
+        t = np.arange(window_length)
+        ramp = max(overlap, 1) + 1
+        weights = np.minimum(np.minimum(t + 1, window_length - t), ramp) / ramp
+    else:
+        raise ValueError(f"Unknown context weight profile {profile}")
+    return torch.from_numpy(weights).to(torch.float32)
+
+def get_context_weights(profile: str, window_length: int, overlap: int, device: torch.device = torch.device("cpu")) -> torch.Tensor:
+    """Per-frame blending weights of a context window, shape (window_length,)"""
+    return _context_weights(profile, window_length, overlap).to(device)
+
+
+class ContextPlan:
+    """
+    Context windows for every step of a sampling run, built once up front.
+    Windows of each step are stored as a (num_windows, window_length) int64 tensor on the target device,
+    together with the blending weights of the windows and the per-frame sum of the weights covering each frame.
+    The frame indices of the windows are also kept on the host (`frames`), as the key the caches of the transformer
+    track a window by, since the shifting schedules move the window at a given position from step to step.
+    """
+    def __init__(
+        self,
+        scheduler: Callable,
+        num_steps: int,
+        num_frames: int,
+        context_size: int,
+        context_stride: int = 3,
+        context_overlap: int = 4,
+        closed_loop: bool = True,
+        weight_profile: str = "flat",
+        device: torch.device = torch.device("cpu"),
+    ):
+        self.num_frames = num_frames
+        self.weight_profile = weight_profile
+        self.step_windows = []
+        self.step_weights = []
+        self.step_counts = []
+        self.step_frames = []
+        # steps that produce the same windows share their tensors
+        built = {}
+        for step in range(num_steps):
+            windows = list(scheduler(step, num_steps, num_frames, context_size, context_stride, context_overlap, closed_loop))
+            key = tuple(map(tuple, windows))
+            if key not in built:
+                # shifted windows of higher strides can run past the last frame, wrap them like the looped schedule does
+                window_idx = torch.tensor(windows, dtype=torch.long) % num_frames
+                num_windows, window_length = window_idx.shape
+                weights = _context_weights(weight_profile, window_length, context_overlap)
+                counts = torch.zeros(num_frames, dtype=torch.float32).index_add_(0, window_idx.flatten(), weights.repeat(num_windows))
+                frames = tuple(map(tuple, window_idx.tolist()))
+                built[key] = (window_idx.to(device), weights.to(device), counts.to(device), frames)
+            window_idx, weights, counts, frames = built[key]
+            self.step_windows.append(window_idx)
+            self.step_weights.append(weights)
+            self.step_counts.append(counts)
+            self.step_frames.append(frames)
+
+    def __len__(self):
+        return len(self.step_windows)
+
+    def windows(self, step: int) -> torch.Tensor:
+        return self.step_windows[step]
+
+    def weights(self, step: int) -> Optional[torch.Tensor]:
+        # flat windows need no multiply
+        return None if self.weight_profile == "flat" else self.step_weights[step]
+
+    def counts(self, step: int) -> torch.Tensor:
+        return self.step_counts[step]
+
+    def frames(self, step: int, start: int = 0, num_windows: int = 1) -> tuple:
+        """Frame indices of `num_windows` windows of the step from `start`, as a hashable tuple per window"""
+        return self.step_frames[step][start:start + num_windows]
+
+    def batches(self, step: int, batch_size: int = 1):
+        window_idx = self.step_windows[step]
+        for start in range(0, window_idx.shape[0], batch_size):
+            yield start, window_idx[start:start + batch_size]
+
+def gather_context_windows(x: torch.Tensor, window_idx: torch.Tensor) -> torch.Tensor:
+    """(B, F, ...) -> (K * B, W, ...) for K windows of length W, ordered window-major"""
+    num_windows, window_length = window_idx.shape
+    x = x.index_select(1, window_idx.flatten()).unflatten(1, (num_windows, window_length))
+    return x.transpose(0, 1).flatten(0, 1)
+
+def scatter_add_context_windows(out: torch.Tensor, x: torch.Tensor, window_idx: torch.Tensor, weights: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Inverse of gather_context_windows, accumulates (K * B, W, ...) into out of shape (B, F, ...).
+    Optional per-frame window weights of shape (W,) are applied in the same pass as the cast to the accumulator dtype.
+    """
+    num_windows = window_idx.shape[0]
+    if weights is not None:
+        x = x * weights.view(1, -1, *([1] * (x.dim() - 2))).to(out.dtype)
+    x = x.unflatten(0, (num_windows, -1)).transpose(0, 1).flatten(1, 2)
+    return out.index_add_(1, window_idx.flatten(), x.to(out.dtype))
+
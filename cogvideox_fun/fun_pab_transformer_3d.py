@@ -34,7 +34,7 @@ from diffusers.models.modeling_utils import ModelMixin
 
 from ..videosys.modules.normalization import AdaLayerNorm, CogVideoXLayerNormZero
 from ..videosys.modules.embeddings import apply_rotary_emb
-from ..videosys.core.pab_mgr import enable_pab, if_broadcast_spatial
+from ..videosys.core.pab_mgr import PABWindow
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 try:
@@ -333,8 +333,6 @@ class CogVideoXBlock(nn.Module):
         )
 
         # pab
-        self.attn_count = 0
-        self.last_attn = None
         self.block_idx = block_idx
 
     def forward(
@@ -343,7 +341,7 @@ class CogVideoXBlock(nn.Module):
         encoder_hidden_states: torch.Tensor,
         temb: torch.Tensor,
         image_rotary_emb: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
-        timestep=None,
+        pab: Optional[PABWindow] = None,
     ) -> torch.Tensor:
         text_seq_length = encoder_hidden_states.size(1)
 
@@ -353,18 +351,16 @@ class CogVideoXBlock(nn.Module):
         )
 
         # attention
-        if enable_pab():
-            broadcast_attn, self.attn_count = if_broadcast_spatial(int(timestep[0]), self.attn_count, self.block_idx)
-        if enable_pab() and broadcast_attn:
-            attn_hidden_states, attn_encoder_hidden_states = self.last_attn
+        if pab is not None and pab.broadcast_spatial(self.block_idx):
+            attn_hidden_states, attn_encoder_hidden_states = pab.last_attn[self.block_idx]
         else:
             attn_hidden_states, attn_encoder_hidden_states = self.attn1(
                 hidden_states=norm_hidden_states,
                 encoder_hidden_states=norm_encoder_hidden_states,
                 image_rotary_emb=image_rotary_emb,
             )
-            if enable_pab():
-                self.last_attn = (attn_hidden_states, attn_encoder_hidden_states)
+            if pab is not None:
+                pab.save_attn(self.block_idx, attn_hidden_states, attn_encoder_hidden_states)
 
         hidden_states = hidden_states + gate_msa * attn_hidden_states
         encoder_hidden_states = encoder_hidden_states + enc_gate_msa * attn_encoder_hidden_states
@@ -375,8 +371,13 @@ class CogVideoXBlock(nn.Module):
         )
 
         # feed-forward
-        norm_hidden_states = torch.cat([norm_encoder_hidden_states, norm_hidden_states], dim=1)
-        ff_output = self.ff(norm_hidden_states)
+        if pab is not None and pab.broadcast_mlp(self.block_idx):
+            ff_output = pab.mlp_output(self.block_idx)
+        else:
+            norm_hidden_states = torch.cat([norm_encoder_hidden_states, norm_hidden_states], dim=1)
+            ff_output = self.ff(norm_hidden_states)
+            if pab is not None:
+                pab.save_mlp(self.block_idx, ff_output)
 
         hidden_states = hidden_states + gate_ff * ff_output[:, text_seq_length:]
         encoder_hidden_states = encoder_hidden_states + enc_gate_ff * ff_output[:, :text_seq_length]
@@ -515,8 +516,9 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
                     attention_bias=attention_bias,
                     norm_elementwise_affine=norm_elementwise_affine,
                     norm_eps=norm_eps,
+                    block_idx=i,
                 )
-                for _ in range(num_layers)
+                for i in range(num_layers)
             ]
         )
         self.norm_final = nn.LayerNorm(inner_dim, norm_eps, norm_elementwise_affine)
@@ -533,6 +535,11 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
 
         self.gradient_checkpointing = False
 
+        # PABState of the current sampling run, set by the pipeline from its PAB config
+        self.pab_state = None
+        # frames of the context windows denoised by the next calls, set by the pipeline, None for the whole video
+        self.context_window = None
+
     def _set_gradient_checkpointing(self, module, value=False):
         self.gradient_checkpointing = value
 
@@ -626,7 +633,7 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
         hidden_states = hidden_states[:, text_seq_length:]
 
         # 4. Transformer blocks
-        
+        pab = self.pab_state.begin_call(timestep, self.context_window) if self.pab_state is not None else None
         for i, block in enumerate(self.transformer_blocks):
             if self.training and self.gradient_checkpointing:
 
@@ -651,7 +658,7 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
                     encoder_hidden_states=encoder_hidden_states,
                     temb=emb,
                     image_rotary_emb=image_rotary_emb,
-                    timestep=timestep,
+                    pab=pab,
                 )
 
         if not self.config.use_rotary_positional_embeddings:
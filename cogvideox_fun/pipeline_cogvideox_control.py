@@ -24,7 +24,6 @@ from einops import rearrange
 
 from diffusers.callbacks import MultiPipelineCallbacks, PipelineCallback
 from diffusers.models import AutoencoderKLCogVideoX, CogVideoXTransformer3DModel
-from diffusers.models.embeddings import get_3d_rotary_pos_embed
 from diffusers.pipelines.pipeline_utils import DiffusionPipeline
 from diffusers.schedulers import CogVideoXDDIMScheduler, CogVideoXDPMScheduler
 from diffusers.utils import BaseOutput, logging, replace_example_docstring
@@ -35,7 +34,9 @@ from einops import rearrange
 
 from ..videosys.core.pipeline import VideoSysPipeline
 from ..videosys.cogvideox_transformer_3d import CogVideoXTransformer3DModel as CogVideoXTransformer3DModelPAB
-from ..videosys.core.pab_mgr import set_pab_manager
+from ..videosys.core.pab_mgr import pab_state_for
+from ..rotary_cache import get_rotary_emb_cache
+from .context import get_context_scheduler, temporal_tiling, ContextPlan, gather_context_windows, scatter_add_context_windows
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -210,8 +211,8 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
             vae_scale_factor=self.vae_scale_factor, do_normalize=False, do_binarize=True, do_convert_grayscale=True
         )
 
-        if pab_config is not None:
-            set_pab_manager(pab_config)
+        # compiled into a schedule on every run, so pipelines of different models never share PAB state
+        self.pab_config = pab_config
 
     def prepare_latents(
         self, batch_size, num_channels_latents, num_frames, height, width, dtype, device, generator, timesteps, denoise_strength, num_inference_steps,
@@ -349,16 +350,6 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
             extra_step_kwargs["generator"] = generator
         return extra_step_kwargs
     
-    def _gaussian_weights(self, t_tile_length, t_batch_size):
-        from numpy import pi, exp, sqrt
-
-        var = 0.01
-        midpoint = (t_tile_length - 1) / 2  # -1 because index goes from 0 to latent_width - 1
-        t_probs = [exp(-(t-midpoint)*(t-midpoint)/(t_tile_length*t_tile_length)/(2*var)) / sqrt(2*pi*var) for t in range(t_tile_length)]
-        weights = torch.tensor(t_probs)
-        weights = weights.unsqueeze(0).unsqueeze(2).unsqueeze(3).unsqueeze(4).repeat(1, t_batch_size,1, 1, 1)
-        return weights
-
     # Copied from diffusers.pipelines.latte.pipeline_latte.LattePipeline.check_inputs
     def check_inputs(
         self,
@@ -442,12 +433,12 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
         grid_crops_coords = get_resize_crop_region_for_grid(
             (grid_height, grid_width), base_size_width, base_size_height
         )
-        freqs_cos, freqs_sin = get_3d_rotary_pos_embed(
+        freqs_cos, freqs_sin = get_rotary_emb_cache().get(
             embed_dim=self.transformer.config.attention_head_dim,
             crops_coords=grid_crops_coords,
             grid_size=(grid_height, grid_width),
             temporal_size=num_frames,
-            use_real=True,
+            device=device,
         )
         
         if start_frame is not None or context_frames is not None:
@@ -463,8 +454,6 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
             freqs_cos = freqs_cos.view(-1, freqs_cos.shape[-1])
             freqs_sin = freqs_sin.view(-1, freqs_sin.shape[-1])
 
-        freqs_cos = freqs_cos.to(device=device)
-        freqs_sin = freqs_sin.to(device=device)
         return freqs_cos, freqs_sin
 
     @property
@@ -528,6 +517,7 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
         context_stride: Optional[int] = None,
         context_overlap: Optional[int] = None,
         freenoise: Optional[bool] = True,
+        context_weighting: Optional[str] = "default",
         tora: Optional[dict] = None,
     ) -> Union[CogVideoX_Fun_PipelineOutput, Tuple]:
         """
@@ -694,22 +684,41 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
 
         
 
+        if self.pab_config is not None:
+            self.transformer.pab_state = pab_state_for(self.pab_config, timesteps, self.transformer)
+        self.transformer.context_window = None
+
         # 8. Denoising loop
         num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
 
         # 8.5. Temporal tiling prep
-        if context_schedule is not None and context_schedule == "temporal_tiling":
+        if context_schedule is not None and context_schedule == "temporal_tiling" and isinstance(self.scheduler, CogVideoXDDIMScheduler):
             t_tile_length = context_frames
             t_tile_overlap = context_overlap
-            t_tile_weights = self._gaussian_weights(t_tile_length=t_tile_length, t_batch_size=1).to(latents.device).to(self.vae.dtype)
+            context_plan = ContextPlan(
+                temporal_tiling, len(timesteps), latents.shape[1], t_tile_length, context_stride, t_tile_overlap,
+                weight_profile="gaussian" if context_weighting == "default" else context_weighting, device=latents.device
+                )
             use_temporal_tiling = True
+            use_context_schedule = False
             print("Temporal tiling enabled")
         elif context_schedule is not None:
-            print(f"Context schedule enabled: {context_frames} frames, {context_stride} stride, {context_overlap} overlap")
             use_temporal_tiling = False
             use_context_schedule = True
-            from .context import get_context_scheduler
             context = get_context_scheduler(context_schedule)
+            if context_schedule == "temporal_tiling":
+                # multistep schedulers keep state between steps, so instead of stepping every tile separately
+                # the tile noise predictions are blended into one full length prediction and stepped once
+                print(f"Temporal tiling enabled with blended noise predictions for {self.scheduler.__class__.__name__}")
+                weight_profile = "gaussian" if context_weighting == "default" else context_weighting
+            else:
+                print(f"Context schedule enabled: {context_frames} frames, {context_stride} stride, {context_overlap} overlap")
+                weight_profile = "flat" if context_weighting == "default" else context_weighting
+            # all windows of the run as index tensors with their per-frame overlap counts
+            context_plan = ContextPlan(
+                context, len(timesteps), latents.shape[1], context_frames, context_stride, context_overlap,
+                weight_profile=weight_profile, device=latents.device
+                )
 
         else:
             use_temporal_tiling = False
@@ -739,33 +748,18 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
                 if use_temporal_tiling and isinstance(self.scheduler, CogVideoXDDIMScheduler):
                     #temporal tiling code based on https://github.com/mayuelala/FollowYourEmoji/blob/main/models/video_pipeline.py
                     # =====================================================
-                    grid_ts = 0
-                    cur_t = 0
-                    while cur_t < latents.shape[1]:
-                        cur_t = max(grid_ts * t_tile_length - t_tile_overlap * grid_ts, 0) + t_tile_length
-                        grid_ts += 1
-
-                    all_t = latents.shape[1]
-                    latents_all_list = []
-                    # =====================================================
+                    latents_all = torch.zeros(latents.shape, device=latents.device, dtype=torch.float32)
 
                     image_rotary_emb = (
-                            self._prepare_rotary_positional_embeddings(height, width, context_frames, device)
+                            self._prepare_rotary_positional_embeddings(height, width, t_tile_length, device)
                             if self.transformer.config.use_rotary_positional_embeddings
                             else None
                         )
 
-                    for t_i in range(grid_ts):
-                        if t_i < grid_ts - 1:
-                            ofs_t = max(t_i * t_tile_length - t_tile_overlap * t_i, 0)
-                        if t_i == grid_ts - 1:
-                            ofs_t = all_t - t_tile_length
-
-                        input_start_t = ofs_t
-                        input_end_t = ofs_t + t_tile_length
-
-                        latents_tile = latents[:, input_start_t:input_end_t,:, :, :]
-                        control_latents_tile = control_latents[:, input_start_t:input_end_t, :, :, :]
+                    for window_start, window_idx in context_plan.batches(i):
+                        self.transformer.context_window = context_plan.frames(i, window_start)
+                        latents_tile = gather_context_windows(latents, window_idx)
+                        control_latents_tile = gather_context_windows(control_latents, window_idx)
 
                         latent_model_input_tile = torch.cat([latents_tile] * 2) if do_classifier_free_guidance else latents_tile
                         latent_model_input_tile = self.scheduler.scale_model_input(latent_model_input_tile, t)
@@ -790,27 +784,11 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
 
                         # compute the previous noisy sample x_t -> x_t-1
                         latents_tile = self.scheduler.step(noise_pred, t, latents_tile.to(self.vae.dtype), **extra_step_kwargs, return_dict=False)[0]
-                        latents_all_list.append(latents_tile)
+                        # add the weighted tile contribution to overall latents
+                        scatter_add_context_windows(latents_all, latents_tile, window_idx, context_plan.weights(i))
 
                     # ==========================================
-                    latents_all = torch.zeros(latents.shape, device=latents.device, dtype=self.vae.dtype)
-                    contributors = torch.zeros(latents.shape, device=latents.device, dtype=self.vae.dtype)
-                    # Add each tile contribution to overall latents
-                    for t_i in range(grid_ts):
-                        if t_i < grid_ts - 1:
-                            ofs_t = max(t_i * t_tile_length - t_tile_overlap * t_i, 0)
-                        if t_i == grid_ts - 1:
-                            ofs_t = all_t - t_tile_length
-
-                        input_start_t = ofs_t
-                        input_end_t = ofs_t + t_tile_length
-
-                        latents_all[:, input_start_t:input_end_t,:, :, :] += latents_all_list[t_i] * t_tile_weights
-                        contributors[:, input_start_t:input_end_t,:, :, :] += t_tile_weights
-                    
-                    latents_all /= contributors
-
-                    latents = latents_all                    
+                    latents = (latents_all / context_plan.counts(i).view(1, -1, 1, 1, 1)).to(self.vae.dtype)
                     
                     if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
                         progress_bar.update()
@@ -831,11 +809,7 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
                     # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
                     timestep = t.expand(latent_model_input.shape[0])
 
-                    context_queue = list(context(
-                        i, num_inference_steps, latents.shape[1], context_frames, context_stride, context_overlap,
-                    ))
-                    counter = torch.zeros_like(latent_model_input)
-                    noise_pred = torch.zeros_like(latent_model_input)
+                    noise_pred = torch.zeros(latent_model_input.shape, device=latent_model_input.device, dtype=torch.float32)
 
                     image_rotary_emb = (
                             self._prepare_rotary_positional_embeddings(height, width, context_frames, device)
@@ -843,24 +817,23 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
                             else None
                         )
 
-                    for c in context_queue:
-                        partial_latent_model_input = latent_model_input[:, c, :, :, :]
-                        partial_control_latents = current_control_latents[:, c, :, :, :]
+                    for window_start, window_idx in context_plan.batches(i):
+                        self.transformer.context_window = context_plan.frames(i, window_start)
+                        c = window_idx[0]
+                        partial_latent_model_input = latent_model_input.index_select(1, c)
+                        partial_control_latents = current_control_latents.index_select(1, c)
 
                         # predict noise model_output
-                        noise_pred[:, c, :, :, :] += self.transformer(
+                        scatter_add_context_windows(noise_pred, self.transformer(
                             hidden_states=partial_latent_model_input,
                             encoder_hidden_states=prompt_embeds,
                             timestep=timestep,
                             image_rotary_emb=image_rotary_emb,
                             return_dict=False,
                             control_latents=partial_control_latents,
-                        )[0]
-
-                        counter[:, c, :, :, :] += 1
-                        noise_pred = noise_pred.float()
+                        )[0], window_idx, context_plan.weights(i))
                         
-                    noise_pred /= counter
+                    noise_pred /= context_plan.counts(i).view(1, -1, 1, 1, 1)
                     if do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
                         noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond)
@@ -965,6 +938,13 @@ class CogVideoX_Fun_Pipeline_Control(VideoSysPipeline):
         # else:
         #     video = latents
 
+        self.transformer.context_window = None
+        if self.pab_config is not None:
+            pab_state = self.transformer.pab_state
+            if pab_state is not None and pab_state.evicted:
+                logger.warning(f"PAB dropped {pab_state.evicted} stored MLP outputs before their broadcast, raise mlp_cache_slots or set it to 0")
+            self.transformer.pab_state = None
+
         # Offload all models
         self.maybe_free_model_hooks()
 
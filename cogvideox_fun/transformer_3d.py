@@ -31,6 +31,7 @@ from diffusers.models.embeddings import TimestepEmbedding, Timesteps, get_3d_sin
 from diffusers.models.modeling_outputs import Transformer2DModelOutput
 from diffusers.models.modeling_utils import ModelMixin
 from diffusers.models.normalization import AdaLayerNorm, CogVideoXLayerNormZero
+from ..fastercache import FasterCachePolicy, FasterCacheState
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
@@ -336,8 +337,8 @@ class CogVideoXBlock(nn.Module):
         video_flow_feature: Optional[torch.Tensor] = None,
         fuser=None,
         fastercache_counter=0,
-        fastercache_start_step=15,
-        fastercache_device="cuda:0",
+        fastercache=None,
+        block_index=0,
     ) -> torch.Tensor:
         text_seq_length = encoder_hidden_states.size(1)
 
@@ -355,29 +356,19 @@ class CogVideoXBlock(nn.Module):
             del h, fuser      
         #fastercache
         B = norm_hidden_states.shape[0]
-        if fastercache_counter >= fastercache_start_step + 3 and fastercache_counter%3!=0 and self.cached_hidden_states[-1].shape[0] >= B:
-            attn_hidden_states = (
-                self.cached_hidden_states[1][:B] + 
-                (self.cached_hidden_states[1][:B] - self.cached_hidden_states[0][:B]) 
-                * 0.3
-                ).to(norm_hidden_states.device, non_blocking=True)
-            attn_encoder_hidden_states = (
-                self.cached_encoder_hidden_states[1][:B] + 
-                (self.cached_encoder_hidden_states[1][:B] - self.cached_encoder_hidden_states[0][:B])
-                 * 0.3
-                ).to(norm_hidden_states.device, non_blocking=True)
+        cached_attn = None
+        if fastercache is not None and fastercache.policy.reuse_block(fastercache_counter, block_index):
+            cached_attn = fastercache.predict(block_index, B, norm_hidden_states.device)
+        if cached_attn is not None:
+            attn_hidden_states, attn_encoder_hidden_states = cached_attn
         else:
             attn_hidden_states, attn_encoder_hidden_states = self.attn1(
                 hidden_states=norm_hidden_states,
                 encoder_hidden_states=norm_encoder_hidden_states,
                 image_rotary_emb=image_rotary_emb,
             )
-            if fastercache_counter == fastercache_start_step:
-                self.cached_hidden_states = [attn_hidden_states.to(fastercache_device), attn_hidden_states.to(fastercache_device)]
-                self.cached_encoder_hidden_states = [attn_encoder_hidden_states.to(fastercache_device), attn_encoder_hidden_states.to(fastercache_device)]
-            elif fastercache_counter > fastercache_start_step:
-                self.cached_hidden_states[-1].copy_(attn_hidden_states.to(fastercache_device))
-                self.cached_encoder_hidden_states[-1].copy_(attn_encoder_hidden_states.to(fastercache_device))
+            if fastercache is not None and fastercache.policy.caches_block(fastercache_counter, block_index):
+                fastercache.update(block_index, fastercache_counter, attn_hidden_states, attn_encoder_hidden_states)
 
         hidden_states = hidden_states + gate_msa * attn_hidden_states
         encoder_hidden_states = encoder_hidden_states + enc_gate_msa * attn_encoder_hidden_states
@@ -550,10 +541,10 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
 
         self.use_fastercache = False
         self.fastercache_counter = 0
-        self.fastercache_start_step = 15
-        self.fastercache_lf_step = 40
-        self.fastercache_hf_step = 30
-        self.fastercache_device = "cuda"
+        self.fastercache_policy = FasterCachePolicy()
+        self.fastercache_state = None
+        # frames of the context windows denoised by the next calls, set by the pipeline, None for the whole video
+        self.context_window = None
 
     def _set_gradient_checkpointing(self, module, value=False):
         self.gradient_checkpointing = value
@@ -708,9 +699,17 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
         encoder_hidden_states = hidden_states[:, :text_seq_length]
         hidden_states = hidden_states[:, text_seq_length:]
 
+        # the counter advances once per denoising step, the state of every context window is kept apart
+        fastercache = None
         if self.use_fastercache:
-            self.fastercache_counter+=1
-        if self.fastercache_counter >= self.fastercache_start_step + 3 and self.fastercache_counter % 5 !=0:
+            if self.fastercache_state is None or self.fastercache_state.policy is not self.fastercache_policy:
+                self.fastercache_state = FasterCacheState(self.fastercache_policy)
+            elif self.fastercache_counter == 0:
+                self.fastercache_state.clear()
+            fastercache = self.fastercache_state.begin_call(timestep, self.context_window)
+            self.fastercache_counter = self.fastercache_state.counter
+        policy = self.fastercache_policy
+        if fastercache is not None and fastercache.reuse_model(self.fastercache_counter):
             # 4. Transformer blocks
             for i, block in enumerate(self.transformer_blocks):
                 hidden_states, encoder_hidden_states = block(
@@ -721,7 +720,8 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
                     video_flow_feature=video_flow_features[i][:1] if video_flow_features is not None else None,
                     fuser = self.fuser_list[i] if self.fuser_list is not None else None,
                     fastercache_counter = self.fastercache_counter,
-                    fastercache_device = self.fastercache_device
+                    fastercache = fastercache,
+                    block_index = i,
                 )
 
             if not self.config.use_rotary_positional_embeddings:
@@ -747,13 +747,13 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
             lf_c, hf_c = fft(cond.float())
             #lf_step = 40
             #hf_step = 30
-            if self.fastercache_counter <= self.fastercache_lf_step:
-                self.delta_lf = self.delta_lf * 1.1
-            if self.fastercache_counter >= self.fastercache_hf_step:
-                self.delta_hf = self.delta_hf * 1.1
+            if self.fastercache_counter <= policy.lf_step:
+                fastercache.delta_lf = fastercache.delta_lf * 1.1
+            if self.fastercache_counter >= policy.hf_step:
+                fastercache.delta_hf = fastercache.delta_hf * 1.1
    
-            new_hf_uc = self.delta_hf + hf_c
-            new_lf_uc = self.delta_lf + lf_c
+            new_hf_uc = fastercache.delta_hf + hf_c
+            new_lf_uc = fastercache.delta_lf + lf_c
 
             combine_uc = new_lf_uc + new_hf_uc
             combined_fft = torch.fft.ifftshift(combine_uc)
@@ -771,7 +771,8 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
                     video_flow_feature=video_flow_features[i] if video_flow_features is not None else None,
                     fuser = self.fuser_list[i] if self.fuser_list is not None else None,
                     fastercache_counter = self.fastercache_counter,
-                    fastercache_device = self.fastercache_device
+                    fastercache = fastercache,
+                    block_index = i,
                 )
 
             if not self.config.use_rotary_positional_embeddings:
@@ -792,7 +793,7 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
             output = hidden_states.reshape(batch_size, num_frames, height // p, width // p, channels, p, p)
             output = output.permute(0, 1, 4, 2, 5, 3, 6).flatten(5, 6).flatten(3, 4)
 
-            if self.fastercache_counter >= self.fastercache_start_step + 1: 
+            if fastercache is not None and policy.caches_model(self.fastercache_counter):
                 (bb, tt, cc, hh, ww) = output.shape
                 cond = rearrange(output[0:1].float(), "B T C H W -> (B T) C H W", B=bb//2, C=cc, T=tt, H=hh, W=ww)
                 uncond = rearrange(output[1:2].float(), "B T C H W -> (B T) C H W", B=bb//2, C=cc, T=tt, H=hh, W=ww)
@@ -800,8 +801,8 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
                 lf_c, hf_c = fft(cond)
                 lf_uc, hf_uc = fft(uncond)
 
-                self.delta_lf = lf_uc - lf_c
-                self.delta_hf = hf_uc - hf_c
+                fastercache.delta_lf = lf_uc - lf_c
+                fastercache.delta_hf = hf_uc - hf_c
             
 
         if not return_dict:
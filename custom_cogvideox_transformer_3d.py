@@ -31,6 +31,8 @@ from diffusers.models.embeddings import CogVideoXPatchEmbed, TimestepEmbedding,
 from diffusers.models.modeling_outputs import Transformer2DModelOutput
 from diffusers.models.modeling_utils import ModelMixin
 from diffusers.models.normalization import AdaLayerNorm, CogVideoXLayerNormZero
+from .fastercache import FasterCachePolicy, FasterCacheState
+from .teacache import TeaCacheState
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -288,8 +290,6 @@ class CogVideoXBlock(nn.Module):
             inner_dim=ff_inner_dim,
             bias=ff_bias,
         )
-        self.cached_hidden_states = []
-        self.cached_encoder_hidden_states = []
         
     def forward(
         self,
@@ -300,8 +300,8 @@ class CogVideoXBlock(nn.Module):
         video_flow_feature: Optional[torch.Tensor] = None,
         fuser=None,
         fastercache_counter=0,
-        fastercache_start_step=15,
-        fastercache_device="cuda:0",
+        fastercache=None,
+        block_index=0,
     ) -> torch.Tensor:
         text_seq_length = encoder_hidden_states.size(1)
         # norm & modulate
@@ -319,29 +319,19 @@ class CogVideoXBlock(nn.Module):
         
         #fastercache
         B = norm_hidden_states.shape[0]
-        if fastercache_counter >= fastercache_start_step + 3 and fastercache_counter%3!=0 and self.cached_hidden_states[-1].shape[0] >= B:
-            attn_hidden_states = (
-                self.cached_hidden_states[1][:B] + 
-                (self.cached_hidden_states[1][:B] - self.cached_hidden_states[0][:B]) 
-                * 0.3
-                ).to(norm_hidden_states.device, non_blocking=True)
-            attn_encoder_hidden_states = (
-                self.cached_encoder_hidden_states[1][:B] + 
-                (self.cached_encoder_hidden_states[1][:B] - self.cached_encoder_hidden_states[0][:B])
-                 * 0.3
-                ).to(norm_hidden_states.device, non_blocking=True)
+        cached_attn = None
+        if fastercache is not None and fastercache.policy.reuse_block(fastercache_counter, block_index):
+            cached_attn = fastercache.predict(block_index, B, norm_hidden_states.device)
+        if cached_attn is not None:
+            attn_hidden_states, attn_encoder_hidden_states = cached_attn
         else:
             attn_hidden_states, attn_encoder_hidden_states = self.attn1(
                 hidden_states=norm_hidden_states,
                 encoder_hidden_states=norm_encoder_hidden_states,
                 image_rotary_emb=image_rotary_emb,
             )
-            if fastercache_counter == fastercache_start_step:
-                self.cached_hidden_states = [attn_hidden_states.to(fastercache_device), attn_hidden_states.to(fastercache_device)]
-                self.cached_encoder_hidden_states = [attn_encoder_hidden_states.to(fastercache_device), attn_encoder_hidden_states.to(fastercache_device)]
-            elif fastercache_counter > fastercache_start_step:
-                self.cached_hidden_states[-1].copy_(attn_hidden_states.to(fastercache_device))
-                self.cached_encoder_hidden_states[-1].copy_(attn_encoder_hidden_states.to(fastercache_device))
+            if fastercache is not None and fastercache.policy.caches_block(fastercache_counter, block_index):
+                fastercache.update(block_index, fastercache_counter, attn_hidden_states, attn_encoder_hidden_states)
 
         hidden_states = hidden_states + gate_msa * attn_hidden_states
         encoder_hidden_states = encoder_hidden_states + enc_gate_msa * attn_encoder_hidden_states
@@ -513,10 +503,11 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
         self.fuser_list = None
         self.use_fastercache = False
         self.fastercache_counter = 0
-        self.fastercache_start_step = 15
-        self.fastercache_lf_step = 40
-        self.fastercache_hf_step = 30
-        self.fastercache_device = "cuda"
+        self.fastercache_policy = FasterCachePolicy()
+        self.fastercache_state = None
+        self.teacache_state: Optional[TeaCacheState] = None
+        # frames of the context windows denoised by the next calls, set by the pipeline, None for the whole video
+        self.context_window = None
 
     def _set_gradient_checkpointing(self, module, value=False):
         self.gradient_checkpointing = value
@@ -652,9 +643,26 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
         text_seq_length = encoder_hidden_states.shape[1]
         encoder_hidden_states = hidden_states[:, :text_seq_length]
         hidden_states = hidden_states[:, text_seq_length:]
+        # the counter advances once per denoising step, the state of every context window is kept apart
+        fastercache = None
         if self.use_fastercache:
-            self.fastercache_counter+=1
-        if self.fastercache_counter >= self.fastercache_start_step + 3 and self.fastercache_counter % 5 !=0:
+            if self.fastercache_state is None or self.fastercache_state.policy is not self.fastercache_policy:
+                self.fastercache_state = FasterCacheState(self.fastercache_policy)
+            elif self.fastercache_counter == 0:
+                self.fastercache_state.clear()
+            fastercache = self.fastercache_state.begin_call(timestep, self.context_window)
+            self.fastercache_counter = self.fastercache_state.counter
+        policy = self.fastercache_policy
+
+        # TeaCache, both caches skip work from the same steps so FasterCache takes precedence
+        teacache = None
+        if self.teacache_state is not None and fastercache is None:
+            teacache = self.teacache_state.begin_call(timestep, self.context_window)
+            modulated_input = self.transformer_blocks[0].norm1(hidden_states, encoder_hidden_states, emb)[0]
+            self.teacache_state.decide(teacache, modulated_input)
+            del modulated_input
+
+        if fastercache is not None and fastercache.reuse_model(self.fastercache_counter):
             # 3. Transformer blocks
             for i, block in enumerate(self.transformer_blocks):
                     hidden_states, encoder_hidden_states = block(
@@ -665,7 +673,8 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
                         video_flow_feature=video_flow_features[i][:1] if video_flow_features is not None else None,
                         fuser = self.fuser_list[i] if self.fuser_list is not None else None,
                         fastercache_counter = self.fastercache_counter,
-                        fastercache_device = self.fastercache_device
+                        fastercache = fastercache,
+                        block_index = i,
                     )
 
                     if (controlnet_states is not None) and (i < len(controlnet_states)):
@@ -704,13 +713,13 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
             lf_c, hf_c = fft(cond.float())
             #lf_step = 40
             #hf_step = 30
-            if self.fastercache_counter <= self.fastercache_lf_step:
-                self.delta_lf = self.delta_lf * 1.1
-            if self.fastercache_counter >= self.fastercache_hf_step:
-                self.delta_hf = self.delta_hf * 1.1
+            if self.fastercache_counter <= policy.lf_step:
+                fastercache.delta_lf = fastercache.delta_lf * 1.1
+            if self.fastercache_counter >= policy.hf_step:
+                fastercache.delta_hf = fastercache.delta_hf * 1.1
    
-            new_hf_uc = self.delta_hf + hf_c
-            new_lf_uc = self.delta_lf + lf_c
+            new_hf_uc = fastercache.delta_hf + hf_c
+            new_lf_uc = fastercache.delta_lf + lf_c
 
             combine_uc = new_lf_uc + new_hf_uc
             combined_fft = torch.fft.ifftshift(combine_uc)
@@ -718,27 +727,37 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
             recovered_uncond = rearrange(recovered_uncond.to(output.dtype), "(B T) C H W -> B T C H W", B=bb, C=cc, T=tt, H=hh, W=ww)
             output = torch.cat([output, recovered_uncond])
         else:
-            for i, block in enumerate(self.transformer_blocks):
-                hidden_states, encoder_hidden_states = block(
-                    hidden_states=hidden_states,
-                    encoder_hidden_states=encoder_hidden_states,
-                    temb=emb,
-                    image_rotary_emb=image_rotary_emb,
-                    video_flow_feature=video_flow_features[i] if video_flow_features is not None else None,
-                    fuser = self.fuser_list[i] if self.fuser_list is not None else None,
-                    fastercache_counter = self.fastercache_counter,
-                    fastercache_device = self.fastercache_device
-                )
+            if teacache is not None and teacache.skip:
+                # the text tokens only reach the output through the per token final norm, they can stay as they are
+                hidden_states = teacache.apply_residual(hidden_states)
+            else:
+                blocks_input = hidden_states
+                for i, block in enumerate(self.transformer_blocks):
+                    hidden_states, encoder_hidden_states = block(
+                        hidden_states=hidden_states,
+                        encoder_hidden_states=encoder_hidden_states,
+                        temb=emb,
+                        image_rotary_emb=image_rotary_emb,
+                        video_flow_feature=video_flow_features[i] if video_flow_features is not None else None,
+                        fuser = self.fuser_list[i] if self.fuser_list is not None else None,
+                        fastercache_counter = self.fastercache_counter,
+                        fastercache = fastercache,
+                        block_index = i,
+                    )
+
+                    if (controlnet_states is not None) and (i < len(controlnet_states)):
+                        controlnet_states_block = controlnet_states[i]
+                        controlnet_block_weight = 1.0
+                        if isinstance(controlnet_weights, (list, np.ndarray)) or torch.is_tensor(controlnet_weights):
+                            controlnet_block_weight = controlnet_weights[i]
+                        elif isinstance(controlnet_weights, (float, int)):
+                            controlnet_block_weight = controlnet_weights
+                        
+                        hidden_states = hidden_states + controlnet_states_block * controlnet_block_weight
 
-            if (controlnet_states is not None) and (i < len(controlnet_states)):
-                controlnet_states_block = controlnet_states[i]
-                controlnet_block_weight = 1.0
-                if isinstance(controlnet_weights, (list, np.ndarray)) or torch.is_tensor(controlnet_weights):
-                    controlnet_block_weight = controlnet_weights[i]
-                elif isinstance(controlnet_weights, (float, int)):
-                    controlnet_block_weight = controlnet_weights
-                
-                hidden_states = hidden_states + controlnet_states_block * controlnet_block_weight
+                if teacache is not None:
+                    teacache.store_residual(blocks_input, hidden_states)
+                del blocks_input
                     
             if not self.config.use_rotary_positional_embeddings:
                 # CogVideoX-2B
@@ -761,7 +780,7 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
             output = hidden_states.reshape(batch_size, num_frames, height // p, width // p, -1, p, p)
             output = output.permute(0, 1, 4, 2, 5, 3, 6).flatten(5, 6).flatten(3, 4)
 
-            if self.fastercache_counter >= self.fastercache_start_step + 1: 
+            if fastercache is not None and policy.caches_model(self.fastercache_counter):
                 (bb, tt, cc, hh, ww) = output.shape
                 cond = rearrange(output[0:1].float(), "B T C H W -> (B T) C H W", B=bb//2, C=cc, T=tt, H=hh, W=ww)
                 uncond = rearrange(output[1:2].float(), "B T C H W -> (B T) C H W", B=bb//2, C=cc, T=tt, H=hh, W=ww)
@@ -769,8 +788,8 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
                 lf_c, hf_c = fft(cond)
                 lf_uc, hf_uc = fft(uncond)
 
-                self.delta_lf = lf_uc - lf_c
-                self.delta_hf = hf_uc - hf_c
+                fastercache.delta_lf = lf_uc - lf_c
+                fastercache.delta_hf = hf_uc - hf_c
 
         if not return_dict:
             return (output,)
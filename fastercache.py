@@ -0,0 +1,285 @@
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+import torch
+
+# block outputs are extrapolated from the last two computed steps, so reuse can only start once both exist
+WARMUP_STEPS = 3
+
+# weight of the step to step difference when extrapolating a block's attention output
+BLOCK_EXTRAPOLATION = 0.3
+
+DELTA_DTYPES = {
+    "disabled": None,
+    "fp16": torch.float16,
+    "fp8_e4m3fn": torch.float8_e4m3fn,
+}
+
+def parse_block_list(blocks: str) -> Optional[list]:
+    """Parses "0-10, 20, 30-41" into a list of block indices, an empty string selects all blocks (None)"""
+    blocks = blocks.strip()
+    if not blocks:
+        return None
+    indices = []
+    for part in blocks.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            indices.extend(range(int(start), int(end) + 1))
+        else:
+            indices.append(int(part))
+    return sorted(set(indices))
+
+class FasterCachePolicy:
+    """
+    When and where FasterCache reuses work, shared by all the blocks of a transformer.
+
+    From `start_step` on the attention output of the enabled blocks is cached, and `WARMUP_STEPS` later the blocks skip
+    their attention on every step not divisible by `block_cadence`, extrapolating it from the cache instead. On steps
+    not divisible by `model_cadence` the transformer also skips the unconditional pass, rebuilding it from the
+    frequency domain difference of the last full CFG step, boosted until `lf_step` (low frequencies) and from `hf_step`
+    (high frequencies). A cadence of 0 disables that level of reuse.
+
+    The cached attention outputs are the last computed one and its difference to the one before, the difference can
+    be stored in fp16 or fp8 (`delta_dtype`) to save memory. With `max_cache_bytes` the least recently used blocks are
+    moved to `offload_device` once the cache on `cache_device` would grow over the budget.
+    """
+    def __init__(
+        self,
+        start_step: int = 15,
+        lf_step: int = 40,
+        hf_step: int = 30,
+        block_cadence: int = 3,
+        model_cadence: int = 5,
+        blocks: Optional[Iterable[int]] = None,
+        delta_dtype: Optional[torch.dtype] = None,
+        max_cache_bytes: int = 0,
+        cache_device="cuda",
+        offload_device="cpu",
+    ):
+        self.start_step = start_step
+        self.lf_step = lf_step
+        self.hf_step = hf_step
+        self.block_cadence = block_cadence
+        self.model_cadence = model_cadence
+        self.blocks = None if blocks is None else frozenset(blocks)
+        self.delta_dtype = delta_dtype
+        self.max_cache_bytes = max_cache_bytes
+        self.cache_device = cache_device
+        self.offload_device = offload_device
+
+    def __repr__(self):
+        return (f"FasterCachePolicy(start_step={self.start_step}, lf_step={self.lf_step}, hf_step={self.hf_step}, "
+                f"block_cadence={self.block_cadence}, model_cadence={self.model_cadence}, "
+                f"blocks={sorted(self.blocks) if self.blocks is not None else 'all'}, delta_dtype={self.delta_dtype}, "
+                f"max_cache_bytes={self.max_cache_bytes}, cache_device={self.cache_device})")
+
+    def block_enabled(self, block_index: int) -> bool:
+        return self.blocks is None or block_index in self.blocks
+
+    def caches_block(self, counter: int, block_index: int) -> bool:
+        return counter >= self.start_step and self.block_enabled(block_index)
+
+    def reuse_block(self, counter: int, block_index: int) -> bool:
+        return (self.block_cadence > 0 and counter >= self.start_step + WARMUP_STEPS and counter % self.block_cadence != 0
+                and self.block_enabled(block_index))
+
+    def reuse_model(self, counter: int) -> bool:
+        return self.model_cadence > 0 and counter >= self.start_step + WARMUP_STEPS and counter % self.model_cadence != 0
+
+    def caches_model(self, counter: int) -> bool:
+        return counter >= self.start_step + 1
+
+class _CachedTensor:
+    """The last computed tensor and its difference to the previous one, the difference optionally in fp16/fp8"""
+    def __init__(self, tensor: torch.Tensor, device, delta_dtype: Optional[torch.dtype]):
+        self.delta_dtype = delta_dtype
+        self.last = tensor.to(device, copy=True)
+        self.delta = torch.zeros_like(self.last, dtype=delta_dtype or self.last.dtype)
+        self.delta_scale = torch.ones((), device=device, dtype=torch.float32)
+
+    def update(self, tensor: torch.Tensor):
+        delta = tensor.to(self.last.device) - self.last
+        if self.delta_dtype in (torch.float8_e4m3fn, torch.float8_e5m2):
+            # per tensor scale, fp8 casts don't saturate
+            fp8_max = torch.finfo(self.delta_dtype).max
+            self.delta_scale.copy_((delta.abs().amax().float() / fp8_max).clamp_(min=torch.finfo(torch.float32).tiny))
+            self.delta.copy_((delta / self.delta_scale.to(delta.dtype)).clamp_(-fp8_max, fp8_max))
+        else:
+            self.delta.copy_(delta)
+        self.last.copy_(tensor)
+
+    def predict(self, batch_size: int, device, weight: float) -> torch.Tensor:
+        last = self.last[:batch_size]
+        delta = self.delta[:batch_size].to(last.dtype)
+        if self.delta_dtype in (torch.float8_e4m3fn, torch.float8_e5m2):
+            delta = delta * self.delta_scale.to(last.dtype)
+        return (last + delta * weight).to(device, non_blocking=True)
+
+    def to(self, device):
+        self.last = self.last.to(device)
+        self.delta = self.delta.to(device)
+        self.delta_scale = self.delta_scale.to(device)
+        return self
+
+    @property
+    def device(self):
+        return self.last.device
+
+    @property
+    def nbytes(self) -> int:
+        return self.last.numel() * self.last.element_size() + self.delta.numel() * self.delta.element_size()
+
+class FasterCacheStore:
+    """
+    Attention output cache of one sampling run, keyed by (window id, block index), filled and read by the transformer
+    blocks through the policy's schedule. Keeps track of the bytes held on the cache device and spills the least
+    recently used blocks to the offload device when a new block would exceed the budget. Blocks are only moved when
+    created, in place updates keep them where they are, so the cyclic block order of the steps never makes them bounce
+    between devices.
+    """
+    def __init__(self, policy: FasterCachePolicy):
+        self.policy = policy
+        self._entries = OrderedDict()
+        self.spilled = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def _resident_bytes(self) -> int:
+        device = torch.device(self.policy.cache_device)
+        return sum(
+            cached.nbytes
+            for entry in self._entries.values() for cached in entry
+            if cached.device == device or (device.index is None and cached.device.type == device.type)
+        )
+
+    def _enforce_budget(self):
+        policy = self.policy
+        if policy.max_cache_bytes <= 0 or torch.device(policy.cache_device) == torch.device(policy.offload_device):
+            return
+        offload_device = torch.device(policy.offload_device)
+        resident_bytes = self._resident_bytes()
+        for entry in list(self._entries.values()):
+            if resident_bytes <= policy.max_cache_bytes:
+                break
+            if entry[0].device == offload_device:
+                continue
+            nbytes = sum(cached.nbytes for cached in entry)
+            for cached in entry:
+                cached.to(offload_device)
+            resident_bytes -= nbytes
+            self.spilled += 1
+
+    def update(self, key, counter: int, hidden_states: torch.Tensor, encoder_hidden_states: torch.Tensor):
+        """Records the attention outputs computed at `counter` for the block"""
+        entry = self._entries.get(key)
+        if entry is None or counter == self.policy.start_step or entry[0].last.shape != hidden_states.shape:
+            delta_dtype = self.policy.delta_dtype
+            self._entries[key] = (
+                _CachedTensor(hidden_states, self.policy.cache_device, delta_dtype),
+                _CachedTensor(encoder_hidden_states, self.policy.cache_device, delta_dtype),
+            )
+            self._enforce_budget()
+        else:
+            entry[0].update(hidden_states)
+            entry[1].update(encoder_hidden_states)
+        self._entries.move_to_end(key)
+
+    def predict(self, key, batch_size: int, device):
+        """Extrapolated attention outputs of the block, None when the cache can't serve this batch"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0].last.shape[0] < batch_size:
+            return None
+        self._entries.move_to_end(key)
+        return (
+            entry[0].predict(batch_size, device, BLOCK_EXTRAPOLATION),
+            entry[1].predict(batch_size, device, BLOCK_EXTRAPOLATION),
+        )
+
+    def discard(self, window_id):
+        """Drops the blocks of a window"""
+        for key in [key for key in self._entries if key[0] == window_id]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+        self.spilled = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": sum(cached.nbytes for entry in self._entries.values() for cached in entry),
+            "resident_bytes": self._resident_bytes(),
+            "spilled": self.spilled,
+        }
+
+class FasterCacheWindow:
+    """FasterCache state of one context window, or of the whole video: its blocks in the shared store and its CFG deltas"""
+    def __init__(self, store: FasterCacheStore, window_id: int):
+        self.store = store
+        self.policy = store.policy
+        self.window_id = window_id
+        self.delta_lf = None
+        self.delta_hf = None
+
+    def reuse_model(self, counter: int) -> bool:
+        # windows a schedule only adds late in the run have no deltas to rebuild the unconditional pass from yet
+        return self.policy.reuse_model(counter) and self.delta_lf is not None
+
+    def update(self, block_index: int, counter: int, hidden_states: torch.Tensor, encoder_hidden_states: torch.Tensor):
+        self.store.update((self.window_id, block_index), counter, hidden_states, encoder_hidden_states)
+
+    def predict(self, block_index: int, batch_size: int, device):
+        return self.store.predict((self.window_id, block_index), batch_size, device)
+
+class FasterCacheState:
+    """
+    FasterCache state of a sampling run. The step counter advances when the timestep changes, so all the forward calls
+    of a context scheduled or temporally tiled step count as one step. Each call gets its own window state, keyed by
+    the frames it denoises (`frames`, from the pipeline's ContextPlan, None for the whole video) and by how many calls
+    on the same frames came before it in the step, e.g. the halves of sequential CFG. The shifting context schedules
+    move the windows from step to step, so a window only reuses what was computed on its own frames, and the windows
+    a step doesn't visit are dropped.
+    """
+    def __init__(self, policy: FasterCachePolicy):
+        self.policy = policy
+        self.store = FasterCacheStore(policy)
+        self.windows = {}
+        self.counter = 0
+        self._timestep = None
+        self._step_calls = {}
+
+    def begin_call(self, timestep, frames=None) -> FasterCacheWindow:
+        timestep = float(timestep.flatten()[0]) if torch.is_tensor(timestep) else float(timestep)
+        if self.counter == 0 or timestep != self._timestep:
+            self._end_step()
+            self.counter += 1
+        self._timestep = timestep
+        call = self._step_calls.get(frames, 0)
+        self._step_calls[frames] = call + 1
+        window_id = (frames, call)
+        window = self.windows.get(window_id)
+        if window is None:
+            window = self.windows[window_id] = FasterCacheWindow(self.store, window_id)
+        return window
+
+    def _end_step(self):
+        if self._step_calls:
+            visited = {(frames, call) for frames, calls in self._step_calls.items() for call in range(calls)}
+            for window_id in [window_id for window_id in self.windows if window_id not in visited]:
+                del self.windows[window_id]
+                self.store.discard(window_id)
+        self._step_calls = {}
+
+    def clear(self):
+        self.store.clear()
+        self.windows.clear()
+        self.counter = 0
+        self._timestep = None
+        self._step_calls = {}
+
+    def stats(self) -> dict:
+        return {"steps": self.counter, "windows": len(self.windows), **self.store.stats()}
@@ -2,44 +2,195 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-def fp8_linear_forward(cls, original_dtype, input):
-    weight_dtype = cls.weight.dtype
-    if weight_dtype in [torch.float8_e4m3fn, torch.float8_e5m2]:
-        if len(input.shape) == 3:
-            if weight_dtype == torch.float8_e4m3fn:
-                inn = input.reshape(-1, input.shape[2]).to(torch.float8_e5m2)
-            else:
-                inn = input.reshape(-1, input.shape[2]).to(torch.float8_e4m3fn)
-            w = cls.weight.t()
+FP8_DTYPES = [torch.float8_e4m3fn, torch.float8_e5m2]
+
+# number of past input amax values the delayed input scale is taken from
+AMAX_HISTORY_LENGTH = 16
+
+# "tensor" keeps a single weight scale per layer, "row" one per output feature
+FP8_SCALING_GRANULARITIES = ["tensor", "row"]
+
+_unit_scales = {}
+
+def _unit_scale(device):
+    scale = _unit_scales.get(device)
+    if scale is None:
+        scale = torch.ones((1), device=device, dtype=torch.float32)
+        _unit_scales[device] = scale
+    return scale
+
+def fp8_weight_scale(weight, granularity="tensor", fp8_dtype=torch.float8_e4m3fn):
+    """Scale mapping the weight's absolute max, of the whole tensor or of each output row, to the fp8 max"""
+    fp8_max = torch.finfo(fp8_dtype).max
+    w = weight.detach().float().abs()
+    if granularity == "tensor":
+        amax = w.amax().reshape(1)
+    elif granularity == "row":
+        amax = w.amax(dim=1)
+    else:
+        raise ValueError(f"Unknown fp8 scaling granularity {granularity}")
+    return (amax / fp8_max).clamp(min=torch.finfo(torch.float32).tiny)
+
+def quantize_fp8_weight(module, granularity="tensor", fp8_dtype=torch.float8_e4m3fn):
+    """
+    Casts a linear layer's weight to fp8 with a calibrated scale, stored on the module as `scale_weight`.
+    The weight has to be in a higher precision, casting an already fp8 weight would just rescale its rounding error.
+    """
+    weight = module.weight.data
+    fp8_max = torch.finfo(fp8_dtype).max
+    scale = fp8_weight_scale(weight, granularity, fp8_dtype)
+    w = weight.float() / (scale if granularity == "tensor" else scale.unsqueeze(1))
+    module.weight.data = w.clamp_(-fp8_max, fp8_max).to(fp8_dtype)
+    module.register_buffer("scale_weight", scale, persistent=False)
+    module.fp8_scaling = granularity
+    module.register_buffer("amax_history", torch.zeros(AMAX_HISTORY_LENGTH, device=weight.device, dtype=torch.float32), persistent=False)
+    module.register_buffer("scale_input", torch.ones((1), device=weight.device, dtype=torch.float32), persistent=False)
+    module.amax_history_steps = 0
+
+def update_input_scale(module, x, fp8_dtype=torch.float8_e4m3fn):
+    """
+    Delayed scaling: the input is scaled with the largest amax of the previous calls, so the scale never needs a host
+    sync, then the current amax is pushed into the history. The very first call uses its own amax.
+    """
+    fp8_max = torch.finfo(fp8_dtype).max
+    history = module.amax_history
+    amax = x.detach().abs().amax().float()
+    if module.amax_history_steps == 0:
+        history[0] = amax
+    module.scale_input.copy_((history.amax() / fp8_max).clamp_(min=torch.finfo(torch.float32).tiny))
+    history[module.amax_history_steps % history.shape[0]] = amax
+    module.amax_history_steps += 1
+    return module.scale_input
+
+def quantize_fp8_input(x, scale_input, fp8_dtype=torch.float8_e4m3fn):
+    # values above the delayed scale's range saturate instead of overflowing to nan
+    fp8_max = torch.finfo(fp8_dtype).max
+    return (x / scale_input.to(x.dtype)).clamp_(-fp8_max, fp8_max).to(fp8_dtype)
+
+def fp8_scaled_mm_reference(inn, weight, scale_input, scale_weight, bias=None, out_dtype=torch.float16):
+    """
+    Reference for `torch._scaled_mm` on fp8 operands: computes in fp32 on the fp8 rounded values, so the numerics of
+    the scaled fp8 path can be checked on CPU. Only matches the CUDA path where that keeps the unscaled product in
+    fp32 as well, like the row wise scaling does.
+    """
+    out = inn.float() @ weight.float().t()
+    out = out * scale_input.float() * scale_weight.float()
+    if bias is not None:
+        out = out + bias.float()
+    return out.to(out_dtype)
+
+def _pad_dim(tensor, dim, multiple=16):
+    pad = -tensor.shape[dim] % multiple
+    if pad == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] += pad
+    # built with new_zeros and a copy, F.pad has no fp8 kernels
+    padded = tensor.new_zeros(shape)
+    padded.narrow(dim, 0, tensor.shape[dim]).copy_(tensor)
+    return padded
+
+class FP8Linear(nn.Linear):
+    """
+    Linear layer with fp8 weights computed with `torch._scaled_mm`, keeps the nn.Linear parameters and state dict keys.
+    Inputs of any shape are flattened to 2D and the in/out features padded to the multiples of 16 _scaled_mm needs,
+    the weight is never cast in place, layers that can't use _scaled_mm work on a temporary upcast copy instead.
+    Padded copies of the weight and bias are kept in non persistent buffers, rebuilt when those are replaced or
+    modified in place, so only the input is padded per call.
+    """
+    def __init__(self, in_features, out_features, bias=True, original_dtype=torch.float16, device=None, dtype=None):
+        super().__init__(in_features, out_features, bias=bias, device=device, dtype=dtype)
+        self.original_dtype = original_dtype
+        self.fp8_scaling = None
+        self.register_buffer("padded_weight", None, persistent=False)
+        self.register_buffer("padded_bias", None, persistent=False)
+        self._padded_key = None
 
-            scale_weight = torch.ones((1), device=input.device, dtype=torch.float32)
-            scale_input = scale_weight
+    @classmethod
+    def from_linear(cls, linear, original_dtype):
+        fp8_linear = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, original_dtype=original_dtype, device="meta")
+        fp8_linear.weight = linear.weight
+        fp8_linear.bias = linear.bias
+        for name, buffer in linear.named_buffers(recurse=False):
+            fp8_linear.register_buffer(name, buffer, persistent=name not in linear._non_persistent_buffers_set)
+        fp8_linear.fp8_scaling = getattr(linear, "fp8_scaling", None)
+        fp8_linear.amax_history_steps = getattr(linear, "amax_history_steps", 0)
+        fp8_linear.train(linear.training)
+        return fp8_linear
 
-            bias = cls.bias.to(original_dtype) if cls.bias is not None else None
-            out_dtype = original_dtype
+    def _padded_operands(self, bias):
+        """The weight and the `original_dtype` bias padded for _scaled_mm, the same tensors when no padding is needed"""
+        if self.in_features % 16 == 0 and self.out_features % 16 == 0:
+            return self.weight, bias
+        key = (*((t.data_ptr(), t._version) if t is not None else None for t in (self.weight, self.bias)), self.original_dtype)
+        if key != self._padded_key or self.padded_weight is None:
+            self.padded_weight = _pad_dim(_pad_dim(self.weight.detach(), 1), 0)
+            self.padded_bias = _pad_dim(bias.detach(), 0) if bias is not None else None
+            self._padded_key = key
+        return self.padded_weight, self.padded_bias
 
+    def extra_repr(self):
+        return f"{super().extra_repr()}, original_dtype={self.original_dtype}, fp8_scaling={self.fp8_scaling}"
+
+    def forward(self, input):
+        if self.weight.dtype not in FP8_DTYPES:
+            return super().forward(input)
+        original_dtype = self.original_dtype
+        bias = self.bias.to(original_dtype) if self.bias is not None else None
+        if self.fp8_scaling is None and input.device.type != "cuda":
+            return F.linear(input.to(original_dtype), self.weight.to(original_dtype), bias)
+
+        x = input.reshape(-1, input.shape[-1])
+        if self.fp8_scaling is None:
+            # unscaled weights keep the e4m3 weight/e5m2 input pairing
+            scale_input = scale_weight = _unit_scale(input.device)
+            inn = x.to(torch.float8_e5m2 if self.weight.dtype == torch.float8_e4m3fn else torch.float8_e4m3fn)
+        else:
+            scale_input = update_input_scale(self, x, self.weight.dtype)
+            inn = quantize_fp8_input(x, scale_input, self.weight.dtype)
+            scale_weight = self.scale_weight.float()
+
+        if input.device.type != "cuda":
+            o = fp8_scaled_mm_reference(inn, self.weight, scale_input, scale_weight, bias, original_dtype)
+            return o.reshape((*input.shape[:-1], self.out_features))
+
+        # zero padding leaves the products unchanged, the padded output features are sliced off
+        inn = _pad_dim(inn, 1)
+        weight, padded_bias = self._padded_operands(bias)
+        if self.fp8_scaling == "row":
+            # _scaled_mm only takes row wise scales for both operands together, apply the weight rows to the output instead.
+            # The rows are scaled up to the fp8 max, so the product is only cast once scaled back, fp16 would overflow
+            o = torch._scaled_mm(inn, weight.t(), out_dtype=torch.float32, scale_a=scale_input, scale_b=_unit_scale(input.device))
+            if isinstance(o, tuple):
+                o = o[0]
+            o = o[:, :self.out_features] * scale_weight
+            if bias is not None:
+                o = o + bias.float()
+            o = o.to(original_dtype)
+        else:
             if bias is not None:
-                o = torch._scaled_mm(inn, w, out_dtype=out_dtype, bias=bias, scale_a=scale_input, scale_b=scale_weight)
+                o = torch._scaled_mm(inn, weight.t(), out_dtype=original_dtype, bias=padded_bias, scale_a=scale_input, scale_b=scale_weight)
             else:
-                o = torch._scaled_mm(inn, w, out_dtype=out_dtype, scale_a=scale_input, scale_b=scale_weight)
-
+                o = torch._scaled_mm(inn, weight.t(), out_dtype=original_dtype, scale_a=scale_input, scale_b=scale_weight)
             if isinstance(o, tuple):
                 o = o[0]
+            o = o[:, :self.out_features]
 
-            return o.reshape((-1, input.shape[1], cls.weight.shape[0]))
-        else:
-            cls.to(original_dtype)
-            out = cls.original_forward(input.to(original_dtype))
-            cls.to(original_dtype)
-            return out
-    else:
-        return cls.original_forward(input)
+        return o.reshape((*input.shape[:-1], self.out_features))
 
-def convert_fp8_linear(module, original_dtype):
+def convert_fp8_linear(module, original_dtype, scaling=None, params_to_keep={}):
+    """
+    Replaces the linear layers with FP8Linear. With `scaling` ("tensor" or "row") the linear weights, still in high
+    precision, are cast to fp8 with calibrated weight scales and the inputs use delayed scaling, otherwise the
+    already fp8 weights are used with unit scales.
+    """
     setattr(module, "fp8_matmul_enabled", True)
-    for name, module in module.named_modules():
-        if isinstance(module, nn.Linear):
-            original_forward = module.forward
-            setattr(module, "original_forward", original_forward)
-            setattr(module, "forward", lambda input, m=module: fp8_linear_forward(m, original_dtype, input))
+    linears = [(name, m) for name, m in module.named_modules() if isinstance(m, nn.Linear) and not isinstance(m, FP8Linear)]
+    for name, linear in linears:
+        if scaling is not None and not any(keyword in name for keyword in params_to_keep):
+            quantize_fp8_weight(linear, scaling)
+        parent_name, _, child_name = name.rpartition(".")
+        parent = module.get_submodule(parent_name) if parent_name else module
+        setattr(parent, child_name, FP8Linear.from_linear(linear, original_dtype))
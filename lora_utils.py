@@ -5,19 +5,25 @@
 # https://github.com/bmaltais/kohya_ss
 
 import hashlib
+import json
 import math
 import os
+import threading
+import weakref
 from collections import defaultdict
 from io import BytesIO
 from typing import List, Optional, Type, Union
 
 import safetensors.torch
 import torch
+import torch.nn.functional as F
 import torch.utils.checkpoint
 from diffusers.models.lora import LoRACompatibleConv, LoRACompatibleLinear
 from safetensors.torch import load_file
 from transformers import T5EncoderModel
 
+from .utils import log, remove_specific_blocks
+
 
 class LoRAModule(torch.nn.Module):
     """
@@ -138,6 +144,136 @@ def addnet_hash_safetensors(b):
     return hash_sha256.hexdigest()
 
 
+_file_hashes = {}
+
+def _hash_memo_path(memo_dir):
+    return os.path.join(memo_dir, "hashes.json")
+
+def file_content_hash(path, memo_dir=None):
+    """
+    addnet_hash_safetensors of a safetensors file, so edits of the metadata don't change it, the sha256 of any other
+    file. Memoized by path, size and modification time in memory and, with `memo_dir`, in a hashes.json there, so
+    restarts don't rehash multi GB files.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    entry = _file_hashes.get(path)
+    memo = None
+    if entry is None and memo_dir is not None and os.path.exists(_hash_memo_path(memo_dir)):
+        with open(_hash_memo_path(memo_dir)) as f:
+            memo = json.load(f)
+        entry = memo.get(path)
+    if entry is not None and entry["signature"] == signature:
+        _file_hashes[path] = entry
+        return entry["sha256"]
+
+    with open(path, "rb") as f:
+        if path.endswith(".safetensors"):
+            sha256 = addnet_hash_safetensors(f)
+        else:
+            sha256 = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+            sha256 = sha256.hexdigest()
+        entry = {"signature": signature, "sha256": sha256}
+    _file_hashes[path] = entry
+    if memo_dir is not None:
+        os.makedirs(memo_dir, exist_ok=True)
+        if memo is None and os.path.exists(_hash_memo_path(memo_dir)):
+            with open(_hash_memo_path(memo_dir)) as f:
+                memo = json.load(f)
+        memo = memo or {}
+        memo[path] = entry
+        with open(f"{_hash_memo_path(memo_dir)}.tmp", "w") as f:
+            json.dump(memo, f)
+        os.replace(f"{_hash_memo_path(memo_dir)}.tmp", _hash_memo_path(memo_dir))
+    return entry["sha256"]
+
+def lora_cache_key(base_hashes, loras, extra=(), memo_dir=None):
+    """Key of a LoRA merged model, from the base weights' hashes, the LoRA file hashes and strengths, and any settings"""
+    key = hashlib.sha256()
+    for base_hash in base_hashes:
+        key.update(base_hash.encode())
+    for lora in loras:
+        key.update(f"{file_content_hash(lora['path'], memo_dir)}:{float(lora['strength'])}".encode())
+    for value in extra:
+        key.update(repr(value).encode())
+    return key.hexdigest()[:16]
+
+class LoRAMergeCache:
+    """
+    Disk cache of LoRA merged transformer weights, one safetensors file per lora_cache_key. Files are written by a
+    background thread, so the load that merged them doesn't wait on the disk, and read back whole into memory. Hits
+    touch the file, and once the directory grows over `max_bytes` the least recently used files are deleted.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def __repr__(self):
+        return f"LoRAMergeCache({self.cache_dir}, max_bytes={self.max_bytes})"
+
+    def key(self, base_files, loras, extra=()):
+        return lora_cache_key([file_content_hash(path, self.cache_dir) for path in sorted(base_files)], loras, extra, self.cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.safetensors")
+
+    def load(self, key):
+        """The cached state dict read into CPU memory with load_file, None on a miss"""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return load_file(path)
+
+    def _write(self, key, state_dict, metadata):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            safetensors.torch.save_file(state_dict, tmp_path, metadata)
+            os.replace(tmp_path, path)
+            log.info(f"Cached the LoRA merged weights in {path}")
+        except Exception as e:
+            log.warning(f"Failed to cache the LoRA merged weights: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def save_async(self, key, state_dict, metadata=None):
+        """
+        Writes the state dict in a background thread and returns the thread, the tensors must not change in place
+        until it's done
+        """
+        state_dict = {name: tensor.contiguous() for name, tensor in state_dict.items()}
+        thread = threading.Thread(target=self._write, args=(key, state_dict, metadata), daemon=True)
+        thread.start()
+        return thread
+
+    def evict(self):
+        """Deletes the least recently used files until the cache fits in max_bytes"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".safetensors"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total_bytes = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                # still mapped by another process on Windows
+                continue
+            total_bytes -= size
+            log.info(f"Evicted {name} from the LoRA merge cache")
+
 def precalculate_safetensors_hashes(tensors, metadata):
     """Precalculate the model hashes needed by sd-webui-additional-networks to
     save time on indexing the model later."""
@@ -366,115 +502,380 @@ def create_network(
     )
     return network
 
-def merge_lora(transformer, lora_path, multiplier, device='cpu', dtype=torch.float32, state_dict=None):
-    LORA_PREFIX_TRANSFORMER = "lora_unet"
-    LORA_PREFIX_TEXT_ENCODER = "lora_te"
-    if state_dict is None:
-        state_dict = load_file(lora_path, device=device)
-    else:
-        state_dict = state_dict
-    updates = defaultdict(dict)
+# prefixes of the kohya style (lora_unet_transformer_blocks_0_attn1_to_q) and diffusers style
+# (transformer.transformer_blocks.0.attn1.to_q) LoRA layer names
+LORA_LAYER_PREFIXES = ("lora_unet_", "transformer.")
+
+# keys of the low-rank pairs in both styles, the up/B matrix is (out, rank) and the down/A matrix (rank, in)
+LORA_UP_KEYS = (".lora_up.", ".lora_B.")
+LORA_DOWN_KEYS = (".lora_down.", ".lora_A.")
+
+# fp32 weight bytes moved to the merge device and merged together
+LORA_MERGE_GROUP_BYTES = 512 * 1024**2
+
+_lora_name_indices = weakref.WeakKeyDictionary()
+
+def _lora_name_index(model):
+    """LoRA layer names, with underscores or dots, of every module with a weight or quantized linear, built once per model"""
+    index = _lora_name_indices.get(model)
+    if index is None:
+        index = {}
+        for name, module in model.named_modules():
+            if name and (isinstance(getattr(module, "weight", None), torch.Tensor) or hasattr(module, "in_features")):
+                index[name] = (name, module)
+                index[name.replace(".", "_")] = (name, module)
+        _lora_name_indices[model] = index
+    return index
+
+def _strip_lora_prefix(layer):
+    for prefix in LORA_LAYER_PREFIXES:
+        if layer.startswith(prefix):
+            return layer[len(prefix):]
+    return layer
+
+def _lora_scale(lora, down, alpha):
+    return lora["strength"] * (alpha / down.shape[0] if alpha is not None else 1.0)
+
+def resolve_lora_layer(model, layer):
+    """Module name and module a LoRA layer name targets, (None, None) when the model has no such layer"""
+    layer = _strip_lora_prefix(layer)
+    entry = _lora_name_index(model).get(layer)
+    if entry is None:
+        return None, None
+    name, module = entry
+    try:
+        current = model.get_submodule(name)
+    except AttributeError:
+        current = None
+    if current is not module:
+        # blocks removed or layers replaced since the index was built
+        _lora_name_indices.pop(model, None)
+        entry = _lora_name_index(model).get(layer)
+        return entry if entry is not None else (None, None)
+    return name, module
+
+def lora_pairs(state_dict):
+    """Groups a LoRA state dict into {layer: (up, down, alpha)}, alpha is None when the file has none"""
+    pairs = defaultdict(lambda: [None, None, None])
     for key, value in state_dict.items():
-        layer, elem = key.split('.', 1)
-        updates[layer][elem] = value
-
-    for layer, elems in updates.items():
-
-        # if "lora_te" in layer:
-        #     if transformer_only:
-        #         continue
-        #     else:
-        #         layer_infos = layer.split(LORA_PREFIX_TEXT_ENCODER + "_")[-1].split("_")
-        #         curr_layer = pipeline.text_encoder
-        #else:
-        layer_infos = layer.split(LORA_PREFIX_TRANSFORMER + "_")[-1].split("_")
-        curr_layer = transformer
-
-        temp_name = layer_infos.pop(0)
-        while len(layer_infos) > -1:
-            try:
-                curr_layer = curr_layer.__getattr__(temp_name)
-                if len(layer_infos) > 0:
-                    temp_name = layer_infos.pop(0)
-                elif len(layer_infos) == 0:
-                    break
-            except Exception:
-                if len(layer_infos) == 0:
-                    print('Error loading layer')
-                if len(temp_name) > 0:
-                    temp_name += "_" + layer_infos.pop(0)
-                else:
-                    temp_name = layer_infos.pop(0)
-
-        weight_up = elems['lora_up.weight'].to(dtype)
-        weight_down = elems['lora_down.weight'].to(dtype)
-        if 'alpha' in elems.keys():
-            alpha = elems['alpha'].item() / weight_up.shape[1]
-        else:
-            alpha = 1.0
-
-        curr_layer.weight.data = curr_layer.weight.data.to(device)
-        if len(weight_up.shape) == 4:
-            curr_layer.weight.data += multiplier * alpha * torch.mm(weight_up.squeeze(3).squeeze(2),
-                                                                    weight_down.squeeze(3).squeeze(2)).unsqueeze(
-                2).unsqueeze(3)
-        else:
-            curr_layer.weight.data += multiplier * alpha * torch.mm(weight_up, weight_down)
-
+        if key.endswith(".alpha"):
+            pairs[key[:-len(".alpha")]][2] = value.item()
+            continue
+        for index, markers in ((0, LORA_UP_KEYS), (1, LORA_DOWN_KEYS)):
+            marker = next((marker for marker in markers if marker in key), None)
+            if marker is not None:
+                pairs[key.split(marker)[0]][index] = value
+                break
+    return {layer: tuple(pair) for layer, pair in pairs.items() if pair[0] is not None and pair[1] is not None}
+
+def collect_lora_factors(transformer, loras, layer_index=None):
+    """
+    Resolves the layers of every LoRA once and gathers, per targeted module name, the (up, down, scale) factors of all
+    the LoRAs, the scale being the strength times alpha / rank. `loras` are the CogVideoLoraSelect entries, a
+    "state_dict" entry is used instead of reading "path". A `layer_index` of LoRA layer names to (name, module)
+    replaces the names of the transformer's current modules.
+    """
+    factors = {}
+    for lora in loras:
+        state_dict = lora.get("state_dict")
+        if state_dict is None:
+            state_dict = load_file(lora["path"])
+        missing = 0
+        for layer, (up, down, alpha) in lora_pairs(state_dict).items():
+            if layer_index is not None:
+                name, module = layer_index.get(_strip_lora_prefix(layer), (None, None))
+            else:
+                name, module = resolve_lora_layer(transformer, layer)
+            if module is None:
+                missing += 1
+                continue
+            factors.setdefault(name, (module, []))[1].append((up, down, _lora_scale(lora, down, alpha)))
+        if missing:
+            log.warning(f"LoRA {lora.get('name', lora.get('path'))}: {missing} layers not found in the model, skipped")
+    return factors
+
+def _lora_target_weight(module, device, dtype):
+    """The module's weight in the merge precision, scaled fp8 weights dequantized, flattened to 2D"""
+    weight = module.weight.detach().to(device=device, dtype=dtype)
+    scale_weight = getattr(module, "scale_weight", None)
+    if scale_weight is not None:
+        scale_weight = scale_weight.to(device=device, dtype=dtype)
+        weight = weight * (scale_weight if scale_weight.numel() == 1 else scale_weight.unsqueeze(1))
+    return weight.reshape(weight.shape[0], -1)
+
+def _store_lora_target_weight(module, merged):
+    """Casts a merged weight back to the module's dtype and device, requantizing scaled fp8 weights"""
+    weight = module.weight
+    merged = merged.reshape(weight.shape)
+    if weight.dtype in (torch.float8_e4m3fn, torch.float8_e5m2):
+        from .fp8_optimization import fp8_weight_scale
+        fp8_max = torch.finfo(weight.dtype).max
+        if getattr(module, "scale_weight", None) is not None:
+            granularity = module.fp8_scaling
+            scale = fp8_weight_scale(merged, granularity, weight.dtype)
+            merged = merged / (scale if granularity == "tensor" else scale.unsqueeze(1))
+            module.scale_weight.copy_(scale)
+        # fp8 casts don't saturate
+        merged = merged.clamp(-fp8_max, fp8_max)
+    # through detach the copy bumps the parameter's version, which the padded and dequantized weight caches check
+    weight.detach().copy_(merged)
+
+def _merge_lora_group(group, device, dtype, multiplier):
+    # the factors of all the LoRAs of a layer are concatenated along the rank, so every layer is a single low-rank
+    # product and the layers of the group, sharing their shapes, one batched matmul
+    weights = torch.stack([_lora_target_weight(module, device, dtype) for module, _ in group])
+    ups = torch.stack([
+        torch.cat([up.reshape(up.shape[0], -1).to(device=device, dtype=dtype) * (multiplier * scale) for up, _, scale in layer_factors], dim=1)
+        for _, layer_factors in group
+    ])
+    downs = torch.stack([
+        torch.cat([down.reshape(down.shape[0], -1).to(device=device, dtype=dtype) for _, down, _ in layer_factors], dim=0)
+        for _, layer_factors in group
+    ])
+    weights.baddbmm_(ups, downs)
+    for (module, _), merged in zip(group, weights):
+        _store_lora_target_weight(module, merged)
+
+def apply_lora_factors(factors, device=None, dtype=torch.float32, multiplier=1.0):
+    """
+    Adds the LoRA deltas of `collect_lora_factors`, times `multiplier`, to the weights in place. The merge
+    runs in `dtype` on `device`, the weights' own device when None, in groups of layers with the same weight shape and
+    total rank of at most LORA_MERGE_GROUP_BYTES, then every weight is cast back to its dtype and device.
+    """
+    groups = defaultdict(list)
+    for name, (module, layer_factors) in factors.items():
+        if not isinstance(getattr(module, "weight", None), torch.Tensor):
+            raise ValueError(f"LoRA can't be merged into {name} ({module.__class__.__name__}), it has no weight, use a runtime LoRA")
+        total_rank = sum(down.shape[0] for _, down, _ in layer_factors)
+        merge_device = device if device is not None else module.weight.device
+        groups[(tuple(module.weight.shape), total_rank, torch.device(merge_device))].append((module, layer_factors))
+
+    element_size = torch.empty((), dtype=dtype).element_size()
+    for (shape, _, merge_device), modules in groups.items():
+        group_size = max(1, LORA_MERGE_GROUP_BYTES // (math.prod(shape) * element_size))
+        for i in range(0, len(modules), group_size):
+            _merge_lora_group(modules[i:i + group_size], merge_device, dtype, multiplier)
+
+@torch.no_grad()
+def merge_lora_stack(transformer, loras, device=None, dtype=torch.float32):
+    """Merges a list of CogVideoLoraSelect LoRAs into the transformer weights in one pass over the layers"""
+    apply_lora_factors(collect_lora_factors(transformer, loras), device=device, dtype=dtype)
     return transformer
 
-# TODO: Refactor with merge_lora.
-def unmerge_lora(pipeline, lora_path, multiplier=1, device="cpu", dtype=torch.float32):
-    """Unmerge state_dict in LoRANetwork from the pipeline in diffusers."""
-    LORA_PREFIX_UNET = "lora_unet"
-    LORA_PREFIX_TEXT_ENCODER = "lora_te"
-    state_dict = load_file(lora_path, device=device)
-
-    updates = defaultdict(dict)
-    for key, value in state_dict.items():
-        layer, elem = key.split('.', 1)
-        updates[layer][elem] = value
-
-    for layer, elems in updates.items():
+def merge_lora(transformer, lora_path, multiplier, device=None, dtype=torch.float32, state_dict=None):
+    lora = {"path": lora_path, "strength": multiplier}
+    if state_dict is not None:
+        lora["state_dict"] = state_dict
+    return merge_lora_stack(transformer, [lora], device=device, dtype=dtype)
 
-        if "lora_te" in layer:
-            layer_infos = layer.split(LORA_PREFIX_TEXT_ENCODER + "_")[-1].split("_")
-            curr_layer = pipeline.text_encoder
-        else:
-            layer_infos = layer.split(LORA_PREFIX_UNET + "_")[-1].split("_")
-            curr_layer = pipeline.transformer
+def unmerge_lora(transformer, lora_path, multiplier=1, device=None, dtype=torch.float32, state_dict=None):
+    """Subtracts a LoRA merged with merge_lora, up to the rounding of the weights' dtype"""
+    return merge_lora(transformer, lora_path, -multiplier, device=device, dtype=dtype, state_dict=state_dict)
 
-        temp_name = layer_infos.pop(0)
-        while len(layer_infos) > -1:
-            try:
-                curr_layer = curr_layer.__getattr__(temp_name)
-                if len(layer_infos) > 0:
-                    temp_name = layer_infos.pop(0)
-                elif len(layer_infos) == 0:
-                    break
-            except Exception:
-                if len(layer_infos) == 0:
-                    print('Error loading layer')
-                if len(temp_name) > 0:
-                    temp_name += "_" + layer_infos.pop(0)
-                else:
-                    temp_name = layer_infos.pop(0)
-
-        weight_up = elems['lora_up.weight'].to(dtype)
-        weight_down = elems['lora_down.weight'].to(dtype)
-        if 'alpha' in elems.keys():
-            alpha = elems['alpha'].item() / weight_up.shape[1]
+@torch.no_grad()
+def merge_loras_into_quantized_state_dict(state_dict, loras, device=None):
+    """
+    Merges LoRAs into a GGUF loader state dict in place. Every targeted quantized weight is dequantized to fp32, merged
+    on `device` and packed again in its quant type, plain weights are merged and cast back. Raises before changing
+    anything when a targeted quant type has no quantizer. Returns the number of merged layers.
+    """
+    from .mz_gguf_loader import QUANT_TYPES, quantize_state_dict_qtypes
+    qtypes = quantize_state_dict_qtypes(state_dict)
+    keys = {name: f"{name}.{qtype}_qweight" for name, qtype in qtypes.items()}
+    keys.update({key[:-len(".weight")]: key for key in state_dict if key.endswith(".weight") and state_dict[key].ndim == 2})
+    names = {**{name: name for name in keys}, **{name.replace(".", "_"): name for name in keys}}
+
+    factors = defaultdict(list)
+    for lora in loras:
+        for layer, (up, down, alpha) in lora_pairs(load_file(lora["path"])).items():
+            name = names.get(_strip_lora_prefix(layer))
+            if name is not None:
+                factors[name].append((up, down, _lora_scale(lora, down, alpha)))
+    unsupported = {qtypes[name] for name in factors if name in qtypes and QUANT_TYPES[qtypes[name]].quantize is None}
+    if unsupported:
+        raise ValueError(f"Can't requantize {', '.join(sorted(unsupported))} weights")
+
+    for name, layer_factors in factors.items():
+        key = keys[name]
+        tensor = state_dict[key]
+        merge_device = device if device is not None else tensor.device
+        qtype = QUANT_TYPES[qtypes[name]] if name in qtypes else None
+        weight = qtype.dequantize(tensor.to(merge_device), torch.float32) if qtype else tensor.to(merge_device, torch.float32)
+        for up, down, scale in layer_factors:
+            weight.addmm_(up.reshape(up.shape[0], -1).to(merge_device, torch.float32), down.reshape(down.shape[0], -1).to(merge_device, torch.float32), alpha=scale)
+        if qtype is not None:
+            state_dict[key] = qtype.quantize(weight).to(tensor.device)
         else:
-            alpha = 1.0
+            if tensor.dtype in (torch.float8_e4m3fn, torch.float8_e5m2):
+                weight = weight.clamp(-torch.finfo(tensor.dtype).max, torch.finfo(tensor.dtype).max)
+            state_dict[key] = weight.to(tensor.device, tensor.dtype)
+    return len(factors)
 
-        curr_layer.weight.data = curr_layer.weight.data.to(device)
-        if len(weight_up.shape) == 4:
-            curr_layer.weight.data -= multiplier * alpha * torch.mm(weight_up.squeeze(3).squeeze(2),
-                                                                    weight_down.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
-        else:
-            curr_layer.weight.data -= multiplier * alpha * torch.mm(weight_up, weight_down)
+def _runtime_lora_forward_hook(module, args, output):
+    lora_down = module.lora_down
+    return output + F.linear(F.linear(args[0].to(lora_down.dtype), lora_down), module.lora_up).to(output.dtype)
 
-    return pipeline
+def set_runtime_lora(module, down, up):
+    """
+    Attaches a low-rank pair to a linear layer (nn.Linear, FP8Linear or WQLinear_GGUF), `up @ down @ x` is added to
+    its output on every forward. The pair is kept as non persistent buffers so it follows the layer's device, None
+    detaches it.
+    """
+    handle = getattr(module, "_runtime_lora_handle", None)
+    if down is None:
+        if handle is not None:
+            handle.remove()
+            del module._runtime_lora_handle
+            del module.lora_down, module.lora_up
+        return
+    module.register_buffer("lora_down", down, persistent=False)
+    module.register_buffer("lora_up", up, persistent=False)
+    if handle is None:
+        module._runtime_lora_handle = module.register_forward_hook(_runtime_lora_forward_hook)
+
+def _module_device(module):
+    tensor = next(iter(module.parameters(recurse=False)), None)
+    if tensor is None:
+        tensor = next(iter(module.buffers(recurse=False)))
+    return tensor.device
+
+class LoRAManager:
+    """
+    LoRAs merged into a loaded transformer. The unit strength low-rank factors of every merged LoRA are kept as read
+    from the file, so LoRAs can be added, removed or re-weighted in place by merging the difference of their strength,
+    without reloading the base weights. Every change is computed in fp32 and stored in the weights' dtype, so it
+    rounds bf16/fp16/fp8 weights once more.
+
+    With `runtime_dtype` the LoRAs are never merged, instead the factors of all the LoRAs of a layer, scaled by their
+    strength, are concatenated along the rank into one low-rank pair in that dtype and run next to the layer
+    (set_runtime_lora), so any number of LoRAs costs two small matmuls per layer and changes only rebuild the pairs.
+    This works on fp8 and GGUF quantized layers, the layers have to be final (fp8 converted) before the LoRAs are set.
+    """
+    def __init__(self, transformer, device=None, dtype=torch.float32, runtime_dtype=None):
+        self.transformer = transformer
+        self.device = device
+        self.dtype = dtype
+        self.runtime_dtype = runtime_dtype
+        # path -> {"name", "strength", "factors"}
+        self.loras = {}
+        # module name -> module of the layers with a runtime pair
+        self._runtime_modules = {}
+        # LoRAMergeCache write of the merged weights still in progress
+        self.pending_save = None
+        # LoRA layer names by the original block indices once blocks are removed, None to use the current names
+        self.layer_index = None
+
+    def __repr__(self):
+        loras = ", ".join(f"{lora['name']}: {lora['strength']}" for lora in self.loras.values())
+        return f"LoRAManager({loras})"
+
+    @property
+    def strengths(self) -> dict:
+        return {path: lora["strength"] for path, lora in self.loras.items()}
+
+    def _factors(self, path, name):
+        lora = self.loras.get(path)
+        if lora is None:
+            factors = collect_lora_factors(self.transformer, [{"path": path, "strength": 1.0, "name": name}], self.layer_index)
+            lora = self.loras[path] = {"name": name, "strength": 0.0, "factors": factors}
+        return lora["factors"]
+
+    @torch.no_grad()
+    def _apply_runtime(self):
+        stacks = {}
+        for lora in self.loras.values():
+            for module_name, (module, layer_factors) in lora["factors"].items():
+                stacks.setdefault(module_name, (module, []))[1].extend(
+                    (up, down, scale * lora["strength"]) for up, down, scale in layer_factors
+                )
+        for module_name, module in self._runtime_modules.items():
+            if module_name not in stacks:
+                set_runtime_lora(module, None, None)
+        for module_name, (module, layer_factors) in stacks.items():
+            device = _module_device(module)
+            down = torch.cat([down.reshape(down.shape[0], -1) for _, down, _ in layer_factors], dim=0)
+            up = torch.cat([up.reshape(up.shape[0], -1).float() * scale for up, _, scale in layer_factors], dim=1)
+            set_runtime_lora(module, down.to(device, self.runtime_dtype), up.to(device, self.runtime_dtype))
+        self._runtime_modules = {module_name: module for module_name, (module, _) in stacks.items()}
+
+    @torch.no_grad()
+    def _apply(self, changes):
+        """Applies {path: (name, new strength)} in one pass over the layers, dropping the LoRAs set to 0"""
+        if self.pending_save is not None:
+            self.pending_save.join()
+            self.pending_save = None
+        if self.runtime_dtype is not None:
+            for path, (name, strength) in changes.items():
+                self._factors(path, name)
+                if strength == 0:
+                    del self.loras[path]
+                else:
+                    self.loras[path]["strength"] = strength
+            self._apply_runtime()
+            return
+        combined = {}
+        for path, (name, strength) in changes.items():
+            factors = self._factors(path, name)
+            difference = strength - self.loras[path]["strength"]
+            if difference == 0:
+                continue
+            for module_name, (module, layer_factors) in factors.items():
+                combined.setdefault(module_name, (module, []))[1].extend(
+                    (up, down, scale * difference) for up, down, scale in layer_factors
+                )
+        apply_lora_factors(combined, device=self.device, dtype=self.dtype)
+        for path, (_, strength) in changes.items():
+            if strength == 0:
+                del self.loras[path]
+            else:
+                self.loras[path]["strength"] = strength
+
+    def remove_blocks(self, block_indices):
+        """
+        Removes transformer blocks (block_edit), the LoRAs added later still target the layers by their original block
+        indices like the ones set before, the layers of the removed blocks are skipped
+        """
+        _lora_name_indices.pop(self.transformer, None)
+        index = self.layer_index if self.layer_index is not None else _lora_name_index(self.transformer)
+        self.transformer = remove_specific_blocks(self.transformer, block_indices)
+        kept = {id(module) for module in self.transformer.modules()}
+        self.layer_index = {layer: entry for layer, entry in index.items() if id(entry[1]) in kept}
+        return self.transformer
+
+    def set_merged(self, loras):
+        """Records a CogVideoLoraSelect list as merged, for weights loaded with the LoRAs already in them"""
+        for lora in loras or []:
+            self._factors(lora["path"], lora.get("name"))
+            self.loras[lora["path"]]["strength"] += lora["strength"]
+
+    def add(self, lora):
+        """Merges a CogVideoLoraSelect entry, on top of the strength it already has when it's merged"""
+        current = self.loras.get(lora["path"], {}).get("strength", 0.0)
+        self._apply({lora["path"]: (lora.get("name"), current + lora["strength"])})
+
+    def remove(self, path):
+        if path in self.loras:
+            self._apply({path: (self.loras[path]["name"], 0.0)})
+
+    def reweight(self, path, strength):
+        if path not in self.loras:
+            raise ValueError(f"LoRA {path} is not merged")
+        self._apply({path: (self.loras[path]["name"], strength)})
+
+    def set_loras(self, loras):
+        """Brings the merged LoRAs to a CogVideoLoraSelect list, only merging the ones that changed"""
+        wanted = {}
+        for lora in loras or []:
+            name, strength = wanted.get(lora["path"], (lora.get("name"), 0.0))
+            wanted[lora["path"]] = (name, strength + lora["strength"])
+        changes = {path: (lora["name"], 0.0) for path, lora in self.loras.items() if path not in wanted}
+        changes.update({
+            path: (name, strength) for path, (name, strength) in wanted.items()
+            if strength != self.loras.get(path, {}).get("strength", 0.0)
+        })
+        if changes:
+            self._apply(changes)
+        return changes
 
 def load_lora_into_transformer(lora, transformer):
         from peft import LoraConfig, set_peft_model_state_dict
@@ -1,4 +1,5 @@
 import os
+import weakref
 import torch
 import torch.nn as nn
 import json
@@ -20,7 +21,7 @@ from .cogvideox_fun.pipeline_cogvideox_control import CogVideoX_Fun_Pipeline_Con
 
 from .videosys.cogvideox_transformer_3d import CogVideoXTransformer3DModel as CogVideoXTransformer3DModelPAB
 
-from .utils import check_diffusers_version, remove_specific_blocks, log
+from .utils import check_diffusers_version, log
 from comfy.utils import load_torch_file
 
 script_directory = os.path.dirname(os.path.abspath(__file__))
@@ -53,12 +54,13 @@ class DownloadAndLoadCogVideoModel:
                 "precision": (["fp16", "fp32", "bf16"],
                     {"default": "bf16", "tooltip": "official recommendation is that 2b model should be fp16, 5b model should be bf16"}
                 ),
-                "fp8_transformer": (['disabled', 'enabled', 'fastmode'], {"default": 'disabled', "tooltip": "enabled casts the transformer to torch.float8_e4m3fn, fastmode is only for latest nvidia GPUs and requires torch 2.4.0 and cu124 minimum"}),
+                "fp8_transformer": (['disabled', 'enabled', 'fastmode', 'fastmode_scaled', 'fastmode_scaled_rowwise'], {"default": 'disabled', "tooltip": "enabled casts the transformer to torch.float8_e4m3fn, fastmode is only for latest nvidia GPUs and requires torch 2.4.0 and cu124 minimum. The scaled fastmodes calibrate a per tensor or per row weight scale and scale the inputs from their recent absolute max, more accurate for layers with outliers"}),
                 "compile": (["disabled","onediff","torch"], {"tooltip": "compile the model for faster inference, these are advanced options only available on Linux, see readme for more info"}),
                 "enable_sequential_cpu_offload": ("BOOLEAN", {"default": False, "tooltip": "significantly reducing memory usage and slows down the inference"}),
                 "pab_config": ("PAB_CONFIG", {"default": None}),
                 "block_edit": ("TRANSFORMERBLOCKS", {"default": None}),
                 "lora": ("COGLORA", {"default": None}),
+                "lora_cache_gb": ("INT", {"default": 0, "min": 0, "max": 4096, "step": 1, "tooltip": "Keep up to this many GB of LoRA merged transformers in 'ComfyUI/models/CogVideo/lora_merged', so loading the same model, LoRAs and strengths again skips the merge, 0 disables. Only for the Fun models, the others run the LoRAs unmerged"}),
             }
         }
 
@@ -68,12 +70,25 @@ class DownloadAndLoadCogVideoModel:
     CATEGORY = "CogVideoWrapper"
     DESCRIPTION = "Downloads and loads the selected CogVideo model from Huggingface to 'ComfyUI/models/CogVideo'"
 
-    def loadmodel(self, model, precision, fp8_transformer="disabled", compile="disabled", enable_sequential_cpu_offload=False, pab_config=None, block_edit=None, lora=None):
+    def loadmodel(self, model, precision, fp8_transformer="disabled", compile="disabled", enable_sequential_cpu_offload=False, pab_config=None, block_edit=None, lora=None, lora_cache_gb=0):
         
         check_diffusers_version()
 
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
+
+        # when only the LoRAs changed since the last load, merge the difference into the still loaded transformer
+        load_key = (model, precision, fp8_transformer, compile, enable_sequential_cpu_offload, pab_config,
+                    tuple(block_edit) if block_edit is not None else None)
+        last_load = getattr(self, "last_load", None)
+        if last_load is not None and last_load[0] == load_key:
+            pipe = last_load[1]()
+            if pipe is not None:
+                changes = pipe.lora_manager.set_loras(lora)
+                log.info(f"Reusing the loaded transformer, LoRA changes: {changes if changes else 'none'}")
+                return ({**last_load[2], "pipe": pipe},)
+        self.last_load = None
+
         mm.soft_empty_cache()
 
         dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[precision]
@@ -131,41 +146,82 @@ class DownloadAndLoadCogVideoModel:
         # transformer
         if "Fun" in model:
             if pab_config is not None:
-                transformer = CogVideoXTransformer3DModelFunPAB.from_pretrained(base_path, subfolder="transformer")
+                transformer_cls = CogVideoXTransformer3DModelFunPAB
             else:
-                transformer = CogVideoXTransformer3DModelFun.from_pretrained(base_path, subfolder="transformer")
+                transformer_cls = CogVideoXTransformer3DModelFun
         else:
             if pab_config is not None:
-                transformer = CogVideoXTransformer3DModelPAB.from_pretrained(base_path, subfolder="transformer")
+                transformer_cls = CogVideoXTransformer3DModelPAB
             else:
-                transformer = CogVideoXTransformer3DModel.from_pretrained(base_path, subfolder="transformer")
-        
-        transformer = transformer.to(dtype).to(offload_device)
+                transformer_cls = CogVideoXTransformer3DModel
+
+        # the merged weights are cached as cast for the fp8 mode, before the fp8 linears and the block edit
+        from .lora_utils import LoRAManager, LoRAMergeCache
+        merge_cache = merged_sd = None
+        if "fun" in model.lower() and lora and lora_cache_gb > 0:
+            merge_cache = LoRAMergeCache(os.path.join(folder_paths.models_dir, "CogVideo", "lora_merged"), lora_cache_gb * 1024**3)
+            transformer_dir = os.path.join(base_path, "transformer")
+            merge_key = merge_cache.key(
+                [os.path.join(transformer_dir, f) for f in os.listdir(transformer_dir) if f.endswith((".safetensors", ".bin", ".json"))],
+                lora, (transformer_cls.__module__, precision, fp8_transformer),
+            )
+            merged_sd = merge_cache.load(merge_key)
+
+        if merged_sd is not None:
+            log.info(f"Loading the LoRA merged transformer from {merge_cache.path(merge_key)}")
+            try:
+                from accelerate import init_empty_weights
+            except ImportError:
+                init_empty_weights = nullcontext
+            with init_empty_weights():
+                transformer = transformer_cls.from_config(transformer_cls.load_config(base_path, subfolder="transformer"))
+            # casts the buffers missing from the state dict, the parameters are replaced by the loaded cache tensors
+            transformer.to(dtype).load_state_dict(merged_sd, assign=True)
+            transformer = transformer.to(offload_device)
+        else:
+            transformer = transformer_cls.from_pretrained(base_path, subfolder="transformer")
+            transformer = transformer.to(dtype).to(offload_device)
 
         #LoRAs
-        if lora is not None:
-            from .lora_utils import merge_lora, load_lora_into_transformer
-            if "fun" in model.lower():
-                for l in lora:
-                    log.info(f"Merging LoRA weights from {l['path']} with strength {l['strength']}")
-                    transformer = merge_lora(transformer, l["path"], l["strength"])
+        if "fun" in model.lower():
+            # all the LoRAs are merged together, layer groups at a time on the main device, and can be swapped later
+            lora_manager = LoRAManager(transformer, device=device)
+            if merged_sd is not None:
+                lora_manager.set_merged(lora)
             else:
-                transformer = load_lora_into_transformer(lora, transformer)
-                        
-                
-        if block_edit is not None:
-            transformer = remove_specific_blocks(transformer, block_edit)
-        
+                for l in lora or []:
+                    log.info(f"Merging LoRA weights from {l['path']} with strength {l['strength']}")
+                lora_manager.set_loras(lora)
+        else:
+            # run unmerged next to the linear layers, set once those are final below
+            lora_manager = LoRAManager(transformer, runtime_dtype=dtype)
+
         #fp8
-        if fp8_transformer == "enabled" or fp8_transformer == "fastmode":
+        if fp8_transformer in ["enabled", "fastmode", "fastmode_scaled", "fastmode_scaled_rowwise"]:
+            fp8_scaling = {"fastmode_scaled": "tensor", "fastmode_scaled_rowwise": "row"}.get(fp8_transformer)
+            params_to_keep = {"patch_embed", "lora", "pos_embedding"}
+            # the scaled modes quantize the linear weights from full precision when converting them below
+            linear_weights = {f"{name}.weight" for name, m in transformer.named_modules() if isinstance(m, nn.Linear)} if fp8_scaling else set()
             for name, param in transformer.named_parameters():
-                params_to_keep = {"patch_embed", "lora", "pos_embedding"}
-                if not any(keyword in name for keyword in params_to_keep):
+                if not any(keyword in name for keyword in params_to_keep) and name not in linear_weights:
                     param.data = param.data.to(torch.float8_e4m3fn)
-        
-            if fp8_transformer == "fastmode":
-                from .fp8_optimization import convert_fp8_linear
-                convert_fp8_linear(transformer, dtype)
+
+        if merge_cache is not None and merged_sd is None:
+            metadata = {"loras": json.dumps([{"name": l.get("name"), "strength": l["strength"]} for l in lora])}
+            lora_manager.pending_save = merge_cache.save_async(merge_key, transformer.state_dict(), metadata)
+
+        if fp8_transformer in ["fastmode", "fastmode_scaled", "fastmode_scaled_rowwise"]:
+            from .fp8_optimization import convert_fp8_linear
+            convert_fp8_linear(transformer, dtype, scaling=fp8_scaling, params_to_keep=params_to_keep)
+
+        if lora_manager.runtime_dtype is not None:
+            for l in lora or []:
+                log.info(f"Loading LoRA weights from {l['path']} with strength {l['strength']}")
+            lora_manager.set_loras(lora)
+
+        # the LoRA layers, including the ones swapped in later, are resolved by the original block indices
+        if block_edit is not None:
+            transformer = lora_manager.remove_blocks(block_edit)
 
         with open(scheduler_path) as f:
             scheduler_config = json.load(f)
@@ -217,24 +273,36 @@ class DownloadAndLoadCogVideoModel:
             "model_name": model
         }
 
+        # offloaded or onediff compiled weights can't be changed in place. Only a weak reference is kept, the pipeline
+        # lives as long as ComfyUI caches this node's output
+        pipe.lora_manager = lora_manager
+        if compile != "onediff" and not enable_sequential_cpu_offload:
+            self.last_load = (load_key, weakref.ref(pipe), {k: v for k, v in pipeline.items() if k != "pipe"})
+
         return (pipeline,)
 
 class DownloadAndLoadCogVideoGGUFModel:
+    released_models = [
+        "CogVideoX_5b_GGUF_Q4_0.safetensors",
+        "CogVideoX_5b_I2V_GGUF_Q4_0.safetensors",
+        "CogVideoX_5b_fun_GGUF_Q4_0.safetensors",
+        "CogVideoX_5b_fun_1_1_GGUF_Q4_0.safetensors",
+        "CogVideoX_5b_fun_1_1_Pose_GGUF_Q4_0.safetensors",
+        "CogVideoX_5b_Interpolation_GGUF_Q4_0.safetensors",
+        "CogVideoX_5b_Tora_GGUF_Q4_0.safetensors",
+    ]
+
     @classmethod
     def INPUT_TYPES(s):
+        # also offer the local files, e.g. converted with quantize_gguf.py
+        local_models = [f for f in folder_paths.get_filename_list("diffusion_models") if "GGUF" in f and f.endswith(".safetensors")]
+        download_path = os.path.join(folder_paths.models_dir, 'CogVideo', 'GGUF')
+        if os.path.isdir(download_path):
+            local_models += [f for f in os.listdir(download_path) if "GGUF" in f and f.endswith(".safetensors")]
         return {
             "required": {
                 "model": (
-                    [
-                        "CogVideoX_5b_GGUF_Q4_0.safetensors",
-                        "CogVideoX_5b_I2V_GGUF_Q4_0.safetensors",
-                        "CogVideoX_5b_fun_GGUF_Q4_0.safetensors",
-                        "CogVideoX_5b_fun_1_1_GGUF_Q4_0.safetensors",
-                        "CogVideoX_5b_fun_1_1_Pose_GGUF_Q4_0.safetensors",
-                        "CogVideoX_5b_Interpolation_GGUF_Q4_0.safetensors",
-                        "CogVideoX_5b_Tora_GGUF_Q4_0.safetensors",
-
-                    ],
+                    s.released_models + sorted(set(local_models) - set(s.released_models)),
                 ),
             "vae_precision": (["fp16", "fp32", "bf16"], {"default": "bf16", "tooltip": "VAE dtype"}),
             "fp8_fastmode": ("BOOLEAN", {"default": False, "tooltip": "only supported on 4090 and later GPUs, also requires torch 2.4.0 with cu124 minimum"}),
@@ -245,7 +313,10 @@ class DownloadAndLoadCogVideoGGUFModel:
                 "pab_config": ("PAB_CONFIG", {"default": None}),
                 "block_edit": ("TRANSFORMERBLOCKS", {"default": None}),
                 "compile": (["disabled","torch"], {"tooltip": "compile the model for faster inference, these are advanced options only available on Linux, see readme for more info"}),
-              
+                "dequant_cache_mb": ("INT", {"default": 0, "min": 0, "max": 65536, "step": 64, "tooltip": "Keep up to this many MB of dequantized weights on the device instead of unpacking them on every call, 0 disables"}),
+                "lora": ("COGLORA", {"default": None}),
+                "lora_requantize": ("BOOLEAN", {"default": False, "tooltip": "Merge the LoRAs into the quantized weights and requantize them, cached on disk per model, LoRAs and strengths. Faster sampling than running the LoRAs unmerged, at the cost of a second rounding of the merged weights"}),
+                "lora_cache_gb": ("INT", {"default": 16, "min": 1, "max": 4096, "step": 1, "tooltip": "Disk space of the requantized LoRA merges in 'ComfyUI/models/CogVideo/GGUF/lora_merged', the least recently used ones are deleted beyond it"}),
             }
         }
 
@@ -254,7 +325,7 @@ class DownloadAndLoadCogVideoGGUFModel:
     FUNCTION = "loadmodel"
     CATEGORY = "CogVideoWrapper"
 
-    def loadmodel(self, model, vae_precision, fp8_fastmode, load_device, enable_sequential_cpu_offload, pab_config=None, block_edit=None, compile="disabled"):
+    def loadmodel(self, model, vae_precision, fp8_fastmode, load_device, enable_sequential_cpu_offload, pab_config=None, block_edit=None, compile="disabled", dequant_cache_mb=0, lora=None, lora_requantize=False, lora_cache_gb=16):
 
         check_diffusers_version()
 
@@ -292,12 +363,34 @@ class DownloadAndLoadCogVideoGGUFModel:
         with open(transformer_path) as f:
             transformer_config = json.load(f)
 
-        sd = load_torch_file(gguf_path)
-
         from . import mz_gguf_loader
         import importlib
         importlib.reload(mz_gguf_loader)
 
+        # a cached requantized merge replaces the base file, which is then never read
+        sd = None
+        merge_save = None
+        if lora is not None and lora_requantize:
+            from .lora_utils import LoRAMergeCache, merge_loras_into_quantized_state_dict
+            merge_cache = LoRAMergeCache(os.path.join(download_path, "lora_merged"), lora_cache_gb * 1024**3)
+            merge_key = merge_cache.key([gguf_path], lora)
+            sd = merge_cache.load(merge_key)
+            if sd is not None:
+                log.info(f"Loading the requantized LoRA merge from {merge_cache.path(merge_key)}")
+                lora = None
+            else:
+                sd = load_torch_file(gguf_path)
+                try:
+                    for l in lora:
+                        log.info(f"Merging LoRA weights from {l['path']} with strength {l['strength']} into the quantized weights")
+                    merge_loras_into_quantized_state_dict(sd, lora, device=device)
+                    merge_save = merge_cache.save_async(merge_key, sd)
+                    lora = None
+                except ValueError as e:
+                    log.warning(f"{e}, running the LoRAs unmerged instead")
+        if sd is None:
+            sd = load_torch_file(gguf_path)
+
         with mz_gguf_loader.quantize_lazy_load():
             if "fun" in model:
                 if "Pose" in model:
@@ -330,10 +423,7 @@ class DownloadAndLoadCogVideoGGUFModel:
             else:
                 transformer.to(torch.float8_e4m3fn)
 
-            if block_edit is not None:
-                transformer = remove_specific_blocks(transformer, block_edit)
-
-            transformer = mz_gguf_loader.quantize_load_state_dict(transformer, sd, device="cpu")
+            transformer = mz_gguf_loader.quantize_load_state_dict(transformer, sd, device="cpu", dequant_pool_bytes=dequant_cache_mb * 1024**2)
             if load_device == "offload_device":
                 transformer.to(offload_device)
             else:
@@ -344,6 +434,18 @@ class DownloadAndLoadCogVideoGGUFModel:
            from .fp8_optimization import convert_fp8_linear
            convert_fp8_linear(transformer, vae_dtype)
 
+        # the quantized weights stay packed, the LoRAs run next to them as one low-rank pair per layer
+        from .lora_utils import LoRAManager
+        lora_manager = LoRAManager(transformer, runtime_dtype=vae_dtype)
+        lora_manager.pending_save = merge_save
+        for l in lora or []:
+            log.info(f"Loading LoRA weights from {l['path']} with strength {l['strength']}")
+        lora_manager.set_loras(lora)
+
+        # after loading, the state dict and the LoRAs name the blocks by their original indices
+        if block_edit is not None:
+            transformer = lora_manager.remove_blocks(block_edit)
+
         if compile == "torch":
             # compilation
             for i, block in enumerate(transformer.transformer_blocks):
@@ -394,6 +496,7 @@ class DownloadAndLoadCogVideoGGUFModel:
             "scheduler_config": scheduler_config,
             "model_name": model
         }
+        pipe.lora_manager = lora_manager
 
         return (pipeline,)
 
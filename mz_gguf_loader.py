@@ -3,6 +3,7 @@
 import torch
 import torch.nn as nn
 import gc
+from collections import OrderedDict
 
 
 class quantize_lazy_load():
@@ -18,19 +19,31 @@ class quantize_lazy_load():
         self.device.__exit__(exc_type, exc_value, traceback)
 
 
-def quantize_load_state_dict(model, state_dict, device="cpu"):
-    Q4_0_qkey = []
+def quantize_state_dict_qtypes(state_dict):
+    """Maps the name of every quantized linear to its quant type, from the `.{qtype}_qweight` key suffixes"""
+    qtypes = {}
     for key in state_dict.keys():
-        if key.endswith(".Q4_0_qweight"):
-            Q4_0_qkey.append(key.replace(".Q4_0_qweight", ""))
+        for qtype in QUANT_TYPES:
+            suffix = f".{qtype}_qweight"
+            if key.endswith(suffix):
+                qtypes[key[:-len(suffix)]] = qtype
+                break
+    return qtypes
 
+
+def quantize_load_state_dict(model, state_dict, device="cpu", dequant_pool_bytes=0):
+    qtypes = quantize_state_dict_qtypes(state_dict)
+
+    # shared by all the quantized linears of the model, so the budget covers the whole model
+    dequant_pool = DequantizedWeightPool(dequant_pool_bytes) if dequant_pool_bytes > 0 else None
     for name, module in model.named_modules():
-        if name in Q4_0_qkey:
+        if name in qtypes:
             q_linear = WQLinear_GGUF.from_linear(
                 linear=module,
                 device=device,
-                qtype="Q4_0",
+                qtype=qtypes[name],
             )
+            q_linear.dequant_pool = dequant_pool
             set_op_by_name(model, name, q_linear)
 
     model.to_empty(device=device)
@@ -56,6 +69,71 @@ def set_op_by_name(layer, name, new_module):
 import torch.nn.functional as F
 
 
+class DequantizedWeightPool:
+    """
+    Bounded LRU of dequantized weights, keyed by layer and compute dtype/device.
+    Lets the CFG halves, context windows and the following steps reuse a layer's dequantized weight instead of unpacking
+    it again on every call, at the cost of up to `max_bytes` of extra memory. Entries are dropped when the packed weight
+    is modified in place.
+    The layers are visited in the same order on every pass, and plain LRU eviction would then always drop the weight
+    needed next. An entry is only evicted once it has gone unused for a full pass over the layers, otherwise the new
+    weight is not admitted, so a budget smaller than the model keeps a stable subset of the layers resident.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._layers = set()
+        self._clock = 0
+
+    def get(self, layer, qweight, dtype, dequantize):
+        key = (id(layer), dtype, qweight.device)
+        version = (qweight.data_ptr(), qweight._version)
+        self._clock += 1
+        self._layers.add(key)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._entries[key] = (version, entry[1], self._clock)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        if entry is not None:
+            self._evict(key)
+        weight = dequantize(qweight, dtype)
+        nbytes = weight.numel() * weight.element_size()
+        while self._entries and self.used_bytes + nbytes > self.max_bytes:
+            lru_key = next(iter(self._entries))
+            if self._clock - self._entries[lru_key][2] <= len(self._layers):
+                return weight
+            self._evict(lru_key)
+        if self.used_bytes + nbytes > self.max_bytes:
+            return weight
+        self._entries[key] = (version, weight, self._clock)
+        self.used_bytes += nbytes
+        return weight
+
+    def _evict(self, key):
+        weight = self._entries.pop(key)[1]
+        self.used_bytes -= weight.numel() * weight.element_size()
+
+    def clear(self):
+        self._entries.clear()
+        self._layers.clear()
+        self.used_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "used_bytes": self.used_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
 class WQLinear_GGUF(nn.Module):
     def __init__(
         self, in_features, out_features, bias, dev, qtype="Q4_0"
@@ -65,6 +143,7 @@ class WQLinear_GGUF(nn.Module):
         self.in_features = in_features
         self.out_features = out_features
         self.qtype = qtype
+        self.dequant_pool = None
 
         qweight_shape = quant_shape_to_byte_shape(
             (out_features, in_features), qtype
@@ -106,23 +185,27 @@ class WQLinear_GGUF(nn.Module):
 
     def extra_repr(self) -> str:
         return (
-            "in_features={}, out_features={}, bias={}, w_bit={}, group_size={}".format(
+            "in_features={}, out_features={}, bias={}, qtype={}".format(
                 self.in_features,
                 self.out_features,
                 self.bias is not None,
-                self.w_bit,
-                self.group_size,
+                self.qtype,
             )
         )
 
+    def dequantized_weight(self, dtype):
+        if self.qtype not in QUANT_TYPES:
+            raise ValueError(f"Unknown qtype: {self.qtype}")
+        qweight = getattr(self, f"{self.qtype}_qweight")
+        dequantize = QUANT_TYPES[self.qtype].dequantize
+        if self.dequant_pool is not None:
+            return self.dequant_pool.get(self, qweight, dtype, dequantize)
+        return dequantize(qweight, dtype)
+
     @torch.no_grad()
     def forward(self, x):
         # x = torch.matmul(x, dequantize_blocks_Q4_0(self.qweight))
-        if self.qtype == "Q4_0":
-            x = F.linear(x, dequantize_blocks_Q4_0(
-                self.Q4_0_qweight, x.dtype), self.bias.to(x.dtype) if self.bias is not None else None)
-        else:
-            raise ValueError(f"Unknown qtype: {self.qtype}")
+        x = F.linear(x, self.dequantized_weight(x.dtype), self.bias.to(x.dtype) if self.bias is not None else None)
 
         return x
 
@@ -138,7 +221,7 @@ def quant_shape_to_byte_shape(shape, qtype) -> tuple[int, ...]:
     block_size, type_size = GGML_QUANT_SIZES[qtype]
     if shape[-1] % block_size != 0:
         raise ValueError(
-            f"Quantized tensor row size ({shape[-1]}) is not a multiple of Q4_0 block size ({block_size})")
+            f"Quantized tensor row size ({shape[-1]}) is not a multiple of {qtype} block size ({block_size})")
     return (*shape[:-1], shape[-1] // block_size * type_size)
 
 
@@ -147,16 +230,86 @@ def quant_shape_from_byte_shape(shape, qtype) -> tuple[int, ...]:
     block_size, type_size = GGML_QUANT_SIZES[qtype]
     if shape[-1] % type_size != 0:
         raise ValueError(
-            f"Quantized tensor bytes per row ({shape[-1]}) is not a multiple of Q4_0 type size ({type_size})")
+            f"Quantized tensor bytes per row ({shape[-1]}) is not a multiple of {qtype} type size ({type_size})")
     return (*shape[:-1], shape[-1] // type_size * block_size)
 
 
-GGML_QUANT_SIZES = {
-    "Q4_0": (32, 2 + 16),
-}
+# (block size in weights, block size in bytes), kept in sync with the registered quant types
+GGML_QUANT_SIZES = {}
+
+QK_K = 256
+
+
+class GGUFQuantType:
+    """
+    A ggml block quantization layout, the torch kernel unpacking it to (..., in_features) weights and optionally the
+    one packing weights into it
+    """
+    def __init__(self, name, block_size, type_size, dequantize, quantize=None):
+        self.name = name
+        self.block_size = block_size
+        self.type_size = type_size
+        self.dequantize = dequantize
+        self.quantize = quantize
+
+
+QUANT_TYPES = {}
+
+
+def register_quant_type(name, block_size, type_size, dequantize, quantize=None):
+    QUANT_TYPES[name] = GGUFQuantType(name, block_size, type_size, dequantize, quantize)
+    GGML_QUANT_SIZES[name] = (block_size, type_size)
+    return QUANT_TYPES[name]
+
+
+def _to_blocks(data, qtype):
+    _, type_size = GGML_QUANT_SIZES[qtype]
+    return data.view(torch.uint8).reshape(-1, type_size)
+
+
+def _from_blocks(out, shape, qtype, dtype):
+    return out.reshape(quant_shape_from_byte_shape(shape, qtype=qtype)).to(dtype)
+
+
+def _unpack_nibbles(qs):
+    # (n_blocks, 16) bytes -> (n_blocks, 32) values, the low nibbles are the first half of the block
+    return torch.cat((qs & 0x0F, qs >> 4), dim=-1)
+
+
+def _unpack_high_bits(qh):
+    # 4 bytes per block holding the 5th bit of each of the 32 weights, little endian
+    bits = torch.arange(8, device=qh.device, dtype=torch.uint8)
+    return ((qh.unsqueeze(-1) >> bits) & 1).reshape(qh.shape[0], 32)
 
 
 def dequantize_blocks_Q4_0(data, dtype=torch.float16):
+    """
+    Unpacks Q4_0 blocks (an fp16 scale followed by 32 4-bit quants stored as 16 bytes, low nibbles first) straight
+    into a preallocated fp16 buffer and scales it in place. The products are computed in fp16 like the reference
+    unpacking, so the result is bit identical to it for every output dtype.
+    """
+    block_size, type_size = GGML_QUANT_SIZES["Q4_0"]
+    shape = data.shape
+
+    blocks = data.view(torch.uint8).reshape(-1, type_size)
+    n_blocks = blocks.shape[0]
+    d = blocks[:, :2].contiguous().view(torch.float16)
+    qs = blocks[:, 2:]
+
+    out = torch.empty((n_blocks, 2, block_size // 2), dtype=torch.float16, device=data.device)
+    out[:, 0] = qs & 0x0F
+    out[:, 1] = qs >> 4
+    out = out.reshape(n_blocks, block_size).sub_(8).mul_(d)
+
+    out = out.reshape(quant_shape_from_byte_shape(
+        shape,
+        qtype="Q4_0",
+    ))
+    return out.to(dtype)
+
+
+def dequantize_blocks_Q4_0_reference(data, dtype=torch.float16):
+    """Straightforward unpacking following the ggml layout, used to validate the fast path on CPU"""
     block_size, type_size = GGML_QUANT_SIZES["Q4_0"]
 
     data = data.to(torch.uint8)
@@ -186,3 +339,99 @@ def dequantize_blocks_Q4_0(data, dtype=torch.float16):
     )).to(dtype)
     return out
 
+
+def dequantize_blocks_Q4_1(data, dtype=torch.float16):
+    blocks = _to_blocks(data, "Q4_1")
+    d = blocks[:, :2].contiguous().view(torch.float16).float()
+    m = blocks[:, 2:4].contiguous().view(torch.float16).float()
+    q = _unpack_nibbles(blocks[:, 4:])
+    out = torch.addcmul(m, q.float(), d)
+    return _from_blocks(out, data.shape, "Q4_1", dtype)
+
+
+def dequantize_blocks_Q5_0(data, dtype=torch.float16):
+    blocks = _to_blocks(data, "Q5_0")
+    d = blocks[:, :2].contiguous().view(torch.float16).float()
+    qh = _unpack_high_bits(blocks[:, 2:6])
+    q = (_unpack_nibbles(blocks[:, 6:]) | (qh << 4)).float().sub_(16)
+    out = q.mul_(d)
+    return _from_blocks(out, data.shape, "Q5_0", dtype)
+
+
+def dequantize_blocks_Q5_1(data, dtype=torch.float16):
+    blocks = _to_blocks(data, "Q5_1")
+    d = blocks[:, :2].contiguous().view(torch.float16).float()
+    m = blocks[:, 2:4].contiguous().view(torch.float16).float()
+    qh = _unpack_high_bits(blocks[:, 4:8])
+    q = _unpack_nibbles(blocks[:, 8:]) | (qh << 4)
+    out = torch.addcmul(m, q.float(), d)
+    return _from_blocks(out, data.shape, "Q5_1", dtype)
+
+
+def dequantize_blocks_Q8_0(data, dtype=torch.float16):
+    blocks = _to_blocks(data, "Q8_0")
+    d = blocks[:, :2].contiguous().view(torch.float16).float()
+    q = blocks[:, 2:].contiguous().view(torch.int8)
+    out = q.float().mul_(d)
+    return _from_blocks(out, data.shape, "Q8_0", dtype)
+
+
+def dequantize_blocks_Q6_K(data, dtype=torch.float16):
+    """
+    Super blocks of 256 weights in 16 groups with int8 scales. Each half of the block takes 64 bytes of low nibbles
+    and 32 bytes of 2-bit high parts, the nibble/shift position selects which 32 weight run a value belongs to.
+    """
+    blocks = _to_blocks(data, "Q6_K")
+    n_blocks = blocks.shape[0]
+    ql, qh, scales, d = split_block_dims(blocks, QK_K // 2, QK_K // 4, QK_K // 16)
+    d = d.contiguous().view(torch.float16).float()
+    scales = scales.contiguous().view(torch.int8).float()
+    d = (d * scales).reshape(n_blocks, QK_K // 16, 1)
+
+    ql_shifts = torch.tensor([0, 4], device=data.device, dtype=torch.uint8).reshape(1, 1, 2, 1)
+    qh_shifts = torch.tensor([0, 2, 4, 6], device=data.device, dtype=torch.uint8).reshape(1, 1, 4, 1)
+    ql = ((ql.reshape(n_blocks, -1, 1, 64) >> ql_shifts) & 0x0F).reshape(n_blocks, -1, 32)
+    qh = ((qh.reshape(n_blocks, -1, 1, 32) >> qh_shifts) & 0x03).reshape(n_blocks, -1, 32)
+    q = (ql | (qh << 4)).float().sub_(32).reshape(n_blocks, QK_K // 16, -1)
+
+    out = (d * q).reshape(n_blocks, QK_K)
+    return _from_blocks(out, data.shape, "Q6_K", dtype)
+
+
+def _roundf(x):
+    # round half away from zero like ggml's roundf, torch.round rounds half to even
+    a = x.abs()
+    floored = a.floor()
+    return x.sign() * (floored + (2 * (a - floored)).floor())
+
+
+def quantize_blocks_Q4_0(weight):
+    """Packs (..., in_features) weights into Q4_0 blocks, matching ggml's reference quantizer"""
+    block_size, _ = GGML_QUANT_SIZES["Q4_0"]
+    blocks = weight.float().reshape(-1, block_size)
+    imax = blocks.abs().argmax(dim=-1, keepdim=True)
+    d = blocks.gather(-1, imax) / -8
+    inv_d = torch.where(d == 0, torch.zeros_like(d), 1 / d)
+    qs = torch.trunc(blocks * inv_d + 8.5).clamp_(0, 15).to(torch.uint8)
+    qs = qs[:, :block_size // 2] | (qs[:, block_size // 2:] << 4)
+    out = torch.cat((d.to(torch.float16).view(torch.uint8), qs), dim=-1)
+    return out.reshape(quant_shape_to_byte_shape(weight.shape, "Q4_0"))
+
+
+def quantize_blocks_Q8_0(weight):
+    """Packs (..., in_features) weights into Q8_0 blocks, matching ggml's reference quantizer"""
+    block_size, _ = GGML_QUANT_SIZES["Q8_0"]
+    blocks = weight.float().reshape(-1, block_size)
+    d = blocks.abs().amax(dim=-1, keepdim=True) / 127
+    inv_d = torch.where(d == 0, torch.zeros_like(d), 1 / d)
+    qs = _roundf(blocks * inv_d).to(torch.int8).view(torch.uint8)
+    out = torch.cat((d.to(torch.float16).view(torch.uint8), qs), dim=-1)
+    return out.reshape(quant_shape_to_byte_shape(weight.shape, "Q8_0"))
+
+
+register_quant_type("Q4_0", 32, 2 + 16, dequantize_blocks_Q4_0, quantize_blocks_Q4_0)
+register_quant_type("Q4_1", 32, 2 + 2 + 16, dequantize_blocks_Q4_1)
+register_quant_type("Q5_0", 32, 2 + 4 + 16, dequantize_blocks_Q5_0)
+register_quant_type("Q5_1", 32, 2 + 2 + 4 + 16, dequantize_blocks_Q5_1)
+register_quant_type("Q8_0", 32, 2 + 32, dequantize_blocks_Q8_0, quantize_blocks_Q8_0)
+register_quant_type("Q6_K", QK_K, QK_K // 2 + QK_K // 4 + QK_K // 16 + 2, dequantize_blocks_Q6_K)
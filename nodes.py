@@ -1,4 +1,5 @@
 import os
+import time
 import torch
 import folder_paths
 import comfy.model_management as mm
@@ -42,6 +43,12 @@ from PIL import Image
 import numpy as np
 import json
 
+from .cfg_utils import CFG_MODES
+from .fastercache import DELTA_DTYPES, FasterCachePolicy, parse_block_list
+from .teacache import TeaCachePolicy, TeaCacheState
+from .profiling import SamplerProfiler
+from .prompt_cache import get_prompt_embedding_cache, module_fingerprint
+from .text_encode import clip_encoder_dtype, clip_encoder_id, encode_clip_prompt, encode_clip_prompts
 from .utils import log, check_diffusers_version
 
 script_directory = os.path.dirname(os.path.abspath(__file__))
@@ -51,6 +58,9 @@ if not "CogVideo" in folder_paths.folder_names_and_paths:
 if not "cogvideox_loras" in folder_paths.folder_names_and_paths:
     folder_paths.add_model_folder_path("cogvideox_loras", os.path.join(folder_paths.models_dir, "CogVideo", "loras"))
 
+# T5 outputs are reused across runs and restarts, see CogVideoTextEncode
+get_prompt_embedding_cache().set_cache_dir(os.path.join(folder_paths.models_dir, "CogVideo", "prompt_embeds_cache"))
+
 #PAB
 from .videosys.pab import CogVideoXPABConfig
 
@@ -72,6 +82,14 @@ class CogVideoPABConfig:
             "cross_range": ("INT", {"default": 6, "min": 0, "max": 10, "tooltip": "Broadcast timesteps range, higher values are faster but quality may suffer"} ),
 
             "steps": ("INT", {"default": 50, "min": 0, "max": 1000, "tooltip": "Should match the sampling steps"} ),
+            },
+            "optional": {
+                "mlp_broadcast": ("BOOLEAN", {"default": False, "tooltip": "Enable MLP PAB, reuses the feed-forward output of the blocks, high impact"}),
+                "mlp_threshold_start": ("INT", {"default": 850, "min": 0, "max": 1000, "tooltip": "PAB Start Timestep"} ),
+                "mlp_threshold_end": ("INT", {"default": 100, "min": 0, "max": 1000, "tooltip": "PAB End Timestep"} ),
+                "mlp_range": ("INT", {"default": 2, "min": 1, "max": 10, "tooltip": "Broadcast timesteps range, higher values are faster but quality may suffer"} ),
+                "mlp_blocks": ("STRING", {"default": "", "tooltip": "Comma separated block indices or ranges (e.g. 0-20, 30) that broadcast their MLP output, empty for all blocks"}),
+                "mlp_cache_slots": ("INT", {"default": 0, "min": 0, "max": 1024, "tooltip": "Number of MLP outputs kept in memory, each the size of the block's hidden states. 0 keeps one per broadcast block for every context window and CFG pass, otherwise all of them share this many, older outputs are overwritten and their blocks compute instead"} ),
             }
         }
 
@@ -83,7 +101,8 @@ class CogVideoPABConfig:
 
     def config(self, spatial_broadcast, spatial_threshold_start, spatial_threshold_end, spatial_range, 
                temporal_broadcast, temporal_threshold_start, temporal_threshold_end, temporal_range, 
-               cross_broadcast, cross_threshold_start, cross_threshold_end, cross_range, steps):
+               cross_broadcast, cross_threshold_start, cross_threshold_end, cross_range, steps,
+               mlp_broadcast=False, mlp_threshold_start=850, mlp_threshold_end=100, mlp_range=2, mlp_blocks="", mlp_cache_slots=0):
         
         os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
         pab_config = CogVideoXPABConfig(
@@ -96,7 +115,12 @@ class CogVideoPABConfig:
             temporal_range=temporal_range,
             cross_broadcast=cross_broadcast,
             cross_threshold=[cross_threshold_end, cross_threshold_start],
-            cross_range=cross_range
+            cross_range=cross_range,
+            mlp_broadcast=mlp_broadcast,
+            mlp_threshold=[mlp_threshold_end, mlp_threshold_start],
+            mlp_range=mlp_range,
+            mlp_blocks=parse_block_list(mlp_blocks),
+            mlp_cache_slots=mlp_cache_slots,
             )
 
         return (pab_config, )
@@ -163,6 +187,9 @@ class CogVideoEncodePrompt:
             "pipeline": ("COGVIDEOPIPE",),
             "prompt": ("STRING", {"default": "", "multiline": True} ),
             "negative_prompt": ("STRING", {"default": "", "multiline": True} ),
+            },
+            "optional": {
+                "use_cache": ("BOOLEAN", {"default": True, "tooltip": "Reuse the embeddings of previously encoded prompts from memory or disk, without loading the text encoder"}),
             }
         }
 
@@ -171,11 +198,20 @@ class CogVideoEncodePrompt:
     FUNCTION = "process"
     CATEGORY = "CogVideoWrapper"
 
-    def process(self, pipeline, prompt, negative_prompt):
+    def process(self, pipeline, prompt, negative_prompt, use_cache=True):
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
         pipe = pipeline["pipe"]
         dtype = pipeline["dtype"]
+        max_sequence_length = 226
+
+        cache = get_prompt_embedding_cache()
+        if use_cache:
+            encoder_id = module_fingerprint(pipe.text_encoder)
+            keys = [cache.key(encoder_id, text, max_sequence_length, dtype) for text in (prompt, negative_prompt)]
+            cached = [cache.get(key, device) for key in keys]
+            if all(embeds is not None for embeds in cached):
+                return tuple(cached)
 
         pipe.text_encoder.to(device)
         pipe.transformer.to(offload_device)
@@ -185,12 +221,16 @@ class CogVideoEncodePrompt:
             negative_prompt=negative_prompt,
             do_classifier_free_guidance=True,
             num_videos_per_prompt=1,
-            max_sequence_length=226,
+            max_sequence_length=max_sequence_length,
             device=device,
             dtype=dtype,
         )
         pipe.text_encoder.to(offload_device)
 
+        if use_cache:
+            for key, text, embeds in zip(keys, (prompt, negative_prompt), (positive, negative)):
+                cache.put(key, embeds, {"prompt": text, "max_sequence_length": max_sequence_length, "dtype": dtype})
+
         return (positive, negative)
 
 # Inject clip_l and t5xxl w/ individual strength adjustments for ComfyUI's DualCLIPLoader node for CogVideoX. Use CLIPSave node from any SDXL model then load in a custom clip_l model. 
@@ -254,6 +294,7 @@ class CogVideoTextEncode:
             "optional": {
                 "strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 10.0, "step": 0.01}),
                 "force_offload": ("BOOLEAN", {"default": True}),
+                "use_cache": ("BOOLEAN", {"default": True, "tooltip": "Reuse the embeddings of previously encoded prompts from memory or disk, without loading the text encoder"}),
             }
         }
 
@@ -262,25 +303,66 @@ class CogVideoTextEncode:
     FUNCTION = "process"
     CATEGORY = "CogVideoWrapper"
 
-    def process(self, clip, prompt, strength=1.0, force_offload=True):
+    def process(self, clip, prompt, strength=1.0, force_offload=True, use_cache=True):
         max_tokens = 226
-        load_device = mm.text_encoder_device()
-        offload_device = mm.text_encoder_offload_device()
-        clip.tokenizer.t5xxl.pad_to_max_length = True
-        clip.tokenizer.t5xxl.max_length = max_tokens
-        clip.cond_stage_model.to(load_device)
-        tokens = clip.tokenize(prompt, return_word_ids=True)
-        
-        embeds = clip.encode_from_tokens(tokens, return_pooled=False, return_dict=False)
 
-        if embeds.shape[1] > 226:
-            raise ValueError(f"Prompt is too long, max tokens supported is {max_tokens} or less, got {embeds.shape[1]}")
+        # strength is applied after the lookup, the cache holds the raw encoder output
+        cache = get_prompt_embedding_cache()
+        embeds = None
+        if use_cache:
+            key = cache.key(clip_encoder_id(clip), prompt, max_tokens, clip_encoder_dtype(clip))
+            embeds = cache.get(key)
+
+        if embeds is None:
+            load_device = mm.text_encoder_device()
+            offload_device = mm.text_encoder_offload_device()
+            clip.cond_stage_model.to(load_device)
+            embeds = encode_clip_prompt(clip, prompt, max_tokens)
+            if force_offload:
+                clip.cond_stage_model.to(offload_device)
+            if use_cache:
+                cache.put(key, embeds, {"prompt": prompt, "max_sequence_length": max_tokens})
         embeds *= strength
-        if force_offload:
-            clip.cond_stage_model.to(offload_device)
 
         return (embeds, )
     
+class CogVideoTextEncodeBatch:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+            "clip": ("CLIP",),
+            "prompts": ("STRING", {"default": "", "multiline": True, "tooltip": "One prompt per line, empty lines are skipped"} ),
+            },
+            "optional": {
+                "strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 10.0, "step": 0.01}),
+                "force_offload": ("BOOLEAN", {"default": True}),
+                "batch_size": ("INT", {"default": 8, "min": 1, "max": 256, "step": 1, "tooltip": "Prompts encoded per text encoder call"}),
+                "use_cache": ("BOOLEAN", {"default": True, "tooltip": "Reuse the embeddings of previously encoded prompts from memory or disk, without loading the text encoder"}),
+            }
+        }
+
+    RETURN_TYPES = ("CONDITIONING",)
+    RETURN_NAMES = ("conditioning",)
+    OUTPUT_IS_LIST = (True,)
+    FUNCTION = "process"
+    CATEGORY = "CogVideoWrapper"
+    DESCRIPTION = "Encodes several prompts in batched text encoder calls, outputs one conditioning per prompt, identical to CogVideo TextEncode"
+
+    def process(self, clip, prompts, strength=1.0, force_offload=True, batch_size=8, use_cache=True):
+        prompt_list = [line for line in prompts.splitlines() if line.strip()]
+        if not prompt_list:
+            raise ValueError("No prompts given")
+        embeds_list = encode_clip_prompts(
+            clip,
+            prompt_list,
+            batch_size=batch_size,
+            cache=get_prompt_embedding_cache() if use_cache else None,
+            force_offload=force_offload,
+        )
+        for embeds in embeds_list:
+            embeds *= strength
+        return (embeds_list, )
+
 class CogVideoTextEncodeCombine:
     @classmethod
     def INPUT_TYPES(s):
@@ -642,6 +724,13 @@ class CogVideoXFasterCache:
                 "lf_step": ("INT", {"default": 40, "min": 0, "max": 1024, "step": 1}),
                 "cache_device": (["main_device", "offload_device"], {"default": "main_device", "tooltip": "The device to use for the cache, main_device is on GPU and uses a lot of VRAM"}),
             },
+            "optional": {
+                "block_cadence": ("INT", {"default": 3, "min": 0, "max": 1024, "step": 1, "tooltip": "Blocks compute their attention on steps divisible by this and reuse the cached one otherwise, 0 disables block level reuse"}),
+                "model_cadence": ("INT", {"default": 5, "min": 0, "max": 1024, "step": 1, "tooltip": "The unconditional pass is computed on steps divisible by this and rebuilt from the cached CFG difference otherwise, 0 disables it. Lower both cadences for low step counts"}),
+                "blocks": ("STRING", {"default": "", "tooltip": "Comma separated block indices or ranges (e.g. 0-20, 30) that cache and reuse their attention, empty for all blocks"}),
+                "delta_dtype": (list(DELTA_DTYPES), {"default": "disabled", "tooltip": "Store the step to step difference of the cached attention in a lower precision to save memory"}),
+                "max_cache_mb": ("INT", {"default": 0, "min": 0, "max": 1024 * 1024, "step": 64, "tooltip": "Cache size budget on the cache device in MB, the least recently used blocks are moved to the offload device past it, 0 for no limit"}),
+            },
         }
 
     RETURN_TYPES = ("FASTERCACHEARGS",)
@@ -649,17 +738,56 @@ class CogVideoXFasterCache:
     FUNCTION = "args"
     CATEGORY = "CogVideoWrapper"
 
-    def args(self, start_step, hf_step, lf_step, cache_device):
+    def args(self, start_step, hf_step, lf_step, cache_device, block_cadence=3, model_cadence=5, blocks="", delta_dtype="disabled", max_cache_mb=0):
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
+        cache_device = device if cache_device == "main_device" else offload_device
+        policy = FasterCachePolicy(
+            start_step=start_step,
+            lf_step=lf_step,
+            hf_step=hf_step,
+            block_cadence=block_cadence,
+            model_cadence=model_cadence,
+            blocks=parse_block_list(blocks),
+            delta_dtype=DELTA_DTYPES[delta_dtype],
+            max_cache_bytes=max_cache_mb * 1024**2,
+            cache_device=cache_device,
+            offload_device=offload_device,
+        )
+        log.info(f"FasterCache: {policy}")
         fastercache = {
             "start_step" : start_step,
             "hf_step" : hf_step,
             "lf_step" : lf_step,
-            "cache_device" : device if cache_device == "main_device" else offload_device
+            "cache_device" : cache_device,
+            "policy" : policy,
         }
         return (fastercache,)
     
+class CogVideoXTeaCache:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "threshold": ("FLOAT", {"default": 0.1, "min": 0.0, "max": 10.0, "step": 0.001, "tooltip": "Accumulated relative change of the model input under which the transformer blocks are skipped, higher skips more steps at some quality cost, 0 disables skipping"}),
+            },
+            "optional": {
+                "start_step": ("INT", {"default": 0, "min": 0, "max": 1024, "step": 1, "tooltip": "Steps before this always run the full model"}),
+                "end_step": ("INT", {"default": -1, "min": -1, "max": 1024, "step": 1, "tooltip": "Steps after this always run the full model, -1 for the last step"}),
+                "max_consecutive_skips": ("INT", {"default": 0, "min": 0, "max": 1024, "step": 1, "tooltip": "Maximum number of steps in a row that reuse the same cached residual, 0 for no limit"}),
+            },
+        }
+
+    RETURN_TYPES = ("TEACACHEARGS",)
+    RETURN_NAMES = ("teacache", )
+    FUNCTION = "args"
+    CATEGORY = "CogVideoWrapper"
+    DESCRIPTION = "Adaptive step skipping for the CogVideoSampler: steps where the model input barely changed reuse the residual of the transformer blocks from the last full step. The number of skipped steps is logged after sampling"
+
+    def args(self, threshold, start_step=0, end_step=-1, max_consecutive_skips=0):
+        policy = TeaCachePolicy(threshold=threshold, start_step=start_step, end_step=end_step, max_consecutive_skips=max_consecutive_skips)
+        return (policy,)
+
 class CogVideoSampler:
     @classmethod
     def INPUT_TYPES(s):
@@ -687,6 +815,11 @@ class CogVideoSampler:
                 "controlnet": ("COGVIDECONTROLNET",),
                 "tora_trajectory": ("TORAFEATURES", ),
                 "fastercache": ("FASTERCACHEARGS", ),
+                "teacache": ("TEACACHEARGS", ),
+                "cfg_mode": (CFG_MODES, {"default": "batched", "tooltip": "sequential runs the conditional and unconditional passes one after the other instead of as a batch of two, lowering peak VRAM use at some speed cost"}),
+                "cfg_start_percent": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "First step percentage that uses cfg, the unconditional pass is skipped before it"}),
+                "cfg_end_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "Last step percentage that uses cfg, the unconditional pass is skipped after it"}),
+                "profile": ("BOOLEAN", {"default": False, "tooltip": "Record per step timings and peak memory of the sampler, the report is saved as json to the ComfyUI output folder"}),
             }
         }
 
@@ -696,7 +829,8 @@ class CogVideoSampler:
     CATEGORY = "CogVideoWrapper"
 
     def process(self, pipeline, positive, negative, steps, cfg, seed, height, width, num_frames, scheduler, samples=None, 
-                denoise_strength=1.0, image_cond_latents=None, context_options=None, controlnet=None, tora_trajectory=None, fastercache=None):
+                denoise_strength=1.0, image_cond_latents=None, context_options=None, controlnet=None, tora_trajectory=None, fastercache=None,
+                cfg_mode="batched", cfg_start_percent=0.0, cfg_end_percent=1.0, profile=False, teacache=None):
         mm.soft_empty_cache()
 
         base_path = pipeline["base_path"]
@@ -738,46 +872,72 @@ class CogVideoSampler:
         if fastercache is not None:
             pipe.transformer.use_fastercache = True
             pipe.transformer.fastercache_counter = 0
-            pipe.transformer.fastercache_start_step = fastercache["start_step"]
-            pipe.transformer.fastercache_lf_step = fastercache["lf_step"]
-            pipe.transformer.fastercache_hf_step = fastercache["hf_step"]
-            pipe.transformer.fastercache_device = fastercache["cache_device"]
+            pipe.transformer.fastercache_policy = fastercache["policy"]
         else:
             pipe.transformer.use_fastercache = False
             pipe.transformer.fastercache_counter = 0
 
+        if hasattr(pipe.transformer, "teacache_state"):
+            if teacache is not None and fastercache is not None:
+                log.warning("TeaCache is ignored when FasterCache is enabled")
+            pipe.transformer.teacache_state = TeaCacheState(teacache) if teacache is not None else None
+        elif teacache is not None:
+            log.warning("TeaCache is not supported by the PAB transformer, ignoring it")
+
+        profiler = SamplerProfiler(backend=device.type, device=device) if profile else None
+
         autocastcondition = not pipeline["onediff"] or not dtype == torch.float32
         autocast_context = torch.autocast(mm.get_autocast_device(device)) if autocastcondition else nullcontext()
         with autocast_context:
-            latents = pipeline["pipe"](
-                num_inference_steps=steps,
-                height = height,
-                width = width,
-                num_frames = num_frames,
-                guidance_scale=cfg,
-                latents=samples["samples"] if samples is not None else None,
-                image_cond_latents=image_cond_latents["samples"] if image_cond_latents is not None else None,
-                denoise_strength=denoise_strength,
-                prompt_embeds=positive.to(dtype).to(device),
-                negative_prompt_embeds=negative.to(dtype).to(device),
-                generator=generator,
-                device=device,
-                context_schedule=context_options["context_schedule"] if context_options is not None else None,
-                context_frames=context_frames,
-                context_stride= context_stride,
-                context_overlap= context_overlap,
-                freenoise=context_options["freenoise"] if context_options is not None else None,
-                controlnet=controlnet,
-                tora=tora_trajectory if tora_trajectory is not None else None,
-            )
+            try:
+                latents = pipeline["pipe"](
+                    num_inference_steps=steps,
+                    height = height,
+                    width = width,
+                    num_frames = num_frames,
+                    guidance_scale=cfg,
+                    latents=samples["samples"] if samples is not None else None,
+                    image_cond_latents=image_cond_latents["samples"] if image_cond_latents is not None else None,
+                    denoise_strength=denoise_strength,
+                    prompt_embeds=positive.to(dtype).to(device),
+                    negative_prompt_embeds=negative.to(dtype).to(device),
+                    generator=generator,
+                    device=device,
+                    context_schedule=context_options["context_schedule"] if context_options is not None else None,
+                    context_frames=context_frames,
+                    context_stride= context_stride,
+                    context_overlap= context_overlap,
+                    freenoise=context_options["freenoise"] if context_options is not None else None,
+                    context_batch_size=context_options.get("context_batch_size", 1) if context_options is not None else 1,
+                    context_weighting=context_options.get("context_weighting", "default") if context_options is not None else "default",
+                    controlnet=controlnet,
+                    tora=tora_trajectory if tora_trajectory is not None else None,
+                    cfg_mode=cfg_mode,
+                    cfg_start_percent=cfg_start_percent,
+                    cfg_end_percent=cfg_end_percent,
+                    profiler=profiler,
+                )
+            finally:
+                # the timing hooks must not outlive a failed run
+                if profiler is not None:
+                    profiler.detach()
+        if profiler is not None:
+            profile_path = os.path.join(folder_paths.get_output_directory(), "CogVideoX_profiles", f"sampler_profile_{time.strftime('%Y%m%d-%H%M%S')}.json")
+            report = profiler.save(profile_path)
+            log.info(f"Sampler profile saved to {profile_path}, {report['num_steps']} steps in {report['total_wall_ms'] / 1000:.2f}s")
+            for name, section in report["sections"].items():
+                if not name.startswith("transformer_block_"):
+                    log.info(f"  {name}: {section['count']} calls, wall {section['wall_ms']:.1f}ms, device {section['device_ms'] or 0:.1f}ms")
         if not pipeline["cpu_offloading"]:
             pipe.transformer.to(offload_device)
 
         if fastercache is not None:
-            for block in pipe.transformer.transformer_blocks:
-                if (hasattr, block, "cached_hidden_states") and block.cached_hidden_states is not None:
-                    block.cached_hidden_states = None
-                    block.cached_encoder_hidden_states = None
+            if getattr(pipe.transformer, "fastercache_state", None) is not None:
+                pipe.transformer.fastercache_state.clear()
+        if getattr(pipe.transformer, "teacache_state", None) is not None:
+            report = pipe.transformer.teacache_state.report()
+            log.info(f"TeaCache skipped {report['skipped_steps']} of {report['steps']} steps ({report['skipped_calls']} of {report['calls']} transformer calls)")
+            pipe.transformer.teacache_state = None
                     
         mm.soft_empty_cache()
 
@@ -904,6 +1064,9 @@ class CogVideoXFunSampler:
                 "fastercache": ("FASTERCACHEARGS",),
                 "vid2vid_images": ("IMAGE",),
                 "vid2vid_denoise": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+                "cfg_mode": (CFG_MODES, {"default": "batched", "tooltip": "sequential runs the conditional and unconditional passes one after the other instead of as a batch of two, lowering peak VRAM use at some speed cost"}),
+                "cfg_start_percent": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "First step percentage that uses cfg, the unconditional pass is skipped before it"}),
+                "cfg_end_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "Last step percentage that uses cfg, the unconditional pass is skipped after it"}),
             },
         }
     
@@ -914,7 +1077,7 @@ class CogVideoXFunSampler:
 
     def process(self, pipeline,  positive, negative, video_length, base_resolution, seed, steps, cfg, scheduler, 
                 start_img=None, end_img=None, opt_empty_latent=None, noise_aug_strength=0.0563, context_options=None, fastercache=None, 
-                tora_trajectory=None, vid2vid_images=None, vid2vid_denoise=1.0):
+                tora_trajectory=None, vid2vid_images=None, vid2vid_denoise=1.0, cfg_mode="batched", cfg_start_percent=0.0, cfg_end_percent=1.0):
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
         pipe = pipeline["pipe"]
@@ -948,9 +1111,6 @@ class CogVideoXFunSampler:
         log.info(f"Closest bucket size: {width}x{height}")
         
         # Load Sampler
-        if context_options is not None and context_options["context_schedule"] == "temporal_tiling":
-            log.info("Temporal tiling enabled, changing scheduler to CogVideoXDDIM")
-            scheduler="CogVideoXDDIM"
         scheduler_config = pipeline["scheduler_config"]
         if scheduler in scheduler_mapping:
             noise_scheduler = scheduler_mapping[scheduler].from_config(scheduler_config)
@@ -974,10 +1134,7 @@ class CogVideoXFunSampler:
         if fastercache is not None:
             pipe.transformer.use_fastercache = True
             pipe.transformer.fastercache_counter = 0
-            pipe.transformer.fastercache_start_step = fastercache["start_step"]
-            pipe.transformer.fastercache_lf_step = fastercache["lf_step"]
-            pipe.transformer.fastercache_hf_step = fastercache["hf_step"]
-            pipe.transformer.fastercache_device = fastercache["cache_device"]
+            pipe.transformer.fastercache_policy = fastercache["policy"]
         else:
             pipe.transformer.use_fastercache = False
             pipe.transformer.fastercache_counter = 0
@@ -1008,7 +1165,11 @@ class CogVideoXFunSampler:
                 "context_stride": context_stride,
                 "context_overlap": context_overlap,
                 "freenoise":context_options["freenoise"] if context_options is not None else None,
+                "context_weighting":context_options.get("context_weighting", "default") if context_options is not None else "default",
                 "tora":tora_trajectory if tora_trajectory is not None else None,
+                "cfg_mode": cfg_mode,
+                "cfg_start_percent": cfg_start_percent,
+                "cfg_end_percent": cfg_end_percent,
             }
             latents = pipe(
                 **common_params,
@@ -1021,10 +1182,8 @@ class CogVideoXFunSampler:
         #     pipe.transformer.to(offload_device)
         #clear FasterCache
         if fastercache is not None:
-            for block in pipe.transformer.transformer_blocks:
-                if (hasattr, block, "cached_hidden_states") and block.cached_hidden_states is not None:
-                    block.cached_hidden_states = None
-                    block.cached_encoder_hidden_states = None
+            if getattr(pipe.transformer, "fastercache_state", None) is not None:
+                pipe.transformer.fastercache_state.clear()
 
         mm.soft_empty_cache()
 
@@ -1177,6 +1336,10 @@ class CogVideoContextOptions:
             "context_stride": ("INT", {"default": 4, "min": 4, "max": 100, "step": 1, "tooltip": "Context stride as pixel frames, NOTE: the latent space has 4 frames in 1"} ),
             "context_overlap": ("INT", {"default": 4, "min": 4, "max": 100, "step": 1, "tooltip": "Context overlap as pixel frames, NOTE: the latent space has 4 frames in 1"} ),
             "freenoise": ("BOOLEAN", {"default": True, "tooltip": "Shuffle the noise"}),
+            },
+            "optional": {
+                "context_batch_size": ("INT", {"default": 1, "min": 0, "max": 64, "step": 1, "tooltip": "Number of context windows denoised in a single transformer call, 0 picks the largest batch that fits in free VRAM. Also batches the tiles of temporal_tiling with schedulers other than CogVideoXDDIM. Not used with FasterCache"} ),
+                "context_weighting": (["default", "flat", "gaussian", "pyramid"], {"default": "default", "tooltip": "How overlapping windows are blended, default uses gaussian for temporal_tiling and flat for the other schedules"} ),
             }
         }
 
@@ -1185,13 +1348,15 @@ class CogVideoContextOptions:
     FUNCTION = "process"
     CATEGORY = "CogVideoWrapper"
 
-    def process(self, context_schedule, context_frames, context_stride, context_overlap, freenoise):
+    def process(self, context_schedule, context_frames, context_stride, context_overlap, freenoise, context_batch_size=1, context_weighting="default"):
         context_options = {
             "context_schedule":context_schedule,
             "context_frames":context_frames,
             "context_stride":context_stride,
             "context_overlap":context_overlap,
-            "freenoise":freenoise
+            "freenoise":freenoise,
+            "context_batch_size":context_batch_size,
+            "context_weighting":context_weighting,
         }
 
         return (context_options,)
@@ -1250,9 +1415,6 @@ class CogVideoXFunControlSampler:
 
         # Load Sampler
         scheduler_config = pipeline["scheduler_config"]
-        if context_options is not None and context_options["context_schedule"] == "temporal_tiling":
-            log.info("Temporal tiling enabled, changing scheduler to CogVideoXDDIM")
-            scheduler="CogVideoXDDIM"
         if scheduler in scheduler_mapping:
             noise_scheduler = scheduler_mapping[scheduler].from_config(scheduler_config)
             pipe.scheduler = noise_scheduler
@@ -1290,8 +1452,8 @@ class CogVideoXFunControlSampler:
                 context_frames=context_frames,
                 context_stride= context_stride,
                 context_overlap= context_overlap,
-                freenoise=context_options["freenoise"] if context_options is not None else None
-                
+                freenoise=context_options["freenoise"] if context_options is not None else None,
+                context_weighting=context_options.get("context_weighting", "default") if context_options is not None else "default",
             )
 
         return (pipeline, {"samples": latents})
@@ -1300,6 +1462,7 @@ NODE_CLASS_MAPPINGS = {
     "CogVideoSampler": CogVideoSampler,
     "CogVideoDecode": CogVideoDecode,
     "CogVideoTextEncode": CogVideoTextEncode,
+    "CogVideoTextEncodeBatch": CogVideoTextEncodeBatch,
     "CogVideoDualTextEncode_311": CogVideoDualTextEncode_311,
     "CogVideoImageEncode": CogVideoImageEncode,
     "CogVideoImageInterpolationEncode": CogVideoImageInterpolationEncode,
@@ -1316,12 +1479,14 @@ NODE_CLASS_MAPPINGS = {
     "ToraEncodeTrajectory": ToraEncodeTrajectory,
     "ToraEncodeOpticalFlow": ToraEncodeOpticalFlow,
     "CogVideoXFasterCache": CogVideoXFasterCache,
+    "CogVideoXTeaCache": CogVideoXTeaCache,
     "CogVideoXFunResizeToClosestBucket": CogVideoXFunResizeToClosestBucket
 }
 NODE_DISPLAY_NAME_MAPPINGS = {
     "CogVideoSampler": "CogVideo Sampler",
     "CogVideoDecode": "CogVideo Decode",
     "CogVideoTextEncode": "CogVideo TextEncode",
+    "CogVideoTextEncodeBatch": "CogVideo TextEncode Batch",
     "CogVideoDualTextEncode_311": "CogVideo DualTextEncode",
     "CogVideoImageEncode": "CogVideo ImageEncode",
     "CogVideoImageInterpolationEncode": "CogVideo ImageInterpolation Encode",
@@ -1337,5 +1502,6 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "ToraEncodeTrajectory": "Tora Encode Trajectory",
     "ToraEncodeOpticalFlow": "Tora Encode OpticalFlow",
     "CogVideoXFasterCache": "CogVideoX FasterCache",
+    "CogVideoXTeaCache": "CogVideoX TeaCache",
     "CogVideoXFunResizeToClosestBucket": "CogVideoXFun ResizeToClosestBucket"
     }
\ No newline at end of file
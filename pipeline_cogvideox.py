@@ -25,7 +25,6 @@ from diffusers.schedulers import CogVideoXDDIMScheduler, CogVideoXDPMScheduler
 from diffusers.utils import logging
 from diffusers.utils.torch_utils import randn_tensor
 from diffusers.video_processor import VideoProcessor
-from diffusers.models.embeddings import get_3d_rotary_pos_embed
 
 from .custom_cogvideox_transformer_3d import CogVideoXTransformer3DModel
 
@@ -35,7 +34,11 @@ logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 from .videosys.core.pipeline import VideoSysPipeline
 from .videosys.cogvideox_transformer_3d import CogVideoXTransformer3DModel as CogVideoXTransformer3DModelPAB
-from .videosys.core.pab_mgr import set_pab_manager
+from .videosys.core.pab_mgr import pab_state_for
+from .rotary_cache import get_rotary_emb_cache
+from .cfg_utils import cfg_chunk, cfg_forward
+from .profiling import NULL_PROFILER
+from .cogvideox_fun.context import get_context_scheduler, temporal_tiling, ContextPlan, gather_context_windows, scatter_add_context_windows
 
 def get_resize_crop_region_for_grid(src, tgt_width, tgt_height):
     tw = tgt_width
@@ -161,8 +164,8 @@ class CogVideoXPipeline(VideoSysPipeline):
         self.original_mask = original_mask
         self.video_processor = VideoProcessor(vae_scale_factor=self.vae_scale_factor_spatial)
 
-        if pab_config is not None:
-            set_pab_manager(pab_config)
+        # compiled into a schedule on every run, so pipelines of different models never share PAB state
+        self.pab_config = pab_config
 
         self.input_with_padding = True
 
@@ -286,16 +289,55 @@ class CogVideoXPipeline(VideoSysPipeline):
 
         return timesteps.to(device), num_inference_steps - t_start
     
-    def _gaussian_weights(self, t_tile_length, t_batch_size):
-        from numpy import pi, exp, sqrt
-
-        var = 0.01
-        midpoint = (t_tile_length - 1) / 2  # -1 because index goes from 0 to latent_width - 1
-        t_probs = [exp(-(t-midpoint)*(t-midpoint)/(t_tile_length*t_tile_length)/(2*var)) / sqrt(2*pi*var) for t in range(t_tile_length)]
-        weights = torch.tensor(t_probs)
-        weights = weights.unsqueeze(0).unsqueeze(2).unsqueeze(3).unsqueeze(4).repeat(1, t_batch_size,1, 1, 1)
-        return weights
-    
+    def _get_context_batch_size(self, height, width, context_frames, text_seq_length, cfg_batch, device, memory_fraction=0.8):
+        # rough activation estimate for one window: residual stream, qkv/attention output and the 4x feed-forward
+        if torch.device(device).type != "cuda":
+            return 1
+        p = self.transformer.config.patch_size
+        inner_dim = self.transformer.config.num_attention_heads * self.transformer.config.attention_head_dim
+        seq_length = text_seq_length + context_frames * (height // (self.vae_scale_factor_spatial * p)) * (width // (self.vae_scale_factor_spatial * p))
+        element_size = torch.finfo(self.vae.dtype).bits // 8
+        window_bytes = cfg_batch * seq_length * inner_dim * element_size * 12
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        return max(1, int(free_memory * memory_fraction // window_bytes))
+
+    def _predict_noise(
+        self,
+        hidden_states,
+        encoder_hidden_states,
+        timestep,
+        image_rotary_emb=None,
+        control_frames=None,
+        control_weights=None,
+        video_flow_features=None,
+    ):
+        controlnet_states = None
+        if control_frames is not None:
+            # extract controlnet hidden state
+            controlnet_states = self.controlnet(
+                hidden_states=hidden_states,
+                encoder_hidden_states=encoder_hidden_states,
+                image_rotary_emb=image_rotary_emb,
+                controlnet_states=control_frames,
+                timestep=timestep,
+                return_dict=False,
+            )[0]
+            if isinstance(controlnet_states, (tuple, list)):
+                controlnet_states = [x.to(dtype=self.vae.dtype) for x in controlnet_states]
+            else:
+                controlnet_states = controlnet_states.to(dtype=self.vae.dtype)
+
+        return self.transformer(
+            hidden_states=hidden_states,
+            encoder_hidden_states=encoder_hidden_states,
+            timestep=timestep,
+            image_rotary_emb=image_rotary_emb,
+            return_dict=False,
+            controlnet_states=controlnet_states,
+            controlnet_weights=control_weights,
+            video_flow_features=video_flow_features,
+        )[0]
+
     def fuse_qkv_projections(self) -> None:
         r"""Enables fused QKV projections."""
         self.fusing_transformer = True
@@ -326,12 +368,12 @@ class CogVideoXPipeline(VideoSysPipeline):
         grid_crops_coords = get_resize_crop_region_for_grid(
             (grid_height, grid_width), base_size_width, base_size_height
         )
-        freqs_cos, freqs_sin = get_3d_rotary_pos_embed(
+        freqs_cos, freqs_sin = get_rotary_emb_cache().get(
             embed_dim=self.transformer.config.attention_head_dim,
             crops_coords=grid_crops_coords,
             grid_size=(grid_height, grid_width),
             temporal_size=num_frames,
-            use_real=True,
+            device=device,
         )
         
         if start_frame is not None:
@@ -344,8 +386,6 @@ class CogVideoXPipeline(VideoSysPipeline):
             freqs_cos = freqs_cos.view(-1, freqs_cos.shape[-1])
             freqs_sin = freqs_sin.view(-1, freqs_sin.shape[-1])
 
-        freqs_cos = freqs_cos.to(device=device)
-        freqs_sin = freqs_sin.to(device=device)
         return freqs_cos, freqs_sin
 
     # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
@@ -388,8 +428,14 @@ class CogVideoXPipeline(VideoSysPipeline):
         context_stride: Optional[int] = None,
         context_overlap: Optional[int] = None,
         freenoise: Optional[bool] = True,
+        context_batch_size: Optional[int] = 1,
+        context_weighting: Optional[str] = "default",
         controlnet: Optional[dict] = None,
         tora: Optional[dict] = None,
+        cfg_mode: Optional[str] = "batched",
+        cfg_start_percent: Optional[float] = 0.0,
+        cfg_end_percent: Optional[float] = 1.0,
+        profiler = None,
         
     ):
         """
@@ -434,6 +480,22 @@ class CogVideoXPipeline(VideoSysPipeline):
                 Pre-generated negative text embeddings. Can be used to easily tweak text inputs, *e.g.* prompt
                 weighting. If not provided, negative_prompt_embeds will be generated from `negative_prompt` input
                 argument.
+            context_batch_size (`int`, *optional*, defaults to `1`):
+                Number of context windows stacked along the batch dimension and denoised in a single transformer
+                call when a context schedule is used. `0` picks the largest number that fits the free device memory.
+            context_weighting (`str`, *optional*, defaults to `"default"`):
+                Blending profile for overlapping context windows or temporal tiles, one of `"flat"`, `"gaussian"` or
+                `"pyramid"`. `"default"` uses gaussian for temporal tiling and flat for context schedules.
+            cfg_mode (`str`, *optional*, defaults to `"batched"`):
+                `"batched"` runs the unconditional and conditional passes as a single batch of two, `"sequential"` runs
+                them one after the other, which halves the peak activation memory at some speed cost.
+            cfg_start_percent (`float`, *optional*, defaults to `0.0`):
+            cfg_end_percent (`float`, *optional*, defaults to `1.0`):
+                Range of the sampling steps that use classifier free guidance, outside of it the unconditional pass is
+                skipped and only the conditional prediction is used.
+            profiler (`SamplerProfiler`, *optional*):
+                Records per step timings of the transformer blocks, ControlNet, Tora fusers, scheduler step, CFG
+                combine and context blending, together with the peak allocated memory of every step.
         """
 
         #assert (
@@ -558,20 +620,45 @@ class CogVideoXPipeline(VideoSysPipeline):
         comfy_pbar = ProgressBar(num_inference_steps)
 
         # 8. context schedule and temporal tiling
-        if context_schedule is not None and context_schedule == "temporal_tiling":
+        if context_schedule is not None and context_schedule == "temporal_tiling" and isinstance(self.scheduler, CogVideoXDDIMScheduler):
             t_tile_length = context_frames
             t_tile_overlap = context_overlap
-            t_tile_weights = self._gaussian_weights(t_tile_length=t_tile_length, t_batch_size=1).to(latents.device).to(self.vae.dtype)
+            context_plan = ContextPlan(
+                temporal_tiling, len(timesteps), latents.shape[1], t_tile_length, context_stride, t_tile_overlap,
+                weight_profile="gaussian" if context_weighting == "default" else context_weighting, device=latents.device
+                )
             use_temporal_tiling = True
+            use_context_schedule = False
             logger.info("Temporal tiling enabled")
         elif context_schedule is not None:
-            if image_cond_latents is not None:
+            if image_cond_latents is not None and context_schedule != "temporal_tiling":
                 raise NotImplementedError("Context schedule not currently supported with image conditioning")
-            logger.info(f"Context schedule enabled: {context_frames} frames, {context_stride} stride, {context_overlap} overlap")
             use_temporal_tiling = False
             use_context_schedule = True
-            from .cogvideox_fun.context import get_context_scheduler
             context = get_context_scheduler(context_schedule)
+            if context_schedule == "temporal_tiling":
+                # multistep schedulers keep state between steps, so instead of stepping every tile separately
+                # the tile noise predictions are blended into one full length prediction and stepped once
+                logger.info(f"Temporal tiling enabled with blended noise predictions for {self.scheduler.__class__.__name__}")
+                weight_profile = "gaussian" if context_weighting == "default" else context_weighting
+            else:
+                logger.info(f"Context schedule enabled: {context_frames} frames, {context_stride} stride, {context_overlap} overlap")
+                weight_profile = "flat" if context_weighting == "default" else context_weighting
+            # all windows of the run as index tensors with their per-frame overlap counts
+            context_plan = ContextPlan(
+                context, len(timesteps), latents.shape[1], context_frames, context_stride, context_overlap,
+                weight_profile=weight_profile, device=latents.device
+                )
+            if context_batch_size != 1 and getattr(self.transformer, "use_fastercache", False):
+                logger.info("FasterCache expects a single window per forward pass, disabling batched context windows")
+                context_batch_size = 1
+            elif context_batch_size == 0:
+                context_batch_size = self._get_context_batch_size(
+                    height, width, context_frames, prompt_embeds.shape[1], 2 if do_classifier_free_guidance and cfg_mode == "batched" else 1, device
+                    )
+                logger.info(f"Batching up to {context_batch_size} context windows per transformer call")
+            # float32 accumulator for the window predictions, allocated once and reused every step
+            context_noise_pred = None
 
         else:
             use_temporal_tiling = False
@@ -585,6 +672,17 @@ class CogVideoXPipeline(VideoSysPipeline):
             )
             if tora is not None and do_classifier_free_guidance:
                 video_flow_features = tora["video_flow_features"].repeat(1, 2, 1, 1, 1).contiguous()
+            elif tora is not None:
+                video_flow_features = tora["video_flow_features"]
+
+        # FasterCache reconstructs the unconditional output from the batch of two, so it needs that batch every step
+        if getattr(self.transformer, "use_fastercache", False) and (cfg_mode != "batched" or cfg_start_percent > 0.0 or cfg_end_percent < 1.0):
+            logger.info("FasterCache needs the batched unconditional pass on every step, ignoring cfg_mode and the cfg range")
+            cfg_mode, cfg_start_percent, cfg_end_percent = "batched", 0.0, 1.0
+        if do_classifier_free_guidance and cfg_mode == "sequential":
+            logger.info("Running the conditional and unconditional passes sequentially")
+        # output of the sequential cfg passes, reused every step
+        cfg_noise_pred = None
 
         # 9. Controlnet
         if controlnet is not None:
@@ -597,10 +695,11 @@ class CogVideoXPipeline(VideoSysPipeline):
                 self.controlnet.to(self.transformer.dtype)
             
             if getattr(self.transformer, 'fp8_matmul_enabled', False):
-                from .fp8_optimization import convert_fp8_linear
-                if not hasattr(self.controlnet, 'fp8_matmul_enabled') or not self.controlnet.fp8_matmul_enabled:
-                    convert_fp8_linear(self.controlnet, torch.float16)
-                    setattr(self.controlnet, "fp8_matmul_enabled", True)
+                from .fp8_optimization import convert_fp8_linear, FP8Linear
+                if not getattr(self.controlnet, 'fp8_matmul_enabled', False):
+                    # compute in the same dtype as the transformer's fp8 layers
+                    original_dtype = next((m.original_dtype for m in self.transformer.modules() if isinstance(m, FP8Linear)), torch.float16)
+                    convert_fp8_linear(self.controlnet, original_dtype)
             
             control_frames = controlnet["control_frames"].to(device).to(self.controlnet.dtype).contiguous()
             control_frames = torch.cat([control_frames] * 2) if do_classifier_free_guidance else control_frames
@@ -608,6 +707,17 @@ class CogVideoXPipeline(VideoSysPipeline):
             logger.info(f"Controlnet enabled with weights: {control_weights}")
             control_start = controlnet["control_start"]
             control_end = controlnet["control_end"]
+            if use_context_schedule:
+                # controlnet frames are not temporally compressed, so try to match the context frames that are
+                control_context_plan = ContextPlan(
+                    context,
+                    len(timesteps),
+                    control_frames.shape[1],
+                    context_frames * self.vae_scale_factor_temporal,
+                    context_stride * self.vae_scale_factor_temporal,
+                    context_overlap * self.vae_scale_factor_temporal,
+                    device=control_frames.device,
+                    )
         else:
             controlnet_states = None
             control_weights= None
@@ -621,87 +731,79 @@ class CogVideoXPipeline(VideoSysPipeline):
                 for param in module.parameters():
                     param.data = param.data.to(device)
 
+        profiler = profiler if profiler is not None else NULL_PROFILER
+        profiler.attach(self.transformer, self.controlnet if controlnet is not None else None)
+
+        if self.pab_config is not None:
+            self.transformer.pab_state = pab_state_for(self.pab_config, timesteps, self.transformer)
+        self.transformer.context_window = None
+
         # 10. Denoising loop
         with self.progress_bar(total=num_inference_steps) as progress_bar:    
             old_pred_original_sample = None # for DPM-solver++
             for i, t in enumerate(timesteps):
                 if self.interrupt:
                     continue
+                profiler.begin_step(i)
+
+                current_step_percentage = i / num_inference_steps
+                # outside of the cfg range the unconditional pass is skipped and only the conditional half of the inputs is used
+                step_cfg = do_classifier_free_guidance and cfg_start_percent <= current_step_percentage <= cfg_end_percent
+                step_cfg_mode = cfg_mode if step_cfg else "batched"
+                step_prompt_embeds = cfg_chunk(prompt_embeds, 1) if do_classifier_free_guidance and not step_cfg else prompt_embeds
+
                 if use_temporal_tiling and isinstance(self.scheduler, CogVideoXDDIMScheduler):
                     #temporal tiling code based on https://github.com/mayuelala/FollowYourEmoji/blob/main/models/video_pipeline.py
                     # =====================================================
-                    grid_ts = 0
-                    cur_t = 0
-                    while cur_t < latents.shape[1]:
-                        cur_t = max(grid_ts * t_tile_length - t_tile_overlap * grid_ts, 0) + t_tile_length
-                        grid_ts += 1
-
-                    all_t = latents.shape[1]
-                    latents_all_list = []
-                    # =====================================================
+                    latents_all = torch.zeros(latents.shape, device=latents.device, dtype=torch.float32)
 
-                    for t_i in range(grid_ts):
-                        if t_i < grid_ts - 1:
-                            ofs_t = max(t_i * t_tile_length - t_tile_overlap * t_i, 0)
-                        if t_i == grid_ts - 1:
-                            ofs_t = all_t - t_tile_length
-
-                        input_start_t = ofs_t
-                        input_end_t = ofs_t + t_tile_length
-
-                        #latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
-                        #latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-                        image_rotary_emb = (
-                            self._prepare_rotary_positional_embeddings(height, width, t_tile_length, device)
-                            if self.transformer.config.use_rotary_positional_embeddings
-                            else None
-                        )
+                    image_rotary_emb = (
+                        self._prepare_rotary_positional_embeddings(height, width, t_tile_length, device)
+                        if self.transformer.config.use_rotary_positional_embeddings
+                        else None
+                    )
 
-                        latents_tile = latents[:, input_start_t:input_end_t,:, :, :]
-                        latent_model_input_tile = torch.cat([latents_tile] * 2) if do_classifier_free_guidance else latents_tile
+                    for window_start, window_idx in context_plan.batches(i):
+                        self.transformer.context_window = context_plan.frames(i, window_start)
+                        latents_tile = gather_context_windows(latents, window_idx)
+                        latent_model_input_tile = torch.cat([latents_tile] * 2) if step_cfg else latents_tile
                         latent_model_input_tile = self.scheduler.scale_model_input(latent_model_input_tile, t)
+                        if image_cond_latents is not None:
+                            # every tile starts from the conditioning image, like the blended tiles of the other schedulers
+                            image_cond_tile = gather_context_windows(image_cond_latents, window_idx)
+                            image_cond_tile[:, 0] = image_cond_latents[:, 0]
+                            latent_image_input = torch.cat([image_cond_tile] * 2) if step_cfg else image_cond_tile
+                            latent_model_input_tile = torch.cat([latent_model_input_tile, latent_image_input], dim=2)
 
                         #t_input = t[None].to(device)
                         t_input = t.expand(latent_model_input_tile.shape[0]) # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
                 
                         # predict noise model_output
-                        noise_pred = self.transformer(
-                            hidden_states=latent_model_input_tile,
-                            encoder_hidden_states=prompt_embeds,
-                            timestep=t_input,
+                        noise_pred = cfg_forward(
+                            self._predict_noise,
+                            {"hidden_states": latent_model_input_tile, "encoder_hidden_states": step_prompt_embeds, "timestep": t_input},
+                            step_cfg_mode,
+                            out=cfg_noise_pred,
                             image_rotary_emb=image_rotary_emb,
-                            return_dict=False,
-                        )[0]
+                        )
+                        cfg_noise_pred = noise_pred if step_cfg_mode == "sequential" else cfg_noise_pred
                         noise_pred = noise_pred.float()                  
 
-                        if self.do_classifier_free_guidance:
-                            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                            noise_pred = noise_pred_uncond + self._guidance_scale * (noise_pred_text - noise_pred_uncond)
+                        if step_cfg:
+                            with profiler.section("cfg_combine"):
+                                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                                noise_pred = noise_pred_uncond + self._guidance_scale * (noise_pred_text - noise_pred_uncond)
 
                         # compute the previous noisy sample x_t -> x_t-1
-                        latents_tile = self.scheduler.step(noise_pred, t, latents_tile.to(self.vae.dtype), **extra_step_kwargs, return_dict=False)[0]
-                        latents_all_list.append(latents_tile)
+                        with profiler.section("scheduler_step"):
+                            latents_tile = self.scheduler.step(noise_pred, t, latents_tile.to(self.vae.dtype), **extra_step_kwargs, return_dict=False)[0]
+                        # add the weighted tile contribution to overall latents
+                        with profiler.section("context_blend"):
+                            scatter_add_context_windows(latents_all, latents_tile, window_idx, context_plan.weights(i))
 
                     # ==========================================
-                    latents_all = torch.zeros(latents.shape, device=latents.device, dtype=self.vae.dtype)
-                    contributors = torch.zeros(latents.shape, device=latents.device, dtype=self.vae.dtype)
-                    # Add each tile contribution to overall latents
-                    for t_i in range(grid_ts):
-                        if t_i < grid_ts - 1:
-                            ofs_t = max(t_i * t_tile_length - t_tile_overlap * t_i, 0)
-                        if t_i == grid_ts - 1:
-                            ofs_t = all_t - t_tile_length
-
-                        input_start_t = ofs_t
-                        input_end_t = ofs_t + t_tile_length
-
-                        latents_all[:, input_start_t:input_end_t,:, :, :] += latents_all_list[t_i] * t_tile_weights
-                        contributors[:, input_start_t:input_end_t,:, :, :] += t_tile_weights
-                    
-                    latents_all /= contributors
-
-                    latents = latents_all
+                    with profiler.section("context_blend"):
+                        latents = (latents_all / context_plan.counts(i).view(1, -1, 1, 1, 1)).to(self.vae.dtype)
                     #print("latents",latents.shape)
                     # start diff diff
                     if i < len(timesteps) - 1 and self.original_mask is not None:
@@ -721,20 +823,16 @@ class CogVideoXPipeline(VideoSysPipeline):
                         comfy_pbar.update(1)
                     # ==========================================
                 elif use_context_schedule:
-                    latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+                    latent_model_input = torch.cat([latents] * 2) if step_cfg else latents
                     latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-                    counter = torch.zeros_like(latent_model_input)
-                    noise_pred = torch.zeros_like(latent_model_input)
+                    if context_noise_pred is None or context_noise_pred.shape != latent_model_input.shape:
+                        context_noise_pred = torch.zeros(latent_model_input.shape, device=latent_model_input.device, dtype=torch.float32)
+                    noise_pred = context_noise_pred.zero_()
                     
                     if image_cond_latents is not None:
-                        latent_image_input = torch.cat([image_cond_latents] * 2) if do_classifier_free_guidance else image_cond_latents
+                        latent_image_input = torch.cat([image_cond_latents] * 2) if step_cfg else image_cond_latents
                         latent_model_input = torch.cat([latent_model_input, latent_image_input], dim=2)
 
-                    # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-                    timestep = t.expand(latent_model_input.shape[0])
-
-                    current_step_percentage = i / num_inference_steps
-
                     # use same rotary embeddings for all context windows
                     image_rotary_emb = (
                             self._prepare_rotary_positional_embeddings(height, width, context_frames, device)
@@ -742,97 +840,83 @@ class CogVideoXPipeline(VideoSysPipeline):
                             else None
                         )
 
-                    context_queue = list(context(
-                        i, num_inference_steps, latents.shape[1], context_frames, context_stride, context_overlap,
-                    ))
-
-                    if controlnet is not None:
-                        # controlnet frames are not temporally compressed, so try to match the context frames that are
-                        control_context_queue = list(context(
-                            i, 
-                            num_inference_steps, 
-                            control_frames.shape[1], 
-                            context_frames * self.vae_scale_factor_temporal, 
-                            context_stride * self.vae_scale_factor_temporal, 
-                            context_overlap * self.vae_scale_factor_temporal,
-                        ))
-
-                        for c, control_c in zip(context_queue, control_context_queue):
-                            partial_latent_model_input = latent_model_input[:, c, :, :, :]
-                            partial_control_frames = control_frames[:, control_c, :, :, :]
-
-                            controlnet_states = None
-                        
-                            if (control_start <= current_step_percentage <= control_end):
-                                # extract controlnet hidden state
-                                controlnet_states = self.controlnet(
-                                    hidden_states=partial_latent_model_input,
-                                    encoder_hidden_states=prompt_embeds,
-                                    image_rotary_emb=image_rotary_emb,
-                                    controlnet_states=partial_control_frames,
-                                    timestep=timestep,
-                                    return_dict=False,
-                                )[0]
-                                if isinstance(controlnet_states, (tuple, list)):
-                                    controlnet_states = [x.to(dtype=self.controlnet.dtype) for x in controlnet_states]
-                                else:
-                                    controlnet_states = controlnet_states.to(dtype=self.controlnet.dtype)
-    
-                            # predict noise model_output
-                            noise_pred[:, c, :, :, :] += self.transformer(
-                                hidden_states=partial_latent_model_input,
-                                encoder_hidden_states=prompt_embeds,
-                                timestep=timestep,
-                                image_rotary_emb=image_rotary_emb,
-                                return_dict=False,
-                                controlnet_states=controlnet_states,
-                                controlnet_weights=control_weights,
-                            )[0]
-
-                            counter[:, c, :, :, :] += 1
-                            noise_pred = noise_pred.float()
-                    else:
-                        for c in context_queue:
-                            partial_latent_model_input = latent_model_input[:, c, :, :, :]
-                            if (tora is not None and tora["start_percent"] <= current_step_percentage <= tora["end_percent"]):
-                                if do_classifier_free_guidance:
-                                    partial_video_flow_features = tora["video_flow_features"][:, c, :, :, :].repeat(1, 2, 1, 1, 1).contiguous()
-                                else:
-                                    partial_video_flow_features = tora["video_flow_features"][:, c, :, :, :]
-                            else:
-                                partial_video_flow_features = None
-    
-                            # predict noise model_output
-                            noise_pred[:, c, :, :, :] += self.transformer(
-                                hidden_states=partial_latent_model_input,
-                                encoder_hidden_states=prompt_embeds,
-                                timestep=timestep,
-                                image_rotary_emb=image_rotary_emb,
-                                video_flow_features=partial_video_flow_features,
-                                return_dict=False
-                            )[0]
-
-                            counter[:, c, :, :, :] += 1
-                            noise_pred = noise_pred.float()
+                    # stack up to context_batch_size windows along the batch dimension for a single forward pass
+                    for batch_start, window_idx in context_plan.batches(i, context_batch_size):
+                        num_windows = window_idx.shape[0]
+                        self.transformer.context_window = context_plan.frames(i, batch_start, num_windows)
+
+                        partial_latent_model_input = gather_context_windows(latent_model_input, window_idx)
+                        if image_cond_latents is not None:
+                            # every tile starts from the conditioning image, like the windows of the Fun inpaint pipeline
+                            partial_latent_model_input.unflatten(0, (num_windows, -1))[:, :, 0, latents.shape[2]:] = latent_model_input[:, 0, latents.shape[2]:]
+                        partial_prompt_embeds = step_prompt_embeds.repeat(num_windows, 1, 1) if num_windows > 1 else step_prompt_embeds
+                        # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
+                        timestep = t.expand(partial_latent_model_input.shape[0])
+
+                        partial_control_frames = None
+                        if controlnet is not None and (control_start <= current_step_percentage <= control_end):
+                            control_window_idx = control_context_plan.windows(i)[batch_start:batch_start + num_windows]
+                            step_control_frames = cfg_chunk(control_frames, 1) if do_classifier_free_guidance and not step_cfg else control_frames
+                            partial_control_frames = gather_context_windows(step_control_frames, control_window_idx)
+
+                        if (tora is not None and tora["start_percent"] <= current_step_percentage <= tora["end_percent"]):
+                            # tora features are laid out as (B T) on dim 1, keep the (window, cfg batch) ordering of the latents
+                            partial_video_flow_features = tora["video_flow_features"][:, window_idx]
+                            if step_cfg:
+                                partial_video_flow_features = torch.stack([partial_video_flow_features] * 2, dim=2)
+                            partial_video_flow_features = partial_video_flow_features.flatten(1, -4).contiguous()
+                        else:
+                            partial_video_flow_features = None
+
+                        # predict noise model_output, the cfg halves of every window are split apart in sequential mode
+                        window_noise_pred = cfg_forward(
+                            self._predict_noise,
+                            {
+                                "hidden_states": partial_latent_model_input,
+                                "encoder_hidden_states": partial_prompt_embeds,
+                                "timestep": timestep,
+                                "control_frames": partial_control_frames,
+                                "video_flow_features": partial_video_flow_features,
+                            },
+                            step_cfg_mode,
+                            groups=num_windows,
+                            cfg_dims={"video_flow_features": 1},
+                            out=cfg_noise_pred,
+                            image_rotary_emb=image_rotary_emb,
+                            control_weights=control_weights,
+                        )
+                        cfg_noise_pred = window_noise_pred if step_cfg_mode == "sequential" else cfg_noise_pred
+
+                        with profiler.section("context_blend"):
+                            scatter_add_context_windows(noise_pred, window_noise_pred, window_idx, context_plan.weights(i))
                         
-                    noise_pred /= counter
-                    if do_classifier_free_guidance:
-                        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                        noise_pred = noise_pred_uncond + self._guidance_scale * (noise_pred_text - noise_pred_uncond)
+                    with profiler.section("context_blend"):
+                        noise_pred = noise_pred / context_plan.counts(i).view(1, -1, 1, 1, 1)
+
+                    if isinstance(self.scheduler, CogVideoXDPMScheduler):
+                        self._guidance_scale = 1 + guidance_scale * (
+                            (1 - math.cos(math.pi * ((num_inference_steps - t.item()) / num_inference_steps) ** 5.0)) / 2
+                        )
+
+                    if step_cfg:
+                        with profiler.section("cfg_combine"):
+                            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                            noise_pred = noise_pred_uncond + self._guidance_scale * (noise_pred_text - noise_pred_uncond)
                        
                     # compute the previous noisy sample x_t -> x_t-1
-                    if not isinstance(self.scheduler, CogVideoXDPMScheduler):
-                        latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
-                    else:
-                        latents, old_pred_original_sample = self.scheduler.step(
-                            noise_pred,
-                            old_pred_original_sample,
-                            t,
-                            timesteps[i - 1] if i > 0 else None,
-                            latents,
-                            **extra_step_kwargs,
-                            return_dict=False,
-                        )
+                    with profiler.section("scheduler_step"):
+                        if not isinstance(self.scheduler, CogVideoXDPMScheduler):
+                            latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
+                        else:
+                            latents, old_pred_original_sample = self.scheduler.step(
+                                noise_pred,
+                                old_pred_original_sample,
+                                t,
+                                timesteps[i - 1] if i > 0 else None,
+                                latents,
+                                **extra_step_kwargs,
+                                return_dict=False,
+                            )
                     latents = latents.to(prompt_embeds.dtype)
 
                     if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
@@ -840,48 +924,41 @@ class CogVideoXPipeline(VideoSysPipeline):
                         comfy_pbar.update(1)
     
                 else:
-                    latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+                    latent_model_input = torch.cat([latents] * 2) if step_cfg else latents
                     latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
 
                     if image_cond_latents is not None:
-                        latent_image_input = torch.cat([image_cond_latents] * 2) if do_classifier_free_guidance else image_cond_latents
+                        latent_image_input = torch.cat([image_cond_latents] * 2) if step_cfg else image_cond_latents
                         latent_model_input = torch.cat([latent_model_input, latent_image_input], dim=2)
 
                     # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
                     timestep = t.expand(latent_model_input.shape[0])
 
-                    current_step_percentage = i / num_inference_steps
-
-                    if controlnet is not None:
-                        controlnet_states = None
-                        if (control_start <= current_step_percentage <= control_end):
-                            # extract controlnet hidden state
-                            controlnet_states = self.controlnet(
-                                hidden_states=latent_model_input,
-                                encoder_hidden_states=prompt_embeds,
-                                image_rotary_emb=image_rotary_emb,
-                                controlnet_states=control_frames,
-                                timestep=timestep,
-                                return_dict=False,
-                            )[0]
-                            if isinstance(controlnet_states, (tuple, list)):
-                                controlnet_states = [x.to(dtype=self.vae.dtype) for x in controlnet_states]
-                            else:
-                                controlnet_states = controlnet_states.to(dtype=self.vae.dtype)
+                    step_control_frames = None
+                    if controlnet is not None and (control_start <= current_step_percentage <= control_end):
+                        step_control_frames = cfg_chunk(control_frames, 1) if do_classifier_free_guidance and not step_cfg else control_frames
 
+                    step_video_flow_features = None
+                    if tora is not None and tora["start_percent"] <= current_step_percentage <= tora["end_percent"]:
+                        step_video_flow_features = cfg_chunk(video_flow_features, 1, dim=1) if do_classifier_free_guidance and not step_cfg else video_flow_features
 
                     # predict noise model_output
-                    noise_pred = self.transformer(
-                        hidden_states=latent_model_input,
-                        encoder_hidden_states=prompt_embeds,
-                        timestep=timestep,
+                    noise_pred = cfg_forward(
+                        self._predict_noise,
+                        {
+                            "hidden_states": latent_model_input,
+                            "encoder_hidden_states": step_prompt_embeds,
+                            "timestep": timestep,
+                            "control_frames": step_control_frames,
+                            "video_flow_features": step_video_flow_features,
+                        },
+                        step_cfg_mode,
+                        cfg_dims={"video_flow_features": 1},
+                        out=cfg_noise_pred,
                         image_rotary_emb=image_rotary_emb,
-                        return_dict=False,
-                        controlnet_states=controlnet_states,
-                        controlnet_weights=control_weights,
-                        video_flow_features=video_flow_features if (tora is not None and tora["start_percent"] <= current_step_percentage <= tora["end_percent"]) else None,
-
-                    )[0]
+                        control_weights=control_weights,
+                    )
+                    cfg_noise_pred = noise_pred if step_cfg_mode == "sequential" else cfg_noise_pred
                     noise_pred = noise_pred.float()
 
                     if isinstance(self.scheduler, CogVideoXDPMScheduler):
@@ -889,23 +966,25 @@ class CogVideoXPipeline(VideoSysPipeline):
                             (1 - math.cos(math.pi * ((num_inference_steps - t.item()) / num_inference_steps) ** 5.0)) / 2
                         )
                     
-                    if do_classifier_free_guidance:
-                        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                        noise_pred = noise_pred_uncond + self._guidance_scale * (noise_pred_text - noise_pred_uncond)
+                    if step_cfg:
+                        with profiler.section("cfg_combine"):
+                            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                            noise_pred = noise_pred_uncond + self._guidance_scale * (noise_pred_text - noise_pred_uncond)
 
                     # compute the previous noisy sample x_t -> x_t-1
-                    if not isinstance(self.scheduler, CogVideoXDPMScheduler):
-                        latents = self.scheduler.step(noise_pred, t, latents.to(self.vae.dtype), **extra_step_kwargs, return_dict=False)[0]
-                    else:
-                        latents, old_pred_original_sample = self.scheduler.step(
-                            noise_pred,
-                            old_pred_original_sample,
-                            t,
-                            timesteps[i - 1] if i > 0 else None,
-                            latents.to(self.vae.dtype),
-                            **extra_step_kwargs,
-                            return_dict=False,
-                        )
+                    with profiler.section("scheduler_step"):
+                        if not isinstance(self.scheduler, CogVideoXDPMScheduler):
+                            latents = self.scheduler.step(noise_pred, t, latents.to(self.vae.dtype), **extra_step_kwargs, return_dict=False)[0]
+                        else:
+                            latents, old_pred_original_sample = self.scheduler.step(
+                                noise_pred,
+                                old_pred_original_sample,
+                                t,
+                                timesteps[i - 1] if i > 0 else None,
+                                latents.to(self.vae.dtype),
+                                **extra_step_kwargs,
+                                return_dict=False,
+                            )
                     latents = latents.to(prompt_embeds.dtype)
                     # start diff diff
                     if i < len(timesteps) - 1 and self.original_mask is not None:
@@ -923,7 +1002,17 @@ class CogVideoXPipeline(VideoSysPipeline):
                     if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
                         progress_bar.update()
                         comfy_pbar.update(1)
-            
+
+                profiler.end_step()
+
+        profiler.detach()
+
+        self.transformer.context_window = None
+        if self.pab_config is not None:
+            pab_state = self.transformer.pab_state
+            if pab_state is not None and pab_state.evicted:
+                logger.warning(f"PAB dropped {pab_state.evicted} stored MLP outputs before their broadcast, raise mlp_cache_slots or set it to 0")
+            self.transformer.pab_state = None
 
         # Offload all models
         self.maybe_free_model_hooks()
@@ -0,0 +1,191 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+import torch
+
+class CpuTimer:
+    """Wall clock only, the device side timing is a no-op so profiling works without a GPU"""
+    name = "cpu"
+
+    def start(self):
+        return None
+
+    def stop(self, start):
+        return None
+
+    def elapsed_ms(self, record) -> Optional[float]:
+        return None
+
+    def reset_peak_memory(self):
+        pass
+
+    def peak_memory(self) -> Optional[int]:
+        return None
+
+class CudaEventTimer:
+    """Times the work queued on the current stream with CUDA events, resolved lazily so recording never syncs"""
+    name = "cuda"
+
+    def __init__(self, device=None):
+        self.device = torch.device(device) if device is not None else torch.device("cuda", torch.cuda.current_device())
+
+    def start(self):
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def stop(self, start):
+        end = torch.cuda.Event(enable_timing=True)
+        end.record()
+        return (start, end)
+
+    def elapsed_ms(self, record) -> Optional[float]:
+        start, end = record
+        end.synchronize()
+        return start.elapsed_time(end)
+
+    def reset_peak_memory(self):
+        torch.cuda.reset_peak_memory_stats(self.device)
+
+    def peak_memory(self) -> Optional[int]:
+        return torch.cuda.max_memory_allocated(self.device)
+
+
+class SamplerProfiler:
+    """
+    Opt-in per step timing of the sampling loop.
+    Sections are timed both on the host (wall time) and on the device (CUDA events), per transformer block, ControlNet
+    and Tora fuser through module hooks, and around the scheduler step, CFG combine and context blending explicitly.
+    """
+    enabled = True
+
+    def __init__(self, backend: str = "cuda", device=None):
+        if backend == "cuda" and torch.cuda.is_available():
+            self.timer = CudaEventTimer(device)
+        else:
+            self.timer = CpuTimer()
+        self.steps = []
+        self._step = None
+        self._open = defaultdict(list)
+        self._hooks = []
+
+    @contextmanager
+    def section(self, name: str):
+        self._begin(name)
+        try:
+            yield
+        finally:
+            self._end(name)
+
+    def _begin(self, name: str):
+        self._open[name].append((time.perf_counter(), self.timer.start()))
+
+    def _end(self, name: str):
+        if not self._open[name]:
+            return
+        wall_start, device_start = self._open[name].pop()
+        record = (time.perf_counter() - wall_start, self.timer.stop(device_start))
+        if self._step is not None:
+            self._step["records"][name].append(record)
+
+    def begin_step(self, step: int):
+        self.timer.reset_peak_memory()
+        self._step = {"step": step, "wall_start": time.perf_counter(), "records": defaultdict(list)}
+
+    def end_step(self):
+        if self._step is None:
+            return
+        self._step["wall_s"] = time.perf_counter() - self._step.pop("wall_start")
+        self._step["peak_memory_allocated"] = self.timer.peak_memory()
+        self.steps.append(self._step)
+        self._step = None
+
+    def _hook_module(self, module: torch.nn.Module, name: str):
+        self._hooks.append(module.register_forward_pre_hook(lambda *args: self._begin(name)))
+        self._hooks.append(module.register_forward_hook(lambda *args: self._end(name)))
+
+    def attach(self, transformer=None, controlnet=None):
+        """Registers timing hooks on the transformer blocks, the Tora fusers and the ControlNet"""
+        self.detach()
+        if transformer is not None:
+            self._hook_module(transformer, "transformer")
+            for i, block in enumerate(transformer.transformer_blocks):
+                self._hook_module(block, f"transformer_block_{i}")
+            for i, fuser in enumerate(getattr(transformer, "fuser_list", None) or []):
+                self._hook_module(fuser, f"tora_fuser_{i}")
+        if controlnet is not None:
+            self._hook_module(controlnet, "controlnet")
+
+    def detach(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def report(self) -> dict:
+        sections = {}
+        steps = []
+        for step in self.steps:
+            step_sections = {}
+            for name, records in step["records"].items():
+                wall_ms = sum(wall for wall, _ in records) * 1000
+                device_times = [self.timer.elapsed_ms(device) for _, device in records if device is not None]
+                device_ms = sum(device_times) if device_times else None
+                step_sections[name] = {"count": len(records), "wall_ms": wall_ms, "device_ms": device_ms}
+
+                total = sections.setdefault(name, {"count": 0, "wall_ms": 0.0, "device_ms": None})
+                total["count"] += len(records)
+                total["wall_ms"] += wall_ms
+                if device_ms is not None:
+                    total["device_ms"] = (total["device_ms"] or 0.0) + device_ms
+            steps.append({
+                "step": step["step"],
+                "wall_ms": step["wall_s"] * 1000,
+                "peak_memory_allocated": step["peak_memory_allocated"],
+                "sections": step_sections,
+            })
+        for total in sections.values():
+            total["wall_ms_mean"] = total["wall_ms"] / total["count"]
+            total["device_ms_mean"] = total["device_ms"] / total["count"] if total["device_ms"] is not None else None
+
+        peaks = [step["peak_memory_allocated"] for step in steps if step["peak_memory_allocated"] is not None]
+        return {
+            "backend": self.timer.name,
+            "num_steps": len(steps),
+            "total_wall_ms": sum(step["wall_ms"] for step in steps),
+            "peak_memory_allocated": max(peaks) if peaks else None,
+            "sections": sections,
+            "steps": steps,
+        }
+
+    def save(self, path: str) -> dict:
+        report = self.report()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+class NullProfiler:
+    """Stand-in used when profiling is off, every call is a no-op"""
+    enabled = False
+
+    def section(self, name: str):
+        return nullcontext()
+
+    def begin_step(self, step: int):
+        pass
+
+    def end_step(self):
+        pass
+
+    def attach(self, transformer=None, controlnet=None):
+        pass
+
+    def detach(self):
+        pass
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import torch
+
+from .utils import log
+
+# a few dozen prompt/negative prompt pairs cover most batch jobs, a 226x4096 bf16 embedding is ~1.8MB
+DEFAULT_MAX_ENTRIES = 64
+
+def _sample_bytes(tensor: torch.Tensor, num_elements: int = 4096) -> bytes:
+    """Up to `num_elements` values spread evenly over the whole tensor, so a change anywhere in it likely shows"""
+    if tensor.device.type == "meta" or tensor.numel() == 0:
+        return b""
+    stride = max(1, tensor.numel() // num_elements)
+    sample = tensor.detach().reshape(-1)[::stride][:num_elements].to("cpu", torch.float32)
+    return sample.numpy().tobytes()
+
+def module_fingerprint(module: torch.nn.Module) -> str:
+    """
+    Cheap identity of a text encoder's weights: every tensor name, shape and dtype plus a strided sample of the values
+    of every tensor, so fine-tunes of the same encoder get different keys. Computed once per module, the encoders are
+    never trained in place.
+    """
+    fingerprint = getattr(module, "_prompt_cache_fingerprint", None)
+    if fingerprint is not None:
+        return fingerprint
+    h = hashlib.sha256(type(module).__name__.encode())
+    tensors = list(module.state_dict().items())
+    for name, tensor in tensors:
+        h.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        h.update(_sample_bytes(tensor))
+    fingerprint = h.hexdigest()
+    module._prompt_cache_fingerprint = fingerprint
+    return fingerprint
+
+def _hash_nested(h, value):
+    if isinstance(value, torch.Tensor):
+        h.update(f"{tuple(value.shape)}:{value.dtype}".encode())
+        h.update(_sample_bytes(value))
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _hash_nested(h, v)
+    elif isinstance(value, dict):
+        for k in sorted(value, key=str):
+            h.update(str(k).encode())
+            _hash_nested(h, value[k])
+    else:
+        h.update(repr(value).encode())
+
+def patches_fingerprint(patches: dict) -> str:
+    """Identity of ComfyUI model patcher patches (LoRAs applied to a CLIP), weights are only patched while loaded"""
+    h = hashlib.sha256()
+    _hash_nested(h, patches or {})
+    return h.hexdigest()
+
+class PromptEmbeddingCache:
+    """
+    Content addressed cache of text encoder outputs, keyed by (encoder identity, prompt, max sequence length, dtype).
+    Entries live in an in-memory LRU and, when a cache directory is set, as safetensors files that survive restarts.
+    Embeddings are stored on the CPU, callers get a copy so in place edits never leak back into the cache.
+    """
+    def __init__(self, cache_dir: Optional[str] = None, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(encoder_id: str, prompt: str, max_sequence_length: int, dtype=None) -> str:
+        payload = json.dumps([encoder_id, prompt, max_sequence_length, str(dtype)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Optional[str]:
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f"{key}.safetensors")
+
+    def _remember(self, key: str, embeds: torch.Tensor):
+        with self._lock:
+            self._entries[key] = embeds
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str, device=None) -> Optional[torch.Tensor]:
+        with self._lock:
+            embeds = self._entries.get(key)
+            if embeds is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if embeds is None:
+            path = self._path(key)
+            if path is None or not os.path.isfile(path):
+                with self._lock:
+                    self.misses += 1
+                return None
+            from safetensors.torch import load_file
+            try:
+                embeds = load_file(path)["embeds"]
+            except Exception as e:
+                log.warning(f"Ignoring unreadable prompt embedding cache file {path}: {e}")
+                with self._lock:
+                    self.misses += 1
+                return None
+            self._remember(key, embeds)
+            with self._lock:
+                self.disk_hits += 1
+        return embeds.to(device, copy=True) if device is not None else embeds.clone()
+
+    def put(self, key: str, embeds: torch.Tensor, metadata: Optional[dict] = None):
+        embeds = embeds.detach().to("cpu", copy=True).contiguous()
+        self._remember(key, embeds)
+        path = self._path(key)
+        if path is None:
+            return
+        from safetensors.torch import save_file
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write then rename, a concurrent reader never sees a partial file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            save_file({"embeds": embeds}, tmp_path, metadata={k: str(v) for k, v in (metadata or {}).items()})
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning(f"Could not write prompt embedding cache file {path}: {e}")
+
+    def set_cache_dir(self, cache_dir: Optional[str]):
+        self.cache_dir = cache_dir
+
+    def set_max_entries(self, max_entries: int):
+        with self._lock:
+            self.max_entries = max_entries
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self, disk: bool = False):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+        if disk and self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".safetensors"):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "cache_dir": self.cache_dir,
+            }
+
+_prompt_embedding_cache = PromptEmbeddingCache()
+
+def get_prompt_embedding_cache() -> PromptEmbeddingCache:
+    return _prompt_embedding_cache
@@ -0,0 +1,130 @@
+"""
+Converts a diffusers CogVideoX transformer checkpoint into the quantized safetensors layout read by
+DownloadAndLoadCogVideoGGUFModel (`<layer>.Q4_0_qweight` / `<layer>.Q8_0_qweight` packed blocks, see mz_gguf_loader).
+
+Works on any CogVideoXTransformer3DModel state dict, including the Fun, I2V, LoRA merged and block pruned ones, the
+tensors are read, quantized and written one at a time so the peak RAM stays around the size of the largest tensor.
+
+Usage:
+
+    python quantize_gguf.py --input /path/to/CogVideoX-5b/transformer --output models/CogVideo/GGUF/CogVideoX_5b_mymodel_GGUF_Q8_0.safetensors --qtype Q8_0
+
+The loader picks the model config from the file name, keep "5b"/"2b" and "fun", "I2V", "Interpolation", "Tora" or
+"Pose" in it the same way as the released files.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import struct
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mz_gguf_loader import QUANT_TYPES, GGML_QUANT_SIZES, quant_shape_to_byte_shape  # noqa: E402
+
+# the released files quantize the linear layers of the transformer blocks and keep the embeddings and output head
+DEFAULT_PATTERN = r"^transformer_blocks\.\d+\..*\.weight$"
+
+SAFETENSORS_DTYPES = {
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.float8_e4m3fn: "F8_E4M3",
+    torch.uint8: "U8",
+    torch.int8: "I8",
+}
+TORCH_DTYPES = {v: k for k, v in SAFETENSORS_DTYPES.items()}
+
+DTYPES = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+def find_checkpoint_files(path):
+    if os.path.isfile(path):
+        return [path]
+    files = sorted(glob.glob(os.path.join(path, "*.safetensors")))
+    if not files:
+        raise FileNotFoundError(f"No .safetensors files found in {path}")
+    return files
+
+def plan_tensors(files, qtype, pattern, dtype=None):
+    """Reads the headers only and decides the output name, dtype and shape of every tensor"""
+    from safetensors import safe_open
+    block_size, _ = GGML_QUANT_SIZES[qtype]
+    regex = re.compile(pattern)
+    plan = []
+    for file in files:
+        with safe_open(file, framework="pt") as f:
+            for key in f.keys():
+                tensor_slice = f.get_slice(key)
+                shape = tuple(tensor_slice.get_shape())
+                entry = {"file": file, "key": key, "name": key, "quantize": False, "shape": shape}
+                if key.endswith(".weight") and len(shape) == 2 and shape[-1] % block_size == 0 and regex.search(key):
+                    entry.update(name=f"{key[:-len('.weight')]}.{qtype}_qweight", quantize=True, dtype=torch.uint8, shape=quant_shape_to_byte_shape(shape, qtype))
+                else:
+                    entry["dtype"] = dtype or TORCH_DTYPES[tensor_slice.get_dtype()]
+                plan.append(entry)
+    # WQLinear_GGUF keeps its bias in fp16
+    quantized = {entry["key"][:-len(".weight")] for entry in plan if entry["quantize"]}
+    for entry in plan:
+        if entry["key"].endswith(".bias") and entry["key"][:-len(".bias")] in quantized:
+            entry["dtype"] = torch.float16
+    return plan
+
+def write_quantized(plan, output, qtype, metadata):
+    """Writes the safetensors header up front from the plan, then streams the tensors one at a time"""
+    header = {"__metadata__": metadata}
+    offset = 0
+    for entry in plan:
+        nbytes = torch.Size(entry["shape"]).numel() * torch.empty((), dtype=entry["dtype"]).element_size()
+        header[entry["name"]] = {"dtype": SAFETENSORS_DTYPES[entry["dtype"]], "shape": list(entry["shape"]), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    from safetensors import safe_open
+    quantize = QUANT_TYPES[qtype].quantize
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    tmp_output = f"{output}.tmp"
+    handles = {}
+    with open(tmp_output, "wb") as out:
+        out.write(struct.pack("<Q", len(header_bytes)))
+        out.write(header_bytes)
+        for i, entry in enumerate(plan):
+            if entry["file"] not in handles:
+                handles[entry["file"]] = safe_open(entry["file"], framework="pt")
+            tensor = handles[entry["file"]].get_tensor(entry["key"])
+            tensor = quantize(tensor) if entry["quantize"] else tensor.to(entry["dtype"])
+            out.write(tensor.contiguous().view(torch.uint8).numpy().tobytes())
+            print(f"[{i + 1}/{len(plan)}] {entry['name']} {tuple(tensor.shape)} {tensor.dtype}", flush=True)
+            del tensor
+    handles.clear()
+    os.replace(tmp_output, output)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quantize a CogVideoX transformer to Q4_0/Q8_0 safetensors for the GGUF loader")
+    parser.add_argument("--input", required=True, help="transformer folder with diffusers .safetensors shards, or a single .safetensors file")
+    parser.add_argument("--output", required=True, help="output .safetensors path")
+    parser.add_argument("--qtype", default="Q4_0", choices=[name for name, q in QUANT_TYPES.items() if q.quantize is not None])
+    parser.add_argument("--dtype", default=None, choices=list(DTYPES), help="cast the tensors left unquantized, keeps the source dtype by default")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN, help="regex of the weight names to quantize, only 2D weights divisible by the block size are")
+    args = parser.parse_args(argv)
+
+    files = find_checkpoint_files(args.input)
+    plan = plan_tensors(files, args.qtype, args.pattern, DTYPES[args.dtype] if args.dtype else None)
+    num_quantized = sum(1 for entry in plan if entry["quantize"])
+    if num_quantized == 0:
+        raise ValueError(f"No weights matched {args.pattern}, nothing to quantize")
+    print(f"Quantizing {num_quantized} of {len(plan)} tensors to {args.qtype}")
+
+    metadata = {"qtype": args.qtype, "source": os.path.basename(os.path.normpath(args.input))}
+    write_quantized(plan, args.output, args.qtype, metadata)
+    print(f"Saved {args.output} ({os.path.getsize(args.output) / 1024**3:.2f} GB)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import torch
+from diffusers.models.embeddings import get_3d_rotary_pos_embed
+
+# Most jobs reuse a handful of resolutions/frame counts, keep a small number of device resident tables around
+DEFAULT_MAX_ENTRIES = 16
+
+class RotaryEmbeddingCache:
+    """
+    LRU cache of device resident (cos, sin) tables from `get_3d_rotary_pos_embed`.
+    Shared by all the pipelines so the host side computation and the host to device copy only happen once per shape.
+    Returned tensors are shared between callers and must not be modified in place.
+    """
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        embed_dim: int,
+        crops_coords: Tuple[Tuple[int, int], Tuple[int, int]],
+        grid_size: Tuple[int, int],
+        temporal_size: int,
+        device: torch.device,
+        dtype: Optional[torch.dtype] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        device = torch.device(device)
+        key = (embed_dim, tuple(map(tuple, crops_coords)), tuple(grid_size), temporal_size, str(device), dtype)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        freqs_cos, freqs_sin = get_3d_rotary_pos_embed(
+            embed_dim=embed_dim,
+            crops_coords=crops_coords,
+            grid_size=grid_size,
+            temporal_size=temporal_size,
+            use_real=True,
+        )
+        freqs_cos = freqs_cos.to(device=device, dtype=dtype)
+        freqs_sin = freqs_sin.to(device=device, dtype=dtype)
+
+        with self._lock:
+            self._entries[key] = (freqs_cos, freqs_sin)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return freqs_cos, freqs_sin
+
+    def set_max_entries(self, max_entries: int):
+        with self._lock:
+            self.max_entries = max_entries
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+ROTARY_EMB_CACHE = RotaryEmbeddingCache()
+
+def get_rotary_emb_cache() -> RotaryEmbeddingCache:
+    return ROTARY_EMB_CACHE
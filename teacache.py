@@ -0,0 +1,116 @@
+import torch
+
+class TeaCachePolicy:
+    """
+    Adaptive step skipping (TeaCache, https://github.com/ali-vilab/TeaCache). Every call the first block's timestep
+    modulated input is compared to the previous call's, the relative L1 changes are accumulated, and while the sum
+    stays under `threshold` the transformer blocks are skipped and the residual of the last full pass is added back
+    instead. Calls before `start_step` and after `end_step` (-1 for the last step) always run the blocks, and
+    `max_consecutive_skips` (0 for no limit) caps how many calls in a row can reuse the same residual.
+    """
+    def __init__(self, threshold: float = 0.1, start_step: int = 0, end_step: int = -1, max_consecutive_skips: int = 0):
+        self.threshold = threshold
+        self.start_step = start_step
+        self.end_step = end_step
+        self.max_consecutive_skips = max_consecutive_skips
+
+    def __repr__(self):
+        return (f"TeaCachePolicy(threshold={self.threshold}, start_step={self.start_step}, end_step={self.end_step}, "
+                f"max_consecutive_skips={self.max_consecutive_skips})")
+
+class TeaCacheWindow:
+    """Skip state of one context window, or of the whole video"""
+    def __init__(self):
+        self.previous_input = None
+        self.residual = None
+        # kept on the device, only the skip decision is read back
+        self.accumulated_change = None
+        self.consecutive_skips = 0
+        self.skip = False
+
+    def store_residual(self, hidden_states_in: torch.Tensor, hidden_states_out: torch.Tensor):
+        self.residual = hidden_states_out - hidden_states_in
+
+    def apply_residual(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return hidden_states + self.residual
+
+class TeaCacheState:
+    """
+    TeaCache state of a sampling run. Like FasterCache, the step counter advances when the timestep changes and each
+    call keeps its own inputs and residual, keyed by the frames it denoises and its position among the calls on those
+    frames, so the shifting context schedules never compare or reuse the inputs of another part of the video.
+    """
+    def __init__(self, policy: TeaCachePolicy):
+        self.policy = policy
+        self.windows = {}
+        self.step = -1
+        self.calls = 0
+        self.skipped_calls = 0
+        self.skipped_steps = 0
+        self._timestep = None
+        self._step_calls = {}
+        self._step_skipped = True
+
+    def begin_call(self, timestep, frames=None) -> TeaCacheWindow:
+        timestep = float(timestep.flatten()[0]) if torch.is_tensor(timestep) else float(timestep)
+        if self.step < 0 or timestep != self._timestep:
+            self._end_step()
+            self.step += 1
+        self._timestep = timestep
+        call = self._step_calls.get(frames, 0)
+        self._step_calls[frames] = call + 1
+        window = self.windows.get((frames, call))
+        if window is None:
+            window = self.windows[(frames, call)] = TeaCacheWindow()
+        return window
+
+    def _end_step(self):
+        if self.step >= 0 and self._step_skipped:
+            self.skipped_steps += 1
+        self._step_skipped = True
+        if self._step_calls:
+            # windows the step didn't visit have nothing left to compare against
+            visited = {(frames, call) for frames, calls in self._step_calls.items() for call in range(calls)}
+            for window_id in [window_id for window_id in self.windows if window_id not in visited]:
+                del self.windows[window_id]
+        self._step_calls = {}
+
+    def decide(self, window: TeaCacheWindow, modulated_input: torch.Tensor) -> bool:
+        """Decides if the call can skip the transformer blocks, from the change of its modulated input"""
+        policy = self.policy
+        previous_input = window.previous_input
+        window.previous_input = modulated_input.detach().clone()
+        skip = False
+        if (
+            previous_input is not None
+            and window.residual is not None
+            and previous_input.shape == modulated_input.shape
+            and self.step >= policy.start_step
+            and (policy.end_step < 0 or self.step <= policy.end_step)
+        ):
+            change = (modulated_input - previous_input).abs().mean() / previous_input.abs().mean().clamp(min=1e-8)
+            window.accumulated_change = change.float() if window.accumulated_change is None else window.accumulated_change + change.float()
+            # calls past the skip limit compute anyway, only the others wait for the comparison
+            if policy.max_consecutive_skips <= 0 or window.consecutive_skips < policy.max_consecutive_skips:
+                skip = bool(window.accumulated_change < policy.threshold)
+        if skip:
+            window.consecutive_skips += 1
+            self.skipped_calls += 1
+        else:
+            window.accumulated_change = None
+            window.consecutive_skips = 0
+            self._step_skipped = False
+        window.skip = skip
+        self.calls += 1
+        return skip
+
+    def report(self) -> dict:
+        return {
+            "steps": self.step + 1,
+            "skipped_steps": self.skipped_steps + (1 if self.step >= 0 and self._step_skipped else 0),
+            "calls": self.calls,
+            "skipped_calls": self.skipped_calls,
+        }
+
+    def clear(self):
+        self.__init__(self.policy)
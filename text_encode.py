@@ -0,0 +1,97 @@
+from typing import List, Optional
+
+import torch
+import comfy.model_management as mm
+
+from .prompt_cache import PromptEmbeddingCache, module_fingerprint, patches_fingerprint
+from .utils import log
+
+MAX_TOKENS = 226
+
+def clip_encoder_id(clip) -> str:
+    # LoRAs are applied as patcher patches while the model is loaded, they are part of the encoder identity
+    return f"{module_fingerprint(clip.cond_stage_model)}:{patches_fingerprint(getattr(clip.patcher, 'patches', None))}"
+
+def clip_encoder_dtype(clip) -> Optional[torch.dtype]:
+    """Precision of the encoder's weights, part of the cache key like the pipeline dtype of CogVideoEncodePrompt"""
+    parameter = next(clip.cond_stage_model.parameters(), None)
+    return parameter.dtype if parameter is not None else None
+
+def _tokenize(clip, prompt: str, max_tokens: int):
+    clip.tokenizer.t5xxl.pad_to_max_length = True
+    clip.tokenizer.t5xxl.max_length = max_tokens
+    return clip.tokenize(prompt, return_word_ids=True)
+
+def _check_length(embeds: torch.Tensor, max_tokens: int):
+    if embeds.shape[1] > max_tokens:
+        raise ValueError(f"Prompt is too long, max tokens supported is {max_tokens} or less, got {embeds.shape[1]}")
+
+def encode_clip_prompt(clip, prompt: str, max_tokens: int = MAX_TOKENS) -> torch.Tensor:
+    tokens = _tokenize(clip, prompt, max_tokens)
+    embeds = clip.encode_from_tokens(tokens, return_pooled=False, return_dict=False)
+    _check_length(embeds, max_tokens)
+    return embeds
+
+def _encode_clip_batch(clip, prompts: List[str], max_tokens: int) -> List[torch.Tensor]:
+    """
+    Encodes the prompts in one text encoder call. Every prompt is padded to max_tokens, exactly like a single prompt,
+    and ComfyUI encodes all the token sections of a call as one batch and concatenates them along the sequence,
+    so the output is split back into one max_tokens long slice per prompt.
+    """
+    tokens = [_tokenize(clip, prompt, max_tokens) for prompt in prompts]
+    # prompts over the token limit span several sections, encode them on their own to raise the usual error
+    if any(len(t["t5xxl"]) != 1 for t in tokens):
+        return [encode_clip_prompt(clip, prompt, max_tokens) for prompt in prompts]
+    batch_tokens = {key: [section for t in tokens for section in t[key]] for key in tokens[0]}
+    embeds = clip.encode_from_tokens(batch_tokens, return_pooled=False, return_dict=False)
+    if embeds.shape[1] != len(prompts) * max_tokens:
+        # encoders that don't lay sections out end to end (multi encoder CLIPs), fall back to one call per prompt
+        log.warning(f"Unexpected batched text encoder output shape {tuple(embeds.shape)}, encoding prompts one at a time")
+        return [encode_clip_prompt(clip, prompt, max_tokens) for prompt in prompts]
+    return list(embeds.split(max_tokens, dim=1))
+
+def encode_clip_prompts(
+    clip,
+    prompts: List[str],
+    max_tokens: int = MAX_TOKENS,
+    batch_size: int = 8,
+    cache: Optional[PromptEmbeddingCache] = None,
+    force_offload: bool = True,
+) -> List[torch.Tensor]:
+    """
+    Encodes a list of prompts with a ComfyUI T5 CLIP, `batch_size` prompts per text encoder call.
+    Returns one (1, max_tokens, C) embedding per prompt, the same as encoding each prompt on its own. Duplicate prompts
+    are encoded once, and with a cache only the prompts missing from it are encoded, if none are the text encoder is
+    never loaded.
+    """
+    results = [None] * len(prompts)
+    keys = {}
+    if cache is not None:
+        encoder_id = clip_encoder_id(clip)
+        dtype = clip_encoder_dtype(clip)
+        for i, prompt in enumerate(prompts):
+            keys[prompt] = cache.key(encoder_id, prompt, max_tokens, dtype)
+            results[i] = cache.get(keys[prompt])
+
+    # group the positions of the misses by prompt, so repeated prompts share a batch slot
+    pending = {}
+    for i, prompt in enumerate(prompts):
+        if results[i] is None:
+            pending.setdefault(prompt, []).append(i)
+    if not pending:
+        return results
+
+    clip.cond_stage_model.to(mm.text_encoder_device())
+    unique_prompts = list(pending)
+    for start in range(0, len(unique_prompts), batch_size):
+        batch = unique_prompts[start:start + batch_size]
+        for prompt, embeds in zip(batch, _encode_clip_batch(clip, batch, max_tokens)):
+            if cache is not None:
+                cache.put(keys[prompt], embeds, {"prompt": prompt, "max_sequence_length": max_tokens})
+            positions = pending[prompt]
+            results[positions[0]] = embeds.contiguous()
+            for i in positions[1:]:
+                results[i] = embeds.clone()
+    if force_offload:
+        clip.cond_stage_model.to(mm.text_encoder_offload_device())
+    return results
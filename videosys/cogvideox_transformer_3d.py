@@ -21,7 +21,7 @@ from diffusers.utils import is_torch_version
 from diffusers.utils.torch_utils import maybe_allow_in_graph
 from torch import nn
 
-from .core.pab_mgr import enable_pab, if_broadcast_spatial
+from .core.pab_mgr import PABWindow
 from .modules.embeddings import apply_rotary_emb
 
 #from .modules.embeddings import CogVideoXPatchEmbed
@@ -270,8 +270,6 @@ class CogVideoXBlock(nn.Module):
         )
 
         # pab
-        self.attn_count = 0
-        self.last_attn = None
         self.block_idx = block_idx
     #@torch.compiler.disable()
     def forward(
@@ -280,7 +278,7 @@ class CogVideoXBlock(nn.Module):
         encoder_hidden_states: torch.Tensor,
         temb: torch.Tensor,
         image_rotary_emb: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
-        timestep=None,
+        pab: Optional[PABWindow] = None,
         video_flow_feature: Optional[torch.Tensor] = None,
         fuser=None,
     ) -> torch.Tensor:
@@ -299,18 +297,16 @@ class CogVideoXBlock(nn.Module):
             norm_hidden_states = rearrange(h, "(B T) C H W ->  B (T H W) C", T=T)
             del h, fuser
         # attention
-        if enable_pab():
-            broadcast_attn, self.attn_count = if_broadcast_spatial(int(timestep[0]), self.attn_count, self.block_idx)
-        if enable_pab() and broadcast_attn:
-            attn_hidden_states, attn_encoder_hidden_states = self.last_attn
+        if pab is not None and pab.broadcast_spatial(self.block_idx):
+            attn_hidden_states, attn_encoder_hidden_states = pab.last_attn[self.block_idx]
         else:
             attn_hidden_states, attn_encoder_hidden_states = self.attn1(
                 hidden_states=norm_hidden_states,
                 encoder_hidden_states=norm_encoder_hidden_states,
                 image_rotary_emb=image_rotary_emb,
             )
-            if enable_pab():
-                self.last_attn = (attn_hidden_states, attn_encoder_hidden_states)
+            if pab is not None:
+                pab.save_attn(self.block_idx, attn_hidden_states, attn_encoder_hidden_states)
 
         hidden_states = hidden_states + gate_msa * attn_hidden_states
         encoder_hidden_states = encoder_hidden_states + enc_gate_msa * attn_encoder_hidden_states
@@ -321,8 +317,13 @@ class CogVideoXBlock(nn.Module):
         )
 
         # feed-forward
-        norm_hidden_states = torch.cat([norm_encoder_hidden_states, norm_hidden_states], dim=1)
-        ff_output = self.ff(norm_hidden_states)
+        if pab is not None and pab.broadcast_mlp(self.block_idx):
+            ff_output = pab.mlp_output(self.block_idx)
+        else:
+            norm_hidden_states = torch.cat([norm_encoder_hidden_states, norm_hidden_states], dim=1)
+            ff_output = self.ff(norm_hidden_states)
+            if pab is not None:
+                pab.save_mlp(self.block_idx, ff_output)
 
         hidden_states = hidden_states + gate_ff * ff_output[:, text_seq_length:]
         encoder_hidden_states = encoder_hidden_states + enc_gate_ff * ff_output[:, :text_seq_length]
@@ -472,8 +473,9 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
                     attention_bias=attention_bias,
                     norm_elementwise_affine=norm_elementwise_affine,
                     norm_eps=norm_eps,
+                    block_idx=i,
                 )
-                for _ in range(num_layers)
+                for i in range(num_layers)
             ]
         )
         self.norm_final = nn.LayerNorm(inner_dim, norm_eps, norm_elementwise_affine)
@@ -492,6 +494,11 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
 
         self.fuser_list = None
 
+        # PABState of the current sampling run, set by the pipeline from its PAB config
+        self.pab_state = None
+        # frames of the context windows denoised by the next calls, set by the pipeline, None for the whole video
+        self.context_window = None
+
         # parallel
         #self.parallel_manager = None
 
@@ -572,13 +579,14 @@ class CogVideoXTransformer3DModel(ModelMixin, ConfigMixin):
         #     hidden_states = split_sequence(hidden_states, self.parallel_manager.sp_group, dim=1, pad=get_pad("pad"))
 
         # 4. Transformer blocks
+        pab = self.pab_state.begin_call(timesteps, self.context_window) if self.pab_state is not None else None
         for i, block in enumerate(self.transformer_blocks):
             hidden_states, encoder_hidden_states = block(
                 hidden_states=hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 temb=emb,
                 image_rotary_emb=image_rotary_emb,
-                timestep=timesteps if enable_pab() else None,
+                pab=pab,
                 video_flow_feature=video_flow_features[i] if video_flow_features is not None else None,
                 fuser = self.fuser_list[i] if self.fuser_list is not None else None,
             )
@@ -1,5 +1,4 @@
-
-PAB_MANAGER = None
+import torch
 
 
 class PABConfig:
@@ -16,8 +15,10 @@ class PABConfig:
         temporal_threshold: list = None,
         temporal_range: int = None,
         mlp_broadcast: bool = False,
-        mlp_spatial_broadcast_config: dict = None,
-        mlp_temporal_broadcast_config: dict = None,
+        mlp_threshold: list = None,
+        mlp_range: int = None,
+        mlp_blocks: list = None,
+        mlp_cache_slots: int = 0,
     ):
         self.steps = steps
 
@@ -34,199 +35,230 @@ class PABConfig:
         self.temporal_range = temporal_range
 
         self.mlp_broadcast = mlp_broadcast
-        self.mlp_spatial_broadcast_config = mlp_spatial_broadcast_config
-        self.mlp_temporal_broadcast_config = mlp_temporal_broadcast_config
-        self.mlp_temporal_outputs = {}
-        self.mlp_spatial_outputs = {}
-
-
-class PABManager:
-    def __init__(self, config: PABConfig):
-        self.config: PABConfig = config
-
-        init_prompt = f"Init Pyramid Attention Broadcast. steps: {config.steps}."
-        init_prompt += f" spatial broadcast: {config.spatial_broadcast}, spatial range: {config.spatial_range}, spatial threshold: {config.spatial_threshold}."
-        init_prompt += f" temporal broadcast: {config.temporal_broadcast}, temporal range: {config.temporal_range}, temporal_threshold: {config.temporal_threshold}."
-        init_prompt += f" cross broadcast: {config.cross_broadcast}, cross range: {config.cross_range}, cross threshold: {config.cross_threshold}."
-        init_prompt += f" mlp broadcast: {config.mlp_broadcast}."
-        print(init_prompt)
-
-    def if_broadcast_cross(self, timestep: int, count: int):
-        if (
-            self.config.cross_broadcast
-            and (timestep is not None)
-            and (count % self.config.cross_range != 0)
-            and (self.config.cross_threshold[0] < timestep < self.config.cross_threshold[1])
-        ):
-            flag = True
-        else:
-            flag = False
-        count = (count + 1) % self.config.steps
-        return flag, count
-
-    def if_broadcast_temporal(self, timestep: int, count: int):
-        if (
-            self.config.temporal_broadcast
-            and (timestep is not None)
-            and (count % self.config.temporal_range != 0)
-            and (self.config.temporal_threshold[0] < timestep < self.config.temporal_threshold[1])
-        ):
-            flag = True
-        else:
-            flag = False
-        count = (count + 1) % self.config.steps
-        return flag, count
-
-    def if_broadcast_spatial(self, timestep: int, count: int, block_idx: int):
-        if (
-            self.config.spatial_broadcast
-            and (timestep is not None)
-            and (count % self.config.spatial_range != 0)
-            and (self.config.spatial_threshold[0] < timestep < self.config.spatial_threshold[1])
-        ):
-            flag = True
-        else:
-            flag = False
-        count = (count + 1) % self.config.steps
-        return flag, count
+        self.mlp_threshold = mlp_threshold
+        self.mlp_range = mlp_range
+        # None broadcasts the MLP of every block
+        self.mlp_blocks = mlp_blocks
+        # stored MLP outputs shared by all the calls of a step, 0 for one per broadcast block and call
+        self.mlp_cache_slots = mlp_cache_slots
+
+
+class PABSchedule:
+    """
+    Broadcast decisions of one sampling run, compiled once from a PABConfig and the scheduler's timesteps into boolean
+    tables indexed by [step, block]. An attention or MLP output is broadcast on the steps not divisible by its range
+    whose timestep lies strictly inside its threshold, steps past the end of the tables always compute. The attention
+    and MLP outputs are only stored on the steps right before a broadcast one (`spatial_store`, `mlp_store`), the MLP
+    outputs only for `mlp_blocks`.
+    """
+
+    def __init__(self, config: PABConfig, timesteps, num_blocks: int):
+        self.config = config
+        # the blocks used to compare the timestep truncated to an int
+        timesteps = torch.as_tensor(timesteps).detach().flatten().cpu().to(torch.int64)
+        self.num_steps = timesteps.shape[0]
+        self.num_blocks = num_blocks
+
+        self.spatial = self._compile(config.spatial_broadcast, config.spatial_threshold, config.spatial_range, timesteps, num_blocks)
+        self.temporal = self._compile(config.temporal_broadcast, config.temporal_threshold, config.temporal_range, timesteps, num_blocks)
+        self.cross = self._compile(config.cross_broadcast, config.cross_threshold, config.cross_range, timesteps, num_blocks)
+        self.mlp = self._compile(config.mlp_broadcast, config.mlp_threshold, config.mlp_range, timesteps, num_blocks)
+        if config.mlp_blocks is not None:
+            block_mask = torch.zeros(num_blocks, dtype=torch.bool)
+            block_mask[[block for block in config.mlp_blocks if block < num_blocks]] = True
+            self.mlp &= block_mask
+        # blocks only ever store on computed steps, so a failed broadcast still refills the buffer
+        self.spatial_store = torch.zeros_like(self.spatial)
+        self.spatial_store[:-1] = self.spatial[1:]
+        self.mlp_store = torch.zeros_like(self.mlp)
+        self.mlp_store[:-1] = self.mlp[1:]
+        self.num_mlp_blocks = int(self.mlp.any(dim=0).sum())
+        # nested lists for the per block lookups, indexing the tensors would build a new tensor on every call
+        self._spatial = self.spatial.tolist()
+        self._spatial_store = self.spatial_store.tolist()
+        self._temporal = self.temporal.tolist()
+        self._cross = self.cross.tolist()
+        self._mlp = self.mlp.tolist()
+        self._mlp_store = self.mlp_store.tolist()
 
     @staticmethod
-    def _is_t_in_skip_config(all_timesteps, timestep, config):
-        is_t_in_skip_config = False
-        skip_range = None
-        for key in config:
-            if key not in all_timesteps:
-                continue
-            index = all_timesteps.index(key)
-            skip_range = all_timesteps[index : index + 1 + int(config[key]["skip_count"])]
-            if timestep in skip_range:
-                is_t_in_skip_config = True
-                skip_range = [all_timesteps[index], all_timesteps[index + int(config[key]["skip_count"])]]
-                break
-        return is_t_in_skip_config, skip_range
-
-    def if_skip_mlp(self, timestep: int, count: int, block_idx: int, all_timesteps, is_temporal=False):
-        if not self.config.mlp_broadcast:
-            return False, None, False, None
-
-        if is_temporal:
-            cur_config = self.config.mlp_temporal_broadcast_config
-        else:
-            cur_config = self.config.mlp_spatial_broadcast_config
-
-        is_t_in_skip_config, skip_range = self._is_t_in_skip_config(all_timesteps, timestep, cur_config)
-        next_flag = False
-        if (
-            self.config.mlp_broadcast
-            and (timestep is not None)
-            and (timestep in cur_config)
-            and (block_idx in cur_config[timestep]["block"])
-        ):
-            flag = False
-            next_flag = True
-            count = count + 1
-        elif (
-            self.config.mlp_broadcast
-            and (timestep is not None)
-            and (is_t_in_skip_config)
-            and (block_idx in cur_config[skip_range[0]]["block"])
-        ):
-            flag = True
-            count = 0
-        else:
-            flag = False
-
-        return flag, count, next_flag, skip_range
-
-    def save_skip_output(self, timestep, block_idx, ff_output, is_temporal=False):
-        if is_temporal:
-            self.config.mlp_temporal_outputs[(timestep, block_idx)] = ff_output
+    def _compile(enabled: bool, threshold: list, broadcast_range: int, timesteps: torch.Tensor, num_blocks: int) -> torch.Tensor:
+        if not enabled:
+            return torch.zeros(timesteps.shape[0], num_blocks, dtype=torch.bool)
+        steps = torch.arange(timesteps.shape[0])
+        flags = (steps % broadcast_range != 0) & (timesteps > threshold[0]) & (timesteps < threshold[1])
+        return flags.unsqueeze(1).expand(-1, num_blocks).contiguous()
+
+    def __repr__(self):
+        return (f"PABSchedule(steps={self.num_steps}, blocks={self.num_blocks}, "
+                f"spatial={int(self.spatial.sum())}, temporal={int(self.temporal.sum())}, cross={int(self.cross.sum())}, "
+                f"mlp={int(self.mlp.sum())})")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.spatial.any() or self.temporal.any() or self.cross.any() or self.mlp.any())
+
+    def broadcast_spatial(self, step: int, block_idx: int) -> bool:
+        return step < self.num_steps and self._spatial[step][block_idx]
+
+    def store_spatial(self, step: int, block_idx: int) -> bool:
+        return step < self.num_steps and self._spatial_store[step][block_idx]
+
+    def broadcast_temporal(self, step: int, block_idx: int) -> bool:
+        return step < self.num_steps and self._temporal[step][block_idx]
+
+    def broadcast_cross(self, step: int, block_idx: int) -> bool:
+        return step < self.num_steps and self._cross[step][block_idx]
+
+    def broadcast_mlp(self, step: int, block_idx: int) -> bool:
+        return step < self.num_steps and self._mlp[step][block_idx]
+
+    def store_mlp(self, step: int, block_idx: int) -> bool:
+        return step < self.num_steps and self._mlp_store[step][block_idx]
+
+
+class PABOutputBuffer:
+    """
+    Ring buffer of the stored MLP outputs: a fixed number of slots allocated together on the first store, each new key
+    takes the next slot in turn and evicts the key stored there, so more context windows than slots or an interrupted
+    run can't grow it. Outputs of another shape than the slots are not stored, their block computes instead.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buffer = None
+        self.slots = {}
+        self._keys = [None] * capacity
+        self._next_slot = 0
+        self.evicted = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self.slots
+
+    def store(self, key, tensor: torch.Tensor):
+        if self.buffer is None and self.capacity > 0:
+            self.buffer = tensor.new_empty((self.capacity, *tensor.shape))
+        if self.buffer is None or self.buffer.shape[1:] != tensor.shape or self.buffer.dtype != tensor.dtype:
+            self.slots.pop(key, None)
+            return
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self._next_slot
+            self._next_slot = (slot + 1) % self.capacity
+            if self._keys[slot] is not None:
+                del self.slots[self._keys[slot]]
+                self.evicted += 1
+            self._keys[slot] = key
+            self.slots[key] = slot
+        self.buffer[slot].copy_(tensor)
+
+    def get(self, key) -> torch.Tensor:
+        return self.buffer[self.slots[key]]
+
+    def clear(self):
+        self.buffer = None
+        self.slots.clear()
+        self._keys = [None] * self.capacity
+        self._next_slot = 0
+        self.evicted = 0
+
+
+class PABWindow:
+    """
+    Attention outputs of one context window, or of the whole video, kept by the blocks for the broadcast steps. Only
+    the blocks broadcasting on the next step keep theirs.
+    """
+
+    def __init__(self, schedule: PABSchedule, window_id, mlp_outputs: PABOutputBuffer):
+        self.schedule = schedule
+        self.window_id = window_id
+        self.step = 0
+        self.last_attn = {}
+        self.mlp_outputs = mlp_outputs
+
+    def broadcast_spatial(self, block_idx: int) -> bool:
+        # windows a schedule only adds late in the run have nothing to broadcast yet
+        return block_idx in self.last_attn and self.schedule.broadcast_spatial(self.step, block_idx)
+
+    def save_attn(self, block_idx: int, attn_hidden_states: torch.Tensor, attn_encoder_hidden_states: torch.Tensor):
+        if self.schedule.store_spatial(self.step, block_idx):
+            self.last_attn[block_idx] = (attn_hidden_states, attn_encoder_hidden_states)
         else:
-            self.config.mlp_spatial_outputs[(timestep, block_idx)] = ff_output
-
-    def get_mlp_output(self, skip_range, timestep, block_idx, is_temporal=False):
-        skip_start_t = skip_range[0]
-        if is_temporal:
-            skip_output = (
-                self.config.mlp_temporal_outputs.get((skip_start_t, block_idx), None)
-                if self.config.mlp_temporal_outputs is not None
-                else None
-            )
-        else:
-            skip_output = (
-                self.config.mlp_spatial_outputs.get((skip_start_t, block_idx), None)
-                if self.config.mlp_spatial_outputs is not None
-                else None
-            )
-
-        if skip_output is not None:
-            if timestep == skip_range[-1]:
-                # TODO: save memory
-                if is_temporal:
-                    del self.config.mlp_temporal_outputs[(skip_start_t, block_idx)]
-                else:
-                    del self.config.mlp_spatial_outputs[(skip_start_t, block_idx)]
-        else:
-            raise ValueError(
-                f"No stored MLP output found | t {timestep} |[{skip_range[0]}, {skip_range[-1]}] | block {block_idx}"
-            )
-
-        return skip_output
-
-    def get_spatial_mlp_outputs(self):
-        return self.config.mlp_spatial_outputs
-
-    def get_temporal_mlp_outputs(self):
-        return self.config.mlp_temporal_outputs
-
-
-def set_pab_manager(config: PABConfig):
-    global PAB_MANAGER
-    PAB_MANAGER = PABManager(config)
-
-
-def enable_pab():
-    if PAB_MANAGER is None:
-        return False
-    return (
-        PAB_MANAGER.config.cross_broadcast
-        or PAB_MANAGER.config.spatial_broadcast
-        or PAB_MANAGER.config.temporal_broadcast
-    )
-
-
-def update_steps(steps: int):
-    if PAB_MANAGER is not None:
-        PAB_MANAGER.config.steps = steps
-
-
-def if_broadcast_cross(timestep: int, count: int):
-    if not enable_pab():
-        return False, count
-    return PAB_MANAGER.if_broadcast_cross(timestep, count)
-
-
-def if_broadcast_temporal(timestep: int, count: int):
-    if not enable_pab():
-        return False, count
-    return PAB_MANAGER.if_broadcast_temporal(timestep, count)
-
-
-def if_broadcast_spatial(timestep: int, count: int, block_idx: int):
-    if not enable_pab():
-        return False, count
-    return PAB_MANAGER.if_broadcast_spatial(timestep, count, block_idx)
-
-
-def if_broadcast_mlp(timestep: int, count: int, block_idx: int, all_timesteps, is_temporal=False):
-    if not enable_pab():
-        return False, count
-    return PAB_MANAGER.if_skip_mlp(timestep, count, block_idx, all_timesteps, is_temporal)
-
-
-def save_mlp_output(timestep: int, block_idx: int, ff_output, is_temporal=False):
-    return PAB_MANAGER.save_skip_output(timestep, block_idx, ff_output, is_temporal)
-
-
-def get_mlp_output(skip_range, timestep, block_idx: int, is_temporal=False):
-    return PAB_MANAGER.get_mlp_output(skip_range, timestep, block_idx, is_temporal)
+            self.last_attn.pop(block_idx, None)
+
+    def broadcast_mlp(self, block_idx: int) -> bool:
+        return (self.window_id, block_idx) in self.mlp_outputs and self.schedule.broadcast_mlp(self.step, block_idx)
+
+    def mlp_output(self, block_idx: int) -> torch.Tensor:
+        return self.mlp_outputs.get((self.window_id, block_idx))
+
+    def save_mlp(self, block_idx: int, ff_output: torch.Tensor):
+        if self.schedule.store_mlp(self.step, block_idx):
+            self.mlp_outputs.store((self.window_id, block_idx), ff_output)
+
+
+class PABState:
+    """
+    PAB state of a sampling run, set on the transformer as `pab_state` by the pipeline holding the config, so every
+    loaded model keeps its own schedule. Like FasterCache, the step advances when the timestep changes and each call
+    keeps its own outputs, keyed by the frames it denoises and its position among the calls on those frames, so the
+    shifting context schedules never broadcast the outputs of another part of the video. The windows a step doesn't
+    visit are dropped. Every window stores its MLP outputs in its own buffer, with `mlp_cache_slots` all the windows
+    share one ring buffer of that many slots instead, `evicted` counts the outputs dropped before their broadcast.
+    """
+
+    def __init__(self, schedule: PABSchedule):
+        self.schedule = schedule
+        self.windows = {}
+        self.mlp_outputs = PABOutputBuffer(schedule.config.mlp_cache_slots) if schedule.config.mlp_cache_slots else None
+        self.step = -1
+        self._timestep = None
+        self._step_calls = {}
+        self._evicted = 0
+
+    @property
+    def evicted(self) -> int:
+        buffers = [self.mlp_outputs] if self.mlp_outputs is not None else [window.mlp_outputs for window in self.windows.values()]
+        return self._evicted + sum(buffer.evicted for buffer in buffers)
+
+    def begin_call(self, timestep, frames=None) -> PABWindow:
+        timestep = float(timestep.flatten()[0]) if torch.is_tensor(timestep) else float(timestep)
+        if self.step < 0 or timestep != self._timestep:
+            self._end_step()
+            self.step += 1
+        self._timestep = timestep
+        call = self._step_calls.get(frames, 0)
+        self._step_calls[frames] = call + 1
+        window_id = (frames, call)
+        window = self.windows.get(window_id)
+        if window is None:
+            mlp_outputs = self.mlp_outputs if self.mlp_outputs is not None else PABOutputBuffer(self.schedule.num_mlp_blocks)
+            window = self.windows[window_id] = PABWindow(self.schedule, window_id, mlp_outputs)
+        window.step = self.step
+        return window
+
+    def _end_step(self):
+        if self._step_calls:
+            visited = {(frames, call) for frames, calls in self._step_calls.items() for call in range(calls)}
+            for window_id in [window_id for window_id in self.windows if window_id not in visited]:
+                if self.mlp_outputs is None:
+                    self._evicted += self.windows[window_id].mlp_outputs.evicted
+                del self.windows[window_id]
+        self._step_calls = {}
+
+    def clear(self):
+        self.windows.clear()
+        if self.mlp_outputs is not None:
+            self.mlp_outputs.clear()
+        self.step = -1
+        self._timestep = None
+        self._step_calls = {}
+        self._evicted = 0
+
+
+def pab_state_for(config: PABConfig, timesteps, transformer) -> PABState:
+    """Compiles the schedule of a run, None when the config broadcasts nothing on these timesteps"""
+    if config is None:
+        return None
+    schedule = PABSchedule(config, timesteps, len(transformer.transformer_blocks))
+    return PABState(schedule) if schedule.enabled else None
@@ -1,39 +1,4 @@
-class PABConfig:
-    def __init__(
-        self,
-        steps: int,
-        cross_broadcast: bool = False,
-        cross_threshold: list = None,
-        cross_range: int = None,
-        spatial_broadcast: bool = False,
-        spatial_threshold: list = None,
-        spatial_range: int = None,
-        temporal_broadcast: bool = False,
-        temporal_threshold: list = None,
-        temporal_range: int = None,
-        mlp_broadcast: bool = False,
-        mlp_spatial_broadcast_config: dict = None,
-        mlp_temporal_broadcast_config: dict = None,
-    ):
-        self.steps = steps
-
-        self.cross_broadcast = cross_broadcast
-        self.cross_threshold = cross_threshold
-        self.cross_range = cross_range
-
-        self.spatial_broadcast = spatial_broadcast
-        self.spatial_threshold = spatial_threshold
-        self.spatial_range = spatial_range
-
-        self.temporal_broadcast = temporal_broadcast
-        self.temporal_threshold = temporal_threshold
-        self.temporal_range = temporal_range
-
-        self.mlp_broadcast = mlp_broadcast
-        self.mlp_spatial_broadcast_config = mlp_spatial_broadcast_config
-        self.mlp_temporal_broadcast_config = mlp_temporal_broadcast_config
-        self.mlp_temporal_outputs = {}
-        self.mlp_spatial_outputs = {}
+from .core.pab_mgr import PABConfig
 
 class CogVideoXPABConfig(PABConfig):
     def __init__(
@@ -48,6 +13,11 @@ class CogVideoXPABConfig(PABConfig):
         cross_broadcast: bool = False,
         cross_threshold: list = [100, 850],
         cross_range: int = 6,
+        mlp_broadcast: bool = False,
+        mlp_threshold: list = [100, 850],
+        mlp_range: int = 2,
+        mlp_blocks: list = None,
+        mlp_cache_slots: int = 0,
     ):
         super().__init__(
             steps=steps,
@@ -59,6 +29,10 @@ class CogVideoXPABConfig(PABConfig):
             temporal_range=temporal_range,
             cross_broadcast=cross_broadcast,
             cross_threshold=cross_threshold,
-            cross_range=cross_range
-
+            cross_range=cross_range,
+            mlp_broadcast=mlp_broadcast,
+            mlp_threshold=mlp_threshold,
+            mlp_range=mlp_range,
+            mlp_blocks=mlp_blocks,
+            mlp_cache_slots=mlp_cache_slots,
         )
\ No newline at end of file